@@ -14,5 +14,21 @@ if sys.version_info < (3, 6):
 __all__ = [
     "utils",
     "ldap_manager",
-    "lumext"
+    "lumext",
+    "warmup",
+    "health",
+    "scheduler",
+    "benchmark",
+    "tracing",
+    "profiler",
+    "password_policy",
+    "startup",
+    "snapshot_cache",
+    "idempotency",
+    "directory_stats",
+    "reply_publisher",
+    "jobs",
+    "audit",
+    "sites",
+    "search_index"
 ]
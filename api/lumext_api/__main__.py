@@ -4,25 +4,38 @@
 Run this script as a daemon (or in console mode for debug).
 """
 # Standard imports
+import argparse
+import atexit
 import logging, logging.config
 import signal
 import os
-import ssl
+import sys
+import threading
+import time
+from contextlib import ExitStack
 
-# PIP imports
-from vcdextmessageworker import Connection, MessageWorker
-import simplejson as json
-
-# Local imports
-from .utils import signal_handler, configuration_manager as cm, add_log_level, validate_configuration_path
+# Local imports (heavy dependencies are imported by the commands needing them)
+from .startup import timed_import, mark, format_report, report as startup_report
+from .utils import signal_handler, profiler_signal_handler, configuration_manager as cm, config_get, add_log_level, validate_configuration_path
 
 logger = logging.getLogger(__name__)
 
+# Settings without default value
+REQUIRED_SETTINGS = [
+    "rabbitmq.server", "rabbitmq.port", "rabbitmq.user", "rabbitmq.password",
+    "rabbitmq.exchange", "rabbitmq.queue", "rabbitmq.routing_key",
+    "ldap.address", "ldap.user", "ldap.secret", "ldap.base", "ldap.domain",
+    "log.config_path",
+]
+# State of the consumer of each site (site name -> dict)
+consumers = {}
+
 
 def logger_init():
     """Initialize logger.
     """
     logger.debug("Configuring loggers...")
+    json = timed_import("simplejson")
     # disable tracebacks in kombu
     os.environ['DISABLE_TRACEBACKS'] = "1"
     # create trivia level
@@ -34,30 +47,389 @@ def logger_init():
     return
 
 
-def main():
-    """Execute the API worker.
+def register_health_probes(connections: dict):
+    """Register the probes reported by the health server.
+
+    Args:
+        connections (dict): The AMQP connections of the daemon (site name -> kombu.Connection).
     """
-    validate_configuration_path("LUMEXT_CONFIGURATION_FILE_PATH")
-    logger_init()
+    from . import ldap_manager as lm
+    from .lumext import worker_stats
+    from .scheduler import get_scheduler
+    from .health import register_probe
+    from .snapshot_cache import get_snapshot_cache
+    from .idempotency import get_idempotency_store
+    from .reply_publisher import get_reply_publisher
+    from .jobs import get_job_manager
+    from .audit import get_audit_log
+    from .sites import get_sites, activate
+    from .search_index import get_index
+
+    def amqp_probe():
+        connected = {name: bool(conn.connected) for name, conn in connections.items()}
+        stats = {"healthy": all(connected.values()), "connected": all(connected.values())}
+        if len(connected) > 1:
+            stats["sites"] = connected
+        return stats
+
+    def consumers_probe():
+        # Consumers of the additional sites are restarted when they stop
+        return {"healthy": all(c["running"] for c in consumers.values()), "sites": dict(consumers)}
+
+    def ldap_probe():
+        pools = {}
+        for site in get_sites():
+            with activate(site):
+                pool = lm.get_ldap_pool().stats()
+            latency = lm.bind_stats["last_latency"]
+            pool["saturation"] = round(pool["in_use"] / pool["size"], 3) if pool["size"] else 1.0
+            pool["last_bind_latency"] = round(latency, 6) if latency is not None else None
+            pool["bind_failures"] = lm.bind_stats["failures"]
+            # The latest bind failed (directory down, invalid credentials...)
+            last_failure = lm.bind_stats["last_failure"]
+            pool["bind_failing"] = last_failure is not None and last_failure > (lm.bind_stats["last_time"] or 0)
+            if pool["bind_failing"]:
+                pool["last_bind_error"] = lm.bind_stats["last_error"]
+            # At least one connection is available or can be opened, and binds succeed
+            pool["healthy"] = not pool["bind_failing"] and (pool["idle"] > 0 or pool["opened"] < pool["size"])
+            pools[site.name] = pool
+        if len(pools) == 1:
+            return pools.popitem()[1]
+        return {"healthy": all(p["healthy"] for p in pools.values()), "sites": pools}
+
+    def workers_probe():
+        stats = dict(worker_stats, **get_scheduler().stats())
+        stats["backlog"] = stats["queued"]
+        stats["ldap_waiting"] = sum(pool.stats()["waiting"] for pool in lm.get_ldap_pools())
+        return stats
+
+    register_probe("amqp", amqp_probe)
+    register_probe("consumers", consumers_probe)
+    register_probe("ldap", ldap_probe)
+    register_probe("workers", workers_probe)
+    register_probe("startup", startup_report)
+    cache = get_snapshot_cache()
+    if cache:
+        register_probe("snapshot_cache", lambda: dict(cache.stats))
+    store = get_idempotency_store()
+    if store:
+        register_probe("idempotency", lambda: dict(store.stats))
+    publishers = {site.name: get_reply_publisher(site) for site in get_sites()}
+
+    def publisher_probe():
+        stats = {name: dict(p.stats, backlog=p.backlog()) for name, p in publishers.items()}
+        return stats.popitem()[1] if len(stats) == 1 else stats
+
+    if any(publishers.values()):
+        register_probe("reply_publisher", publisher_probe)
+    jobs = get_job_manager()
+    if jobs:
+        register_probe("jobs", lambda: dict(jobs.stats, backlog=jobs.backlog()))
+    index = get_index()
+    if index:
+        register_probe("search", lambda: dict(index.stats, ready=index.ready))
+    audit_log = get_audit_log()
+    if audit_log:
+        register_probe("audit", lambda: dict(audit_log.stats, backlog=audit_log.backlog()))
+
+
+def parse_args(argv=None):
+    """Parse the command line.
+
+    Args:
+        argv (list, optional): Defaults to `sys.argv`. Arguments to parse.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser("lumext", description="LUMExt API worker for vCloud Director")
+    parser.add_argument("--timing", action="store_true",
+                        help="print the startup timing report (import costs) on stderr")
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="run the API worker (default command)")
+    run.add_argument("--record", metavar="FILE",
+                     help="record the incoming request envelopes in FILE (passwords are redacted)")
+    replay = commands.add_parser("replay", help="replay recorded requests against a worker")
+    replay.add_argument("recording", help="file written by `lumext run --record`")
+    replay.add_argument("--rate", type=float, default=10, help="requests per second (default: 10)")
+    replay.add_argument("--concurrency", type=int, default=4,
+                        help="maximum requests waiting for a reply (default: 4)")
+    replay.add_argument("--count", type=int, help="number of requests to send (default: recording size)")
+    replay.add_argument("--password", help="password to use in place of the redacted ones")
+    replay.add_argument("--report", metavar="FILE", help="write the JSON report in FILE")
+    soak = commands.add_parser("soak", help="proceed recorded requests in-process for hours and watch resources")
+    soak.add_argument("recording", help="file written by `lumext run --record`")
+    soak.add_argument("--duration", type=float, default=3600, help="seconds of load (default: 3600)")
+    soak.add_argument("--rate", type=float, default=10, help="requests per second (default: 10)")
+    soak.add_argument("--password", help="password to use in place of the redacted ones")
+    soak.add_argument("--sample-interval", type=float, default=30,
+                      help="seconds between two samples (default: 30)")
+    soak.add_argument("--warmup", type=float, default=300,
+                      help="seconds of load before the baseline sample (default: 300)")
+    soak.add_argument("--max-rss-growth", type=float, default=50, help="in MB (default: 50)")
+    soak.add_argument("--max-thread-growth", type=int, default=5, help="(default: 5)")
+    soak.add_argument("--max-fd-growth", type=int, default=10, help="(default: 10)")
+    soak.add_argument("--max-objects-growth", type=float, default=0.2,
+                      help="ratio of GC tracked objects (default: 0.2)")
+    soak.add_argument("--report", metavar="FILE", help="write the JSON report in FILE")
+    commands.add_parser("check-config", help="validate the configuration file and exit")
+    health = commands.add_parser("health", help="query the health server of a running worker")
+    health.add_argument("--live", action="store_true",
+                        help="check liveness (/health) instead of readiness (/ready)")
+    args = parser.parse_args(argv)
+    if not args.command:
+        args = parser.parse_args((sys.argv[1:] if argv is None else argv) + ["run"])
+    return args
+
+
+def check_config():
+    """Check that the required settings are set (`check-config` command).
+
+    Returns:
+        int: Exit code (0 if the configuration is valid).
+    """
+    errors = [f"Missing setting: {path}" for path in REQUIRED_SETTINGS if config_get(path) is None]
+    log_config = config_get("log.config_path")
+    if log_config and not os.path.isfile(log_config):
+        errors.append(f"Invalid path for logging configuration file: {log_config}")
+    from .sites import site_name
+    # Unnamed sites are named after their position, as when serving them
+    names = [site_name(i, site) for i, site in enumerate(config_get("sites", None) or [])]
+    errors += [f"Duplicated site name: {name}" for name in sorted(set(names)) if names.count(name) > 1]
+    for error in errors:
+        print(error)
+    if errors:
+        return 1
+    print(f"Configuration is valid: {os.environ.get('LUMEXT_CONFIGURATION_FILE_PATH')}")
+    return 0
+
+
+def health_check(args):
+    """Query the health server of a running worker (`health` command).
+
+    Args:
+        args (argparse.Namespace): Parsed arguments of the `health` command.
+
+    Returns:
+        int: Exit code (0 if the worker is healthy/ready).
+    """
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+    address = config_get("health.address", "127.0.0.1")
+    port = int(config_get("health.port", 8081))
+    url = f"http://{address}:{port}/{'health' if args.live else 'ready'}"
+    try:
+        with urlopen(url, timeout=5) as response:
+            print(response.read().decode("utf-8"))
+            return 0
+    except HTTPError as e:
+        print(e.read().decode("utf-8"))
+    except URLError as e:
+        print(f"Cannot reach health server on {url}: {e.reason}")
+    return 1
+
+
+def replay(args):
+    """Replay recorded requests and report latencies.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments of the `replay` command.
+    """
+    from .benchmark import replay as run_replay, print_report
+    report = run_replay(
+        args.recording,
+        rate=args.rate,
+        concurrency=args.concurrency,
+        count=args.count,
+        password=args.password
+    )
+    print_report(report)
+    if args.report:
+        json = timed_import("simplejson")
+        with open(args.report, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, indent=2)
+
+
+def soak(args):
+    """Run a soak test (`soak` command).
+
+    Args:
+        args (argparse.Namespace): Parsed arguments of the `soak` command.
+
+    Returns:
+        int: Exit code (0 if no resource grew beyond its threshold).
+    """
+    from .benchmark import soak as run_soak, print_soak_report
+    report = run_soak(
+        args.recording,
+        duration=args.duration,
+        rate=args.rate,
+        password=args.password,
+        sample_interval=args.sample_interval,
+        warmup=args.warmup,
+        thresholds={
+            "rss": args.max_rss_growth,
+            "threads": args.max_thread_growth,
+            "fds": args.max_fd_growth,
+            "gc_objects": args.max_objects_growth,
+        }
+    )
+    print_soak_report(report)
+    if args.report:
+        json = timed_import("simplejson")
+        with open(args.report, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, indent=2)
+    return 0 if report["passed"] else 1
+
+
+def consume(worker, conn, site):
+    """Consume the requests of a site, forever.
+
+    Args:
+        worker (module): The `vcdextmessageworker` module.
+        conn (kombu.Connection): The AMQP connection of the site.
+        site (sites.Site): The site.
+    """
+    rmq_conf = site.rabbitmq
+    consumer = worker.MessageWorker(
+        conn,
+        exchange=rmq_conf.exchange,
+        queue=rmq_conf.queue,
+        routing_key=rmq_conf.routing_key,
+        sub_worker="lumext_api.lumext.MessageWorker",
+        thread_support=True)
+    # Requests are run with the settings of their site
+    consumer.site = site
+    state = consumers.setdefault(site.name, {"running": False, "restarts": 0, "last_error": None})
+    logger.info(f"Consuming requests of site {site.name} from queue {rmq_conf.queue}")
+    state["running"] = True
+    try:
+        consumer.run()
+    except Exception as e:
+        logger.critical(f"Consumer of site {site.name} stopped: {str(e)}")
+        state["last_error"] = str(e)
+        raise
+    finally:
+        state["running"] = False
+
+
+def consume_forever(worker, conn, site):
+    """Consume the requests of an additional site, restarting its consumer if it stops.
+
+    The site is reported unhealthy (``consumers`` probe) until the consumer
+    runs again.
+
+    Args:
+        worker (module): The `vcdextmessageworker` module.
+        conn (kombu.Connection): The AMQP connection of the site.
+        site (sites.Site): The site.
+    """
+    delay = 1
+    while True:
+        started = time.monotonic()
+        try:
+            consume(worker, conn, site)
+        except Exception:
+            pass
+        if time.monotonic() - started > 60:
+            # It ran for a while: not a crash loop
+            delay = 1
+        consumers[site.name]["restarts"] += 1
+        logger.warning(f"Restarting consumer of site {site.name} in {delay}s.")
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+
+def run(args):
+    """Run the API worker (`run` command).
+
+    Args:
+        args (argparse.Namespace): Parsed arguments of the `run` command.
+    """
+    # Import the AMQP and LDAP stacks, and the sub worker, first: the modules
+    # imported below would otherwise load (and hide the cost of) kombu
+    worker = timed_import("vcdextmessageworker")
+    timed_import("lumext_api.ldap_manager")
+    timed_import("lumext_api.lumext")
+    mark("imports")
+    from .warmup import warm_up, save_recent_tenants
+    from .health import start_health_server
+    from .reply_publisher import get_reply_publisher
+    from .audit import get_audit_log
+    if args.record:
+        from .benchmark import start_recording
+        start_recording(args.record)
 
     # Catch interruption signal to leave quietly
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    # Toggle the sampling profiler at runtime
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profiler_signal_handler)
+        signal.signal(signal.SIGUSR2, profiler_signal_handler)
+    atexit.register(save_recent_tenants)
+    audit_log = get_audit_log()
+    if audit_log:
+        # Audit records still queued on shutdown are written
+        atexit.register(audit_log.flush)
     logger.info("Starting API server")
 
-    # Start AMQP connection
-    rmq_conf = cm().rabbitmq
-    amqp_url = f"amqp://{rmq_conf.user}:{rmq_conf.password}"
-    amqp_url += f"@{rmq_conf.server}:{rmq_conf.port}/%2F"
-    if rmq_conf.use_ssl:
-        amqp_url += "?ssl=1"
-    with Connection(amqp_url, heartbeat=4) as conn:
-        MessageWorker(
-            conn,
-            exchange=rmq_conf.exchange,
-            queue=rmq_conf.queue,
-            routing_key=rmq_conf.routing_key,
-            sub_worker="lumext_api.lumext.MessageWorker",
-            thread_support=True).run()
+    # Get ready before consuming the first message
+    warm_up()
+    mark("warm-up")
+    from .directory_stats import start_reconciler
+    start_reconciler()
+    from .search_index import start_indexer
+    start_indexer()
+    logger.info(format_report())
+
+    # Start the AMQP connection of each site
+    from .sites import get_sites
+    sites = get_sites()
+    with ExitStack() as stack:
+        connections = {
+            site.name: stack.enter_context(worker.Connection(site.amqp_url, heartbeat=4))
+            for site in sites
+        }
+        register_health_probes(connections)
+        start_health_server()
+        for site in sites:
+            publisher = get_reply_publisher(site)
+            if publisher:
+                # Replies still queued on shutdown are published first
+                atexit.register(publisher.flush)
+        # Sites share the scheduler: one consumer thread per additional site
+        for site in sites[1:]:
+            threading.Thread(
+                target=consume_forever, args=(worker, connections[site.name], site),
+                name=f"Consumer-{site.name}", daemon=True
+            ).start()
+        consume(worker, connections[sites[0].name], sites[0])
+
+
+def main(argv=None):
+    """Execute the API worker (or a tool command).
+
+    Args:
+        argv (list, optional): Defaults to `sys.argv`. Command line arguments.
+    """
+    args = parse_args(argv)
+    validate_configuration_path("LUMEXT_CONFIGURATION_FILE_PATH")
+    cm()
+    mark("configuration")
+    if args.timing:
+        atexit.register(lambda: print(format_report(), file=sys.stderr))
+    if args.command == "check-config":
+        sys.exit(check_config())
+    if args.command == "health":
+        sys.exit(health_check(args))
+    logger_init()
+    mark("logging")
+    if args.command == "replay":
+        return replay(args)
+    if args.command == "soak":
+        sys.exit(soak(args))
+    return run(args)
 
 
 if __name__ == '__main__':
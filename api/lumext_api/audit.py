@@ -0,0 +1,263 @@
+"""Audit trail of the directory mutations.
+
+Each user creation, edition and deletion is recorded with the requester
+(user and organization), the target DN, the changed attributes (passwords
+redacted), the outcome and the latency.
+
+Records are queued without blocking the mutation, and written by a single
+thread in batches: one line of JSON per record, appended to
+``audit.path`` with one ``fsync`` per batch (group commit). The file is
+rotated when it exceeds ``audit.max_bytes`` (``audit.backups`` rotated files
+are kept).
+"""
+# Standard imports
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import config_get
+
+logger = logging.getLogger(__name__)
+
+REDACTED = "********"
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+# Requester of the operations run by the current thread
+_requester = threading.local()
+
+
+@contextmanager
+def requester(user: str, org: str):
+    """Set the requester of the operations run by the current thread.
+
+    Args:
+        user (str): ID of the vCD user.
+        org (str): Organization of the request.
+    """
+    previous = getattr(_requester, "value", None)
+    _requester.value = (user, org)
+    try:
+        yield
+    finally:
+        _requester.value = previous
+
+
+def redact(attributes: dict):
+    """Hide the passwords of changed attributes.
+
+    Args:
+        attributes (dict): Changed attributes.
+
+    Returns:
+        dict: A copy, with the password values replaced.
+    """
+    return {
+        k: (REDACTED if "password" in k.lower() or k == "unicodePwd" else v)
+        for k, v in (attributes or {}).items()
+    }
+
+
+def _text(value):
+    """Decode bytes values for the JSON record.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_text(v) for v in value]
+    return value
+
+
+class AuditLog():
+    """Append audit records to a rotated file, by batches.
+    """
+
+    def __init__(self, path: str, max_bytes: int=100 * 1024 * 1024, backups: int=10,
+                 batch_size: int=500, queue_size: int=100000):
+        """Open the audit file and start the writer thread.
+
+        Args:
+            path (str): Path of the audit file.
+            max_bytes (int, optional): Defaults to 100MB. Size of the file before rotation.
+            backups (int, optional): Defaults to 10. Rotated files kept.
+            batch_size (int, optional): Defaults to 500. Maximum records written per fsync.
+            queue_size (int, optional): Defaults to 100000. Maximum records waiting
+                to be written (more are dropped, with an error log).
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "batches": 0, "rotations": 0}
+        self._queue = queue.Queue(queue_size)
+        self._busy = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = open(path, "a", encoding="utf-8")
+        threading.Thread(target=self._work, name="AuditLog", daemon=True).start()
+
+    def record(self, operation: str, dn: str, attributes: dict, result, latency: float):
+        """Queue the record of a mutation (never blocks).
+
+        Args:
+            operation (str): Operation (``create``, ``edit``, ``delete``).
+            dn (str): Target DN.
+            attributes (dict): Changed attributes (passwords are redacted here).
+            result (any): Result of the operation (an ``"NNN: message"`` string for an error).
+            latency (float): Duration of the operation (seconds).
+        """
+        user, org = getattr(_requester, "value", None) or (None, None)
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "user": user,
+            "org": org,
+            "operation": operation,
+            "dn": dn,
+            "attributes": {k: _text(v) for k, v in redact(attributes).items()},
+            "outcome": "success",
+            "latency_ms": round(latency * 1000, 3),
+        }
+        if isinstance(result, str) and len(result.split(':')) > 1:
+            entry["outcome"] = "failure"
+            entry["code"] = int(result.split(':')[0].strip())
+            entry["error_message"] = result.split(':', 1)[1].strip()
+        try:
+            self._queue.put_nowait(entry)
+            self.stats["recorded"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+            logger.error(f"Audit queue is full: record of {operation} {dn} is lost.")
+
+    def backlog(self):
+        """Get the number of records not written yet.
+
+        Returns:
+            int: Queued and in-flight records.
+        """
+        return self._queue.qsize() + self._busy
+
+    def flush(self, timeout: float=10):
+        """Wait for the queued records to be written (on shutdown).
+
+        Args:
+            timeout (float, optional): Defaults to 10. Maximum seconds to wait.
+
+        Returns:
+            bool: True if all the records are written.
+        """
+        deadline = time.time() + timeout
+        while self.backlog() and time.time() < deadline:
+            time.sleep(0.05)
+        if self.backlog():
+            logger.error(f"{self.backlog()} audit record(s) not written before shutdown.")
+            return False
+        return True
+
+    def _rotate(self):
+        """Rotate the audit file (`path` -> `path.1` -> ... -> `path.<backups>`).
+        """
+        self._fd.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._fd = open(self.path, "a", encoding="utf-8")
+        self.stats["rotations"] += 1
+
+    def _work(self):
+        """Write the queued records, forever.
+        """
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._busy = len(batch)
+            try:
+                self._fd.write("".join(json.dumps(entry) + "\n" for entry in batch))
+                self._fd.flush()
+                # Group commit: one fsync for the whole batch
+                os.fsync(self._fd.fileno())
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                if self._fd.tell() >= self.max_bytes:
+                    self._rotate()
+            except (OSError, ValueError) as e:
+                self.stats["dropped"] += len(batch)
+                logger.error(f"Cannot write {len(batch)} audit record(s): {str(e)}")
+            self._busy = 0
+
+
+def get_audit_log():
+    """Get the audit log of the process.
+
+    Returns:
+        AuditLog: The audit log, or None if disabled (or unusable).
+    """
+    global _audit_log
+    if not config_get("audit.enabled", False):
+        return None
+    if _audit_log is None:
+        with _audit_log_lock:
+            if _audit_log is None:
+                path = config_get("audit.path", "/var/log/lumext_audit.log")
+                try:
+                    _audit_log = AuditLog(
+                        path,
+                        max_bytes=int(config_get("audit.max_bytes", 100 * 1024 * 1024)),
+                        backups=int(config_get("audit.backups", 10)),
+                        batch_size=int(config_get("audit.batch_size", 500)),
+                        queue_size=int(config_get("audit.queue_size", 100000))
+                    )
+                except OSError as e:
+                    logger.error(f"Cannot open audit log {path}: {str(e)}")
+                    return None
+    return _audit_log
+
+
+def audited(operation: str, attributes=None):
+    """Decorate a mutation method of an LDAP object to record it in the audit log.
+
+    Args:
+        operation (str): Name of the operation.
+        attributes (callable, optional): Defaults to None. Get the changed
+            attributes from the arguments of the method (object included).
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(obj, *args, **kwargs):
+            audit_log = get_audit_log()
+            if audit_log is None:
+                return method(obj, *args, **kwargs)
+            start = time.perf_counter()
+            result = "500: Exception raised."
+            try:
+                result = method(obj, *args, **kwargs)
+            finally:
+                audit_log.record(
+                    operation,
+                    obj.base,
+                    attributes(obj, *args, **kwargs) if attributes else {},
+                    result,
+                    time.perf_counter() - start
+                )
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,528 @@
+"""Load-testing tools for the LUMExt API worker.
+
+* Recording: the daemon writes the request envelopes it receives (one JSON
+  document per line, passwords and credentials redacted) to a file.
+* Replay: recorded envelopes are published to a (local) broker at a given
+  rate and concurrency; replies from the worker are timed to report latency
+  histograms and errors per route.
+* Soak: recorded envelopes are proceeded in-process by `MessageWorker` for
+  hours (against the configured, local, directory stand-in) while the RSS,
+  threads, open file descriptors and GC objects of the process are sampled;
+  the test fails if they grow beyond thresholds.
+"""
+# Standard imports
+import base64
+import gc
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import configuration_manager as cm, config_get, get_amqp_url
+
+logger = logging.getLogger(__name__)
+
+# Recorder of the running daemon (if recording is enabled)
+recorder = None
+
+REDACTED = "********"
+# Body attributes and headers never written in recordings
+SECRET_ATTRIBUTES = {"password", "passwordconfirm"}
+SECRET_HEADERS = {"authorization", "cookie", "x-vcloud-authorization"}
+# Upper bounds (ms) of the latency histogram buckets
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf")]
+# Default maximum growth of the soak test resources (RSS in MB, ratio for GC objects)
+SOAK_THRESHOLDS = {"rss": 50, "threads": 5, "fds": 10, "gc_objects": 0.2}
+
+
+def _redact_body(value):
+    """Hide the secret attributes of a JSON body, at any depth (bulk bodies are lists).
+    """
+    if isinstance(value, dict):
+        return {
+            k: (REDACTED if k.lower() in SECRET_ATTRIBUTES else _redact_body(v))
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [_redact_body(v) for v in value]
+    return value
+
+
+def redact_request(request: dict):
+    """Get a copy of a request without secrets.
+
+    Args:
+        request (dict): The request part of a vCD envelope.
+
+    Returns:
+        dict: The redacted request.
+    """
+    request = dict(request)
+    request['headers'] = {
+        k: (REDACTED if k.lower() in SECRET_HEADERS else v)
+        for k, v in request.get('headers', {}).items()
+    }
+    try:
+        body = json.loads(base64.b64decode(request.get('body') or ""))
+    except ValueError:
+        # Not base64, JSON or UTF-8 (binascii.Error, JSONDecodeError, UnicodeDecodeError): kept as is
+        return request
+    if isinstance(body, (dict, list)):
+        request['body'] = base64.b64encode(json.dumps(_redact_body(body)).encode('utf-8')).decode()
+    return request
+
+
+def route_of(request: dict):
+    """Get a route name for a request, without its variable parts.
+
+    Args:
+        request (dict): The request part of a vCD envelope.
+
+    Returns:
+        str: Route (ex: ``GET /org/{org}/lumext/user/{id}``).
+    """
+    path = request['requestUri'].split('/api/org/')[-1]
+    parts = path.split('/')
+    parts[0] = "{org}"
+    parts = parts[:3] + ["{id}" for _ in parts[3:4]]
+    return f"{request['method'].upper()} /org/" + "/".join(parts)
+
+
+class Recorder():
+    """Append request envelopes to a file.
+    """
+
+    def __init__(self, path: str):
+        """Open the recording file.
+
+        Args:
+            path (str): Path of the recording (JSON lines).
+        """
+        self.path = path
+        self._fd = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        logger.info(f"Recording request envelopes in {path}")
+
+    def record(self, request: dict, metadata: dict):
+        """Record a request envelope.
+
+        Args:
+            request (dict): The request part of the envelope.
+            metadata (dict): The metadata part of the envelope.
+        """
+        line = json.dumps({
+            "time": time.time(),
+            "request": redact_request(request),
+            "metadata": metadata,
+        })
+        with self._lock:
+            self._fd.write(line + "\n")
+            self._fd.flush()
+
+    def close(self):
+        """Close the recording file.
+        """
+        self._fd.close()
+
+
+def start_recording(path: str):
+    """Enable the recording of the incoming requests.
+
+    Args:
+        path (str): Path of the recording.
+    """
+    global recorder
+    recorder = Recorder(path)
+
+
+def load_recording(path: str, password: str):
+    """Load recorded envelopes.
+
+    Args:
+        path (str): Path of the recording.
+        password (str): Password to use in place of the redacted ones.
+
+    Returns:
+        list: Envelopes as (request, metadata) tuples.
+    """
+    envelopes = []
+    with open(path, "r", encoding="utf-8") as fd:
+        for line in fd:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            request = entry['request']
+            if password and request.get('body'):
+                body = base64.b64decode(request['body']).decode('utf-8')
+                body = body.replace(f'"{REDACTED}"', json.dumps(password))
+                request['body'] = base64.b64encode(body.encode('utf-8')).decode()
+            envelopes.append((request, entry['metadata']))
+    return envelopes
+
+
+class RouteStats():
+    """Latency histogram and errors of a route.
+    """
+
+    def __init__(self):
+        """Create empty statistics.
+        """
+        self.latencies = []
+        self.histogram = OrderedDict((b, 0) for b in BUCKETS)
+        self.errors = defaultdict(int)
+
+    def add(self, latency: float, status: int):
+        """Record a reply.
+
+        Args:
+            latency (float): Latency in seconds.
+            status (int): HTTP status code of the reply (0 for a timeout).
+        """
+        ms = latency * 1000
+        self.latencies.append(ms)
+        for bucket in BUCKETS:
+            if ms <= bucket:
+                self.histogram[bucket] += 1
+                break
+        if not 200 <= status < 400:
+            self.errors[str(status or "timeout")] += 1
+
+    def percentile(self, p: float):
+        """Get a latency percentile.
+
+        Args:
+            p (float): Percentile (0-100).
+
+        Returns:
+            float: Latency in ms.
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return round(ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)], 2)
+
+    def get(self):
+        """Get the statistics as dict for JSON representation.
+
+        Returns:
+            dict: Dict representation of statistics.
+        """
+        return {
+            "count": len(self.latencies),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": round(max(self.latencies), 2) if self.latencies else None,
+            "histogram": {
+                ("+inf" if b == float("inf") else f"<={b}ms"): c
+                for b, c in self.histogram.items()
+            },
+            "errors": dict(self.errors),
+        }
+
+
+def replay(path: str, rate: float=10, concurrency: int=4, count: int=None,
+           password: str=None, timeout: float=30):
+    """Replay recorded envelopes against a worker through the broker.
+
+    Args:
+        path (str): Path of the recording.
+        rate (float, optional): Defaults to 10. Requests published per second.
+        concurrency (int, optional): Defaults to 4. Maximum requests waiting for a reply.
+        count (int, optional): Defaults to the recording size. Number of requests
+            to send (the recording is looped over).
+        password (str, optional): Defaults to None. Password for redacted attributes.
+        timeout (float, optional): Defaults to 30. Seconds to wait for a reply.
+
+    Returns:
+        dict: Statistics per route.
+    """
+    from kombu import Connection, Exchange, Queue, Producer
+
+    envelopes = load_recording(path, password)
+    if not envelopes:
+        logger.error(f"No request found in recording {path}")
+        return {}
+    count = count or len(envelopes)
+    rmq_conf = cm().rabbitmq
+    amqp_url = get_amqp_url(rmq_conf)
+    exchange = Exchange(rmq_conf.exchange, 'direct', durable=True, no_declare=True)
+    reply_name = f"lumext-replay-{uuid.uuid4()}"
+    reply_queue = Queue(reply_name, exchange=exchange, routing_key=reply_name,
+                        exclusive=True, auto_delete=True)
+
+    stats = defaultdict(RouteStats)
+    pending = {}
+    lock = threading.Lock()
+    slots = threading.Semaphore(concurrency)
+    done = threading.Event()
+
+    def on_reply(body, message):
+        with lock:
+            sent = pending.pop(message.properties.get('correlation_id'), None)
+        if sent:
+            route, start = sent
+            stats[route].add(time.perf_counter() - start, int(body.get('statusCode', 0)))
+            slots.release()
+        message.ack()
+
+    def consume(conn):
+        with conn.Consumer(reply_queue, callbacks=[on_reply], accept=['json']):
+            while not done.is_set():
+                try:
+                    conn.drain_events(timeout=0.5)
+                except Exception:
+                    pass
+
+    with Connection(amqp_url) as pub_conn, Connection(amqp_url) as sub_conn:
+        reply_queue(sub_conn.default_channel).declare()
+        consumer = threading.Thread(target=consume, args=(sub_conn,), daemon=True)
+        consumer.start()
+        producer = Producer(pub_conn.default_channel)
+        logger.info(f"Replaying {count} request(s) at {rate}/s (concurrency: {concurrency})")
+        start = time.perf_counter()
+        for i in range(count):
+            # Keep the requested rate
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            request, metadata = envelopes[i % len(envelopes)]
+            if not slots.acquire(timeout=timeout):
+                # Sending anyway would exceed the concurrency: counted as an error
+                logger.warning("No reply received in time: request skipped")
+                stats[route_of(request)].add(timeout, 0)
+                continue
+            request = dict(request, id=str(uuid.uuid4()))
+            correlation_id = str(uuid.uuid4())
+            with lock:
+                pending[correlation_id] = (route_of(request), time.perf_counter())
+            producer.publish(
+                [request, metadata],
+                exchange=exchange,
+                routing_key=rmq_conf.routing_key,
+                correlation_id=correlation_id,
+                reply_to=reply_name,
+                headers={"replyToExchange": rmq_conf.exchange},
+                serializer='json'
+            )
+        # Wait for the last replies
+        deadline = time.perf_counter() + timeout
+        while pending and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        done.set()
+        consumer.join()
+    for route, sent_at in pending.values():
+        stats[route].add(time.perf_counter() - sent_at, 0)
+    return {route: s.get() for route, s in sorted(stats.items())}
+
+
+def print_report(report: dict):
+    """Print a replay report on the console.
+
+    Args:
+        report (dict): Statistics per route.
+    """
+    for route, s in report.items():
+        print(f"{route}\n  count={s['count']} p50={s['p50']}ms p90={s['p90']}ms "
+              f"p99={s['p99']}ms max={s['max']}ms")
+        for bucket, c in s['histogram'].items():
+            if c:
+                print(f"  {bucket:>10} {c}")
+        for status, c in s['errors'].items():
+            print(f"  error {status}: {c}")
+
+
+class _SoakParent():
+    """Stand-in for the AMQP message worker: count the replies.
+    """
+
+    def __init__(self):
+        self.replies = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def publish(self, data, properties):
+        with self._lock:
+            self.replies[str(properties.get('statusCode'))] += 1
+
+
+class _SoakMessage():
+    """Stand-in for an AMQP message.
+    """
+
+    def __init__(self):
+        self.properties = {"correlation_id": str(uuid.uuid4()), "reply_to": "lumext-soak"}
+        self.headers = {"replyToExchange": "lumext-soak"}
+        self.delivery_info = {}
+
+
+def sample_process():
+    """Sample the resources used by the process.
+
+    Returns:
+        dict: RSS (bytes), threads, open file descriptors and GC counters.
+            Values read from `/proc` are None on other systems.
+    """
+    rss = None
+    try:
+        with open("/proc/self/status", "r") as fd:
+            for line in fd:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        fds = None
+    return {
+        "time": round(time.time(), 3),
+        "rss": rss,
+        "threads": threading.active_count(),
+        "fds": fds,
+        "gc_objects": len(gc.get_objects()),
+        "gc_collections": [s["collections"] for s in gc.get_stats()],
+        "gc_garbage": len(gc.garbage),
+    }
+
+
+def _median(samples: list, key: str):
+    """Get the median of a sampled value (None if not available).
+    """
+    values = sorted(s[key] for s in samples if s[key] is not None)
+    return values[len(values) // 2] if values else None
+
+
+def check_growth(samples: list, thresholds: dict):
+    """Compare the first and last samples of a soak test.
+
+    The medians of the 3 first and 3 last samples are compared, to ignore
+    short spikes.
+
+    Args:
+        samples (list): Samples taken after the warm-up period.
+        thresholds (dict): Maximum growth (see `SOAK_THRESHOLDS`).
+
+    Returns:
+        tuple: The growth of each resource, and the list of exceeded thresholds.
+    """
+    first, last = samples[:3], samples[-3:]
+    growth = {}
+    failures = []
+    for key in ("rss", "threads", "fds", "gc_objects"):
+        before, after = _median(first, key), _median(last, key)
+        if before is None or after is None:
+            continue
+        if key == "rss":
+            growth[key] = round((after - before) / 1024 / 1024, 2)
+        elif key == "gc_objects":
+            growth[key] = round((after - before) / before, 3)
+        else:
+            growth[key] = after - before
+        if growth[key] > thresholds[key]:
+            failures.append(f"{key} grew by {growth[key]} (threshold: {thresholds[key]})")
+    return growth, failures
+
+
+def soak(path: str, duration: float=3600, rate: float=10, password: str=None,
+         sample_interval: float=30, warmup: float=300, thresholds: dict=None):
+    """Proceed recorded envelopes in-process for a long time and watch resources.
+
+    Requests go through `lumext.MessageWorker` and the scheduler like in the
+    daemon, against the configured directory (use a local stand-in). Replies
+    are counted instead of being published.
+
+    Args:
+        path (str): Path of the recording.
+        duration (float, optional): Defaults to 3600. Seconds of load.
+        rate (float, optional): Defaults to 10. Requests per second.
+        password (str, optional): Defaults to None. Password for redacted attributes.
+        sample_interval (float, optional): Defaults to 30. Seconds between two samples.
+        warmup (float, optional): Defaults to 300. Seconds of load before the baseline
+            (caches, pools and threads get their steady size).
+        thresholds (dict, optional): Defaults to `SOAK_THRESHOLDS`. Maximum growth.
+
+    Returns:
+        dict: Report with samples, growth, failures and `passed`.
+    """
+    from . import lumext
+    from .scheduler import get_scheduler
+    from .warmup import warm_up
+
+    thresholds = dict(SOAK_THRESHOLDS, **(thresholds or {}))
+    envelopes = load_recording(path, password)
+    if not envelopes:
+        logger.error(f"No request found in recording {path}")
+        return {"passed": False, "failures": ["empty recording"]}
+    # Replies are counted in-process
+    publisher_conf = config_get("reply_publisher")
+    if publisher_conf is not None:
+        publisher_conf.enabled = False
+    warm_up()
+    parent = _SoakParent()
+    samples = []
+    logger.info(f"Soak test: {duration}s at {rate}/s, baseline after {warmup}s")
+    start = time.perf_counter()
+    next_sample = start + warmup
+    sent = 0
+    while time.perf_counter() - start < duration:
+        # Keep the requested rate
+        delay = start + sent / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        request, metadata = envelopes[sent % len(envelopes)]
+        request = dict(request, id=str(uuid.uuid4()))
+        try:
+            lumext.MessageWorker(
+                message_worker=parent, data=[request, metadata], message=_SoakMessage()
+            ).start()
+        except Exception as e:
+            parent.replies["exception"] += 1
+            logger.error(f"Request {route_of(request)} raised: {str(e)}")
+        sent += 1
+        if time.perf_counter() >= next_sample:
+            samples.append(sample_process())
+            next_sample += sample_interval
+            logger.info(f"Soak sample: {samples[-1]}")
+    # Let the last requests finish
+    deadline = time.time() + 60
+    while (lumext.worker_stats["in_flight"] or get_scheduler().stats()["queued"]) and time.time() < deadline:
+        time.sleep(0.1)
+    gc.collect()
+    drained = sample_process()
+    report = {
+        "duration": round(time.perf_counter() - start, 1),
+        "requests": sent,
+        "replies": dict(parent.replies),
+        "thresholds": thresholds,
+        "samples": samples,
+        "drained": drained,
+    }
+    if len(samples) < 2:
+        report["growth"], report["failures"] = {}, ["not enough samples (increase duration)"]
+    else:
+        report["growth"], report["failures"] = check_growth(samples, thresholds)
+    report["passed"] = not report["failures"]
+    return report
+
+
+def print_soak_report(report: dict):
+    """Print a soak test report on the console.
+
+    Args:
+        report (dict): Report of `soak`.
+    """
+    print(f"{report.get('requests', 0)} request(s) in {report.get('duration', 0)}s, "
+          f"{len(report.get('samples', []))} sample(s)")
+    for status, c in sorted(report.get('replies', {}).items()):
+        print(f"  replies {status}: {c}")
+    for key, value in report.get('growth', {}).items():
+        print(f"  growth {key}: {value} (threshold: {report['thresholds'][key]})")
+    for failure in report.get('failures', []):
+        print(f"  FAILED: {failure}")
+    print("PASSED" if report.get('passed') else "FAILED")
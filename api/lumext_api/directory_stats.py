@@ -0,0 +1,208 @@
+"""Per-organization directory statistics (user counts and growth).
+
+Counters are maintained incrementally on user creation and deletion, so the
+statistics are served without listing the users. They are periodically
+reconciled with the directory by a count-only paged search (no attribute
+is read), which also catches the changes made by other processes or out of
+LUMExt.
+
+A daily point of the user count is kept for each organization
+(``stats.history_days``) to report the growth.
+
+While the directory is unavailable, the last known statistics are served;
+an organization never counted is answered with ``503``.
+"""
+# Standard imports
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# PIP imports
+import ldap
+
+# Local imports
+from .utils import config_get
+from . import ldap_manager as lm
+from . import sites
+
+logger = logging.getLogger(__name__)
+
+# Counters by organization
+_counters = {}
+_counters_lock = threading.Lock()
+_reconciler = None
+
+
+def _counter(org: str):
+    """Get the counter of an organization of the current site (lock held).
+    """
+    return _counters.setdefault(sites.qualify(org), {
+        "users": None, "created": 0, "deleted": 0, "reconciled": None, "history": OrderedDict()
+    })
+
+
+def _record_history(counter: dict):
+    """Record the daily point of the user count (lock held).
+    """
+    history = counter["history"]
+    history[time.strftime("%Y-%m-%d")] = counter["users"]
+    while len(history) > int(config_get("stats.history_days", 30)):
+        history.popitem(last=False)
+
+
+def user_created(org: str):
+    """Count a user creation.
+
+    Args:
+        org (str): Organization (parent OU).
+    """
+    with _counters_lock:
+        counter = _counter(org)
+        counter["created"] += 1
+        if counter["users"] is not None:
+            counter["users"] += 1
+            _record_history(counter)
+
+
+def user_deleted(org: str):
+    """Count a user deletion.
+
+    Args:
+        org (str): Organization (parent OU).
+    """
+    with _counters_lock:
+        counter = _counter(org)
+        counter["deleted"] += 1
+        if counter["users"] is not None:
+            counter["users"] = max(counter["users"] - 1, 0)
+            _record_history(counter)
+
+
+def reconcile(org: str):
+    """Count the users of an organization in the directory.
+
+    Args:
+        org (str): Organization (parent OU).
+
+    Raises:
+        ldap.LDAPError: The directory cannot be searched.
+
+    Returns:
+        int: The number of users.
+    """
+    try:
+        users = lm.count_entries(
+            lm.get_ou_base(org), "(objectClass=user)", int(config_get("stats.page_size", 1000))
+        )
+    except ldap.NO_SUCH_OBJECT:
+        # OU structure not created yet
+        users = 0
+    with _counters_lock:
+        counter = _counter(org)
+        if counter["users"] is not None and counter["users"] != users:
+            logger.info(f"User count of {org} reconciled: {counter['users']} -> {users}")
+        counter["users"] = users
+        counter["reconciled"] = int(time.time())
+        _record_history(counter)
+    return users
+
+
+def get_org_stats(org: str):
+    """Get the statistics of an organization.
+
+    The directory is only counted if the organization was never reconciled.
+
+    Args:
+        org (str): Organization (parent OU).
+
+    Returns:
+        dict: User count, creations and deletions, growth over the history, or
+            an error message if the organization was never counted and the
+            directory is unavailable.
+    """
+    with _counters_lock:
+        known = _counter(org)["users"] is not None
+    if not known:
+        try:
+            reconcile(org)
+        except ldap.LDAPError as e:
+            logger.error(f"Cannot count users of {org}: {str(e)}")
+            return "503: Directory unavailable, please retry."
+    with _counters_lock:
+        counter = _counter(org)
+        history = list(counter["history"].items())
+        return {
+            "org": org,
+            "users": counter["users"],
+            "created": counter["created"],
+            "deleted": counter["deleted"],
+            "reconciled": counter["reconciled"],
+            "growth": {
+                "since": history[0][0],
+                "users": counter["users"] - history[0][1],
+            },
+            "history": dict(history),
+        }
+
+
+def get_all_stats():
+    """Get the statistics of all organizations of the current site (provider view).
+
+    Returns:
+        dict: Statistics by organization (organizations which cannot be counted
+            are listed as `unavailable`), and total user count, or an error
+            message if the directory is unavailable.
+    """
+    try:
+        names = lm.list_tenant_ous(strict=True)
+    except ldap.LDAPError as e:
+        logger.error(f"Cannot list organizations: {str(e)}")
+        return "503: Directory unavailable, please retry."
+    orgs, unavailable = {}, []
+    for org in names:
+        stats = get_org_stats(org)
+        if isinstance(stats, str):
+            unavailable.append(org)
+        else:
+            orgs[org] = stats
+    if unavailable and not orgs:
+        return "503: Directory unavailable, please retry."
+    return {
+        "orgs": orgs,
+        "unavailable": unavailable,
+        "total": {"orgs": len(orgs), "users": sum(s["users"] for s in orgs.values())},
+    }
+
+
+def _reconcile_forever(interval: int):
+    """Reconcile the counters of all organizations, every `interval` seconds.
+    """
+    while True:
+        time.sleep(interval)
+        for site in sites.get_sites():
+            start = time.perf_counter()
+            try:
+                with sites.activate(site):
+                    orgs = lm.list_tenant_ous(strict=True)
+                    for org in orgs:
+                        reconcile(org)
+                logger.info(
+                    f"Statistics of {len(orgs)} organization(s) of site {site.name} reconciled "
+                    f"in {(time.perf_counter() - start) * 1000:.0f}ms."
+                )
+            except Exception as e:
+                logger.error(f"Cannot reconcile statistics of site {site.name}: {str(e)}")
+
+
+def start_reconciler():
+    """Start the periodic reconciliation of the counters (if enabled).
+    """
+    global _reconciler
+    interval = int(config_get("stats.reconcile_interval", 3600))
+    if _reconciler is not None or interval <= 0:
+        return
+    _reconciler = threading.Thread(
+        target=_reconcile_forever, args=(interval,), name="StatsReconciler", daemon=True
+    )
+    _reconciler.start()
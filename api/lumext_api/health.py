@@ -0,0 +1,120 @@
+"""Local HTTP server reporting the health of the LUMExt daemon.
+
+Components register cheap probes (callables returning a dict) that only read
+in-memory state: a probe never opens a connection to LDAP or RabbitMQ.
+
+Endpoints:
+    * ``/health``: liveness (is the daemon connected to RabbitMQ?)
+    * ``/ready``: readiness (warm-up done and all probes are healthy)
+    * ``/status``: detailed report of all probes
+"""
+# Standard imports
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import config_get
+from .warmup import READY
+
+logger = logging.getLogger(__name__)
+
+# Registered probes (name -> callable)
+_probes = {}
+_started = time.time()
+
+
+def register_probe(name: str, probe):
+    """Register a probe to include in the health reports.
+
+    Args:
+        name (str): Name of the probe in the report.
+        probe (callable): A function returning a dict. The optional ``healthy``
+            key of this dict is used to compute the global state.
+    """
+    _probes[name] = probe
+
+
+def collect():
+    """Run all the probes.
+
+    Returns:
+        dict: The detailed report.
+    """
+    report = {
+        "ready": READY.is_set(),
+        "uptime": round(time.time() - _started, 3),
+    }
+    for name, probe in list(_probes.items()):
+        try:
+            report[name] = probe()
+        except Exception as e:
+            logger.warning(f"Health probe {name} failed: {str(e)}")
+            report[name] = {"healthy": False, "error": str(e)}
+    report["healthy"] = all(
+        r.get("healthy", True) for r in report.values() if isinstance(r, dict)
+    )
+    return report
+
+
+class HealthServer(ThreadingMixIn, HTTPServer):
+    """Multi-threaded HTTP server for health probes.
+    """
+    daemon_threads = True
+
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """Answer the probes of the orchestrator.
+    """
+
+    def do_GET(self):
+        """Handle a GET request on one of the health endpoints.
+        """
+        path = self.path.split('?')[0].rstrip('/')
+        report = collect()
+        if path == "/health":
+            body = {"alive": report.get("amqp", {}).get("healthy", True)}
+            code = 200 if body["alive"] else 503
+        elif path == "/ready":
+            body = {"ready": report["ready"] and report["healthy"]}
+            code = 200 if body["ready"] else 503
+        elif path == "/status":
+            body = report
+            code = 200 if report["healthy"] else 503
+        else:
+            body = {"error_message": "Not found"}
+            code = 404
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Send access logs to the module logger.
+        """
+        logger.trivia(format % args)
+
+
+def start_health_server():
+    """Start the health server in a background thread (if enabled).
+
+    Returns:
+        HealthServer: The running server, or None if disabled.
+    """
+    if not config_get("health.enabled", False):
+        return None
+    address = config_get("health.address", "127.0.0.1")
+    port = int(config_get("health.port", 8081))
+    server = HealthServer((address, port), HealthRequestHandler)
+    threading.Thread(
+        target=server.serve_forever, name="HealthServer", daemon=True
+    ).start()
+    logger.info(f"Health server listening on http://{address}:{port}")
+    return server
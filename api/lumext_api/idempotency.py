@@ -0,0 +1,199 @@
+"""Idempotent handling of duplicated requests.
+
+A request redelivered by RabbitMQ (or sent again by vCD) has the same vCD
+request ``id``. The response of a completed request is kept for a while
+(``idempotency.ttl``) in a bounded store: a duplicate gets the same reply
+again, without any LDAP operation. A duplicate received while the original
+request is still running waits for its response.
+
+With ``idempotency.path``, completed responses are also written in a local
+SQLite database, so a duplicate is recognized by any worker process of the
+host, including after a restart.
+"""
+# Standard imports
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import config_get
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    code INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    headers TEXT
+);
+"""
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class IdempotencyStore():
+    """Bounded, time-limited store of the responses of completed requests.
+    """
+
+    def __init__(self, max_entries: int=10000, ttl: int=600, path: str=None):
+        """Create the store.
+
+        Args:
+            max_entries (int, optional): Defaults to 10000. Responses kept in memory.
+            ttl (int, optional): Defaults to 600. Seconds a response is kept.
+            path (str, optional): Defaults to None. SQLite database shared by the processes.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.stats = {"replayed": 0, "waited": 0}
+        self._responses = OrderedDict()  # key -> (expires, code, body, headers)
+        self._pending = {}  # key -> threading.Event
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = self._db()
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            if "headers" not in [row[1] for row in db.execute("PRAGMA table_info(responses)")]:
+                # Database created by a previous version
+                try:
+                    db.execute("ALTER TABLE responses ADD COLUMN headers TEXT")
+                except sqlite3.OperationalError:
+                    pass  # Added meanwhile by another process
+
+    def _db(self):
+        """Get the database connection of the running thread.
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _lookup(self, key: str):
+        """Get the response of a completed request (lock held).
+
+        Returns:
+            tuple: `(code, body, headers)`, or None if unknown or expired.
+        """
+        entry = self._responses.get(key)
+        if entry and entry[0] < time.time():
+            del self._responses[key]
+            entry = None
+        if entry is None and self.path:
+            try:
+                entry = self._db().execute(
+                    "SELECT expires, code, body, headers FROM responses WHERE key = ? AND expires >= ?",
+                    (key, time.time())
+                ).fetchone()
+                if entry:
+                    entry = entry[:3] + (json.loads(entry[3]) if entry[3] else None,)
+            except sqlite3.Error as e:
+                logger.warning(f"Cannot read idempotency store: {str(e)}")
+        return entry[1:] if entry else None
+
+    def begin(self, key: str, wait: float=30):
+        """Register the start of a request.
+
+        Args:
+            key (str): ID of the request.
+            wait (float, optional): Defaults to 30. Seconds to wait for the response
+                of a running duplicate.
+
+        Returns:
+            tuple: The `(code, body, headers)` response to replay, or None if
+                the request must be proceeded.
+        """
+        with self._lock:
+            response = self._lookup(key)
+            if response is None:
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = threading.Event()
+                    return None
+        if response is None:
+            logger.info(f"Request {key} is already running: waiting for its response.")
+            self.stats["waited"] += 1
+            pending.wait(wait)
+            with self._lock:
+                response = self._lookup(key)
+            if response is None:
+                return None
+        logger.info(f"Request {key} is a duplicate: replaying its response.")
+        self.stats["replayed"] += 1
+        return response
+
+    def complete(self, key: str, code: int, body: str, headers: dict=None):
+        """Store the response of a request.
+
+        Args:
+            key (str): ID of the request.
+            code (int): HTTP status of the response.
+            body (str): Body of the response.
+            headers (dict, optional): Defaults to None. Extra headers of the
+                response (``ETag``, ``Location``...).
+        """
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._responses[key] = (expires, code, body, headers)
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_entries:
+                self._responses.popitem(last=False)
+            pending = self._pending.pop(key, None)
+        if self.path:
+            try:
+                db = self._db()
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, expires, code, body, headers) VALUES (?, ?, ?, ?, ?)",
+                    (key, expires, code, body, json.dumps(headers) if headers else None)
+                )
+                db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            except sqlite3.Error as e:
+                logger.warning(f"Cannot write idempotency store: {str(e)}")
+        if pending:
+            pending.set()
+
+    def abort(self, key: str):
+        """Forget a running request that ended without response.
+
+        Args:
+            key (str): ID of the request.
+        """
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending:
+            pending.set()
+
+
+def get_idempotency_store():
+    """Get the idempotency store of the process.
+
+    Returns:
+        IdempotencyStore: The store, or None if disabled.
+    """
+    global _store
+    if not config_get("idempotency.enabled", True):
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = IdempotencyStore(
+                    int(config_get("idempotency.max_entries", 10000)),
+                    int(config_get("idempotency.ttl", 600)),
+                    config_get("idempotency.path")
+                )
+    return _store
@@ -0,0 +1,249 @@
+"""Asynchronous jobs for the long-running operations.
+
+Operations which can exceed the response timeout of vCD API extensions (bulk
+user creation, or any write sent with ``Prefer: respond-async``) are run as
+jobs: the request is answered at once with ``202`` and the job ID, and the
+operation runs on a small pool of job threads (``jobs.workers``), so it does
+not hold a scheduler worker.
+
+The status, progress and result of a job are queryable with
+``GET /api/org/{org}/lumext/job/{id}``. Finished jobs are kept for
+``jobs.retention`` seconds, and at most ``jobs.max_jobs`` jobs are kept.
+"""
+# Standard imports
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Local imports
+from .utils import config_get
+from . import audit
+from . import sites
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class Job():
+    """A long-running operation of an organization.
+    """
+
+    def __init__(self, org_id: str, user: str, operation: str, func, args: tuple):
+        """Create a queued job.
+
+        Args:
+            org_id (str): Organization of the job.
+            user (str): User who requested the job.
+            operation (str): Name of the operation (ex: ``bulk-create``).
+            func (callable): Operation, called with the job then `args`. It may
+                report its progress with `Job.progress`, and returns the result
+                (an ``"NNN: message"`` string for an error).
+            args (tuple): Arguments of the operation.
+        """
+        self.id = str(uuid.uuid4())
+        self.org_id = org_id
+        self.user = user
+        self.operation = operation
+        self.func = func
+        self.args = args
+        self.site = sites.current()
+        self.status = QUEUED
+        self.done = 0
+        self.total = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def progress(self, done: int, total: int=None):
+        """Report the progress of the job.
+
+        Args:
+            done (int): Number of items done.
+            total (int, optional): Defaults to None. Total number of items (if known).
+        """
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def run(self):
+        """Run the operation and keep its result.
+        """
+        self.status = RUNNING
+        self.started = time.time()
+        try:
+            with sites.activate(self.site), audit.requester(self.user, self.org_id):
+                result = self.func(self, *self.args)
+            if isinstance(result, str) and len(result.split(':')) > 1:
+                # Error message (ex: "404: Not found")
+                self.error = {
+                    "code": int(result.split(':')[0].strip()),
+                    "error_message": result.split(':', 1)[1].strip(),
+                }
+                self.status = FAILED
+            else:
+                self.result = result
+                self.status = SUCCEEDED
+        except Exception as e:
+            logger.error(f"Job {self.id} ({self.operation}) failed: {str(e)}")
+            self.error = {"code": 500, "error_message": str(e)}
+            self.status = FAILED
+        self.finished = time.time()
+        # Release the request data (passwords...)
+        self.args = ()
+        logger.info(
+            f"Job {self.id} ({self.operation}) {self.status} "
+            f"in {(self.finished - self.started) * 1000:.0f}ms."
+        )
+
+    def get(self):
+        """Get the status of the job.
+
+        Returns:
+            dict: Status, progress, and result or error once finished.
+        """
+        return {
+            "id": self.id,
+            "operation": self.operation,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total},
+            "created": int(self.created),
+            "started": int(self.started) if self.started else None,
+            "finished": int(self.finished) if self.finished else None,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager():
+    """Run jobs on a pool of threads and keep their results for a while.
+    """
+
+    def __init__(self, workers: int=2, retention: int=3600, max_jobs: int=1000):
+        """Start the job threads.
+
+        Args:
+            workers (int, optional): Defaults to 2. Jobs running concurrently.
+            retention (int, optional): Defaults to 3600. Seconds a finished job is kept.
+            max_jobs (int, optional): Defaults to 1000. Maximum jobs kept (the oldest
+                finished jobs are forgotten first).
+        """
+        self.retention = retention
+        self.max_jobs = max_jobs
+        self.stats = {"submitted": 0, "succeeded": 0, "failed": 0}
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"Job-{i}", daemon=True).start()
+
+    def submit(self, org_id: str, user: str, operation: str, func, *args):
+        """Queue a job.
+
+        Args:
+            org_id (str): Organization of the job.
+            user (str): User who requested the job.
+            operation (str): Name of the operation.
+            func (callable): Operation (see `Job`).
+            *args: Arguments of the operation.
+
+        Returns:
+            Job: The queued job.
+        """
+        job = Job(org_id, user, operation, func, args)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self.stats["submitted"] += 1
+        self._queue.put(job)
+        logger.info(f"Job {job.id} ({operation}) queued for organization {org_id}.")
+        return job
+
+    def get(self, job_id: str, org_id: str):
+        """Get a job of an organization.
+
+        Args:
+            job_id (str): ID of the job.
+            org_id (str): Organization of the requester.
+
+        Returns:
+            Job: The job, or None if unknown, expired or of another organization.
+        """
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+        if job is None or job.org_id != org_id:
+            return None
+        return job
+
+    def list(self, org_id: str):
+        """Get the jobs of an organization.
+
+        Args:
+            org_id (str): Organization of the requester.
+
+        Returns:
+            list: The jobs, oldest first.
+        """
+        with self._lock:
+            self._prune()
+            return [job for job in self._jobs.values() if job.org_id == org_id]
+
+    def backlog(self):
+        """Get the number of jobs waiting for a thread.
+
+        Returns:
+            int: Queued jobs.
+        """
+        return self._queue.qsize()
+
+    def _prune(self):
+        """Forget the expired jobs, and the oldest finished ones above the limit (lock held).
+        """
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(self._jobs) - self.max_jobs
+        for job in finished:
+            if job.finished + self.retention < now or excess > 0:
+                del self._jobs[job.id]
+                excess -= 1
+
+    def _work(self):
+        """Run the queued jobs, forever.
+        """
+        while True:
+            job = self._queue.get()
+            job.run()
+            self.stats[job.status] += 1
+
+
+def get_job_manager():
+    """Get the job manager of the process.
+
+    Returns:
+        JobManager: The manager, or None if jobs are disabled (operations are
+            then run synchronously).
+    """
+    global _manager
+    if not config_get("jobs.enabled", True):
+        return None
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = JobManager(
+                    int(config_get("jobs.workers", 2)),
+                    int(config_get("jobs.retention", 3600)),
+                    int(config_get("jobs.max_jobs", 1000))
+                )
+    return _manager
@@ -1,14 +1,58 @@
 """Manage LDAP objects
 """
 
+import base64
+import binascii
 import logging
+import threading
+import time
 import ldap
+import ldap.controls
+import ldap.dn
+import ldap.filter
 import ldap.modlist
 
-from .utils import list_get, configuration_manager as cm
+from .utils import list_get, configuration_manager as cm, config_get
+from . import tracing
+from . import password_policy
+from .snapshot_cache import get_snapshot_cache
+from . import directory_stats
+from . import audit
+from . import sites
+from . import search_index
 
 logger = logging.getLogger(__name__)
 
+# Global LDAP options are set once per process
+_options_ready = False
+# Pools of bound connections, shared by the sites using the same directory
+_pools = {}
+_pool_lock = threading.Lock()
+# OU bases of tenants known to have their full OU structure
+_known_tenants = set()
+# Latest bind measurement (exposed for monitoring)
+bind_stats = {"last_latency": None, "last_time": None, "failures": 0,
+              "last_failure": None, "last_error": None}
+# Attributes read for a user entry
+USER_ATTRIBUTES = ['displayName', 'description', 'userPrincipalName', 'sAMAccountName', 'uSNChanged']
+# Control to search the deleted objects (LDAP_SERVER_SHOW_DELETED_OID)
+SHOW_DELETED_OID = "1.2.840.113556.1.4.417"
+
+
+def parent_dn(dn: str):
+    """Get the DN of the parent of an entry.
+
+    The DN is parsed, so an escaped comma in a value (ex: ``CN=Doe\\, John``)
+    does not split its RDN.
+
+    Args:
+        dn (str): DN of the entry.
+
+    Returns:
+        str: DN of its parent.
+    """
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+
 
 class LdapObject():
     """Define a simple LDAP object.
@@ -22,7 +66,7 @@ class LdapObject():
         """
         self.base = base
         if self.base:
-            self.location = ",".join(base.split(',')[1:]) # Remove first information
+            self.location = parent_dn(base) # Remove first information
         else:
             self.location = None
 
@@ -38,9 +82,9 @@ class LdapObject():
         """Get object as dict for JSON representation.
 
         Returns:
-            dict: Dict representation of object.
+            dict: Dict representation of object (private members excluded).
         """
-        return self.__dict__
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
 
 
 class LdapUser(LdapObject):
@@ -60,84 +104,125 @@ class LdapUser(LdapObject):
         self.login = login
         self.display_name = display_name
         self.description = description
+        # Attributes of the entry as read from the directory
+        self._attrs = {}
 
+    @audit.audited("create", lambda user, parent_ou, password: {
+        "login": user.login, "display_name": user.display_name,
+        "description": user.description, "password": password,
+    })
     def s_create(self, parent_ou, password):
         """Server side creation of User instance on LDAP server.
         """
         logger.debug(f"Creating user {self.login}...")
-        self.base = f"CN={self.display_name},"
+        self.base = f"CN={ldap.dn.escape_dn_chars(self.display_name)},"
         self.base += "OU=Users," + get_ou_base(parent_ou)
         modlist = {
             "objectClass": [b'top', b'person', b'organizationalPerson', b'user'],
             "cn": [self.display_name.encode('utf-8')],
             "displayName": [self.display_name.encode('utf-8')],
             "samAccountName": [self.login.encode('utf-8')],
-            "userPrincipalName": [f"{self.login}@{cm().ldap.domain}".encode('utf-8')],
-            "userAccountControl": [f"{cm().ldap.userAccountControl}".encode('utf-8')],
+            "userPrincipalName": [f"{self.login}@{sites.ldap_conf().domain}".encode('utf-8')],
+            "userAccountControl": [f"{sites.ldap_conf().userAccountControl}".encode('utf-8')],
             "unicodePwd": [f'"{password}"'.encode('utf-16-le')],
         }
         if self.description: # not mandatory
             modlist["description"] = [self.description.encode('utf-8')]
 
-        con = get_ldap_connect()
         logger.trivia("Creation a user with following data: " + str(modlist))
         try:
-            con.add_s(self.base, ldap.modlist.addModlist(modlist))
+            ldap_call("add_s", self.base, ldap.modlist.addModlist(modlist))
             logger.info(f"User {self.login} is created.")
+        except ldap.CONSTRAINT_VIOLATION as e:
+            logger.error(f"Cannot create user {self.login}: {str(e)}")
+            if password_policy.is_password_violation(e):
+                return "400: Password does not meet the password policy of the directory."
+            return "400: User attributes are refused by the directory."
         except Exception as e:
             logger.error(f"Cannot create user {self.login}: {str(e)}")
             return "500: Server side issue on creating user."
         return get_user_in_ou(parent_ou, self.login, as_dict=True)
 
+    @audit.audited("edit", lambda user, parent_ou, new_data={}: new_data)
     def s_edit(self, parent_ou, new_data: dict={}):
         """Server side edition of user's information on LDAP (only if modified)
 
+        Changes are computed against the entry read with the user and sent in a
+        single modify request. A changed value is removed by its previous value:
+        if the entry was modified meanwhile, the whole request is refused (409).
+        A new display name also renames the entry (CN).
+
+        The edition is not atomic: the rename is done first, then the other
+        changes are applied to the renamed entry. If they fail, the entry stays
+        renamed (`base` is the new DN) and the error message says so.
+
         Args:
             new_data (dict): List of properties to change. Default is `{}`.
         """
-        modlist = []
+        wanted = {}
         if new_data.get('login'):
-            modlist.append(get_modify_item('samAccountName', self.login, new_data.get('login')))
-            modlist.append(get_modify_item('userPrincipalName',
-                f"{self.login.decode('utf-8')}@{cm().ldap.domain}".encode('utf-8'),
-                new_data.get('login') + f"@{cm().ldap.domain}"
-            ))
+            wanted['sAMAccountName'] = new_data.get('login')
+            wanted['userPrincipalName'] = new_data.get('login') + f"@{sites.ldap_conf().domain}"
         if new_data.get('description') is not None:
-            if new_data.get('description') == "":
-                # Empty description
-                modlist.append((ldap.MOD_DELETE, 'description', None))
-            else:
-                modlist.append(get_modify_item('description', self.description, new_data.get('description')))
+            wanted['description'] = new_data.get('description') # "" to empty
         if new_data.get('display_name'):
-            modlist.append(get_modify_item('displayName', self.display_name, new_data.get('display_name')))
+            wanted['displayName'] = new_data.get('display_name')
+        modlist = get_modlist(self._attrs, wanted)
         if new_data.get('password'):
             # Reset password
             password = new_data.get('password')
-            modlist.append(get_modify_item('unicodePwd',
-                None, f'"{password}"', encoding="utf-16-le"
-            ))
-        modlist = list(filter(None.__ne__, modlist)) # remove empty changes
+            modlist.append((ldap.MOD_REPLACE, 'unicodePwd', [f'"{password}"'.encode('utf-16-le')]))
+        renamed = ""
+        if 'displayName' in wanted and wanted['displayName'].encode('utf-8') != self.display_name:
+            new_rdn = f"CN={ldap.dn.escape_dn_chars(wanted['displayName'])}"
+            try:
+                ldap_call("rename_s", self.base, new_rdn)
+                logger.info(f"User {self.login} is renamed to {new_rdn}.")
+            except ldap.ALREADY_EXISTS as e:
+                logger.error(f"Cannot rename user {self.login}: {str(e)}")
+                return f"409: An entry named {wanted['displayName']} already exists."
+            except Exception as e:
+                logger.error(f"Cannot rename user {self.login}: {str(e)}")
+                return "500: Server side issue on renaming user."
+            self.base = f"{new_rdn},{self.location}"
+            renamed = f" The user is renamed to {wanted['displayName']}, but its other changes are not applied."
         logger.info(f"There is {len(modlist)} changes to make on the user object.")
         if len(modlist) > 0:
-            logger.trivia(modlist)
-            con = get_ldap_connect()
+            logger.trivia([m for m in modlist if m[1] != 'unicodePwd'])
             try:
-                con.modify_s(self.base, modlist)
+                ldap_call("modify_s", self.base, modlist)
                 logger.info(f"User {self.login} is edited.")
+            except (ldap.NO_SUCH_ATTRIBUTE, ldap.TYPE_OR_VALUE_EXISTS) as e:
+                logger.error(f"Cannot edit user {self.login}: {str(e)}")
+                return f"409: User {self.login.decode('utf-8')} was modified meanwhile, please retry.{renamed}"
+            except ldap.CONSTRAINT_VIOLATION as e:
+                logger.error(f"Cannot edit user {self.login}: {str(e)}")
+                if password_policy.is_password_violation(e):
+                    return (
+                        "400: Password does not meet the password policy of the directory "
+                        f"(history, age...).{renamed}"
+                    )
+                return f"400: User attributes are refused by the directory.{renamed}"
             except Exception as e:
                 logger.error(f"Cannot edit user {self.login}: {str(e)}")
-                return "500: Server side issue on editing user."
+                return f"500: Server side issue on editing user.{renamed}"
         else:
             logger.debug("Nothing to edit.")
-        return get_user_in_ou(parent_ou, new_data.get('login'), as_dict=True)
+        # Result from the applied changes, without reading the entry again
+        for attribute, value in wanted.items():
+            self._attrs[attribute] = [value.encode('utf-8')] if value else []
+        self.login = list_get(self._attrs.get('userPrincipalName'), 0, b"").split(b'@')[0]
+        self.display_name = list_get(self._attrs.get('displayName'), 0)
+        self.description = list_get(self._attrs.get('description'), 0)
+        return self.get()
 
+    @audit.audited("delete")
     def s_delete(self):
         """Server side deletion of User on LDAP Server
         """
         logger.debug(f"Deleting user {self.login}...")
-        con = get_ldap_connect()
         try:
-            con.delete_s(self.base)
+            ldap_call("delete_s", self.base)
             logger.info(f"User {self.login} is deleted.")
             return {"status": "success"}
         except Exception as e:
@@ -145,33 +230,255 @@ class LdapUser(LdapObject):
             return "500: Server side issue on user deletion."
 
 
-def get_ldap_connect():
-    """Initialize a LDAP session.
+class LdapConnectionPool():
+    """A bounded pool of bound LDAP connections.
 
-    Returns:
-        ldap.LDAPObject: new connection object for accessing the given LDAP server.
+    Connections are opened on demand (up to `size`) and reused by the
+    following requests instead of binding again for every operation.
     """
-    # Prepare connection settings (lazy connect)
+
+    def __init__(self, size: int, timeout: float=30, conf=None):
+        """Create the pool.
+
+        Args:
+            size (int): Maximum number of opened connections.
+            timeout (float, optional): Defaults to 30. Seconds to wait for a free
+                connection when all of them are in use (None: wait forever).
+            conf (object, optional): Defaults to the settings of the current site.
+                `ldap` settings of the directory.
+        """
+        self.size = size
+        self.timeout = timeout
+        self.conf = conf
+        self._idle = []
+        self._cond = threading.Condition()
+        self._opened = 0
+        self._waiting = 0
+
+    def acquire(self):
+        """Get a bound connection from the pool.
+
+        A caller waiting for a connection is woken up when a connection is
+        released or discarded (it then opens a new one).
+
+        Returns:
+            ldap.LDAPObject: a connection for the exclusive use of the caller.
+        """
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        with self._cond:
+            while not self._idle and self._opened >= self.size:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise ldap.TIMEOUT("No LDAP connection available in the pool.")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return get_ldap_connect(self.conf)
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, con, discard: bool=False):
+        """Give back a connection to the pool.
+
+        Args:
+            con (ldap.LDAPObject): Connection to release.
+            discard (bool, optional): Defaults to False. Close the connection
+                instead of reusing it (ex: broken connection).
+        """
+        with self._cond:
+            if discard:
+                self._opened -= 1
+            else:
+                self._idle.append(con)
+            # A free slot or connection for a waiting caller
+            self._cond.notify()
+        if discard:
+            try:
+                con.unbind_s()
+            except Exception:
+                pass
+
+    def prefill(self, count: int=None):
+        """Open and bind connections in advance.
+
+        Args:
+            count (int, optional): Defaults to the pool size. Number of connections
+                to get ready.
+
+        Returns:
+            int: Number of idle connections in the pool.
+        """
+        count = min(count or self.size, self.size)
+        opened = []
+        try:
+            while len(opened) < count:
+                opened.append(self.acquire())
+        finally:
+            for con in opened:
+                self.release(con)
+        return len(self._idle)
+
+    def close(self):
+        """Unbind all the idle connections.
+        """
+        while True:
+            with self._cond:
+                if not self._idle:
+                    return
+                con = self._idle.pop()
+            self.release(con, discard=True)
+
+    def stats(self):
+        """Get the pool usage, without touching the directory.
+
+        Returns:
+            dict: size, opened, idle and in-use connections count, and number
+                of callers waiting for a connection.
+        """
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                "size": self.size,
+                "opened": self._opened,
+                "idle": idle,
+                "in_use": max(self._opened - idle, 0),
+                "waiting": self._waiting,
+            }
+
+
+def init_ldap_options():
+    """Set global LDAP options (TLS settings, referrals...) once per process.
+    """
+    global _options_ready
+    if _options_ready:
+        return
     ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND)
     ldap.set_option(ldap.OPT_REFERRALS,0)
     ldap.protocol_version = 3
     # Add cacert file for LDAPs connections
     if "ldaps" in cm().ldap.address and cm().ldap.cacert_file:
         ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, cm().ldap.cacert_file)
+    _options_ready = True
+
+
+def get_ldap_connect(conf=None):
+    """Initialize a LDAP session.
+
+    Prefer `ldap_call` (pooled connections) for directory operations.
+
+    Args:
+        conf (object, optional): Defaults to the settings of the current site.
+            `ldap` settings of the directory.
+
+    Returns:
+        ldap.LDAPObject: new connection object for accessing the given LDAP server.
+    """
+    conf = conf or sites.ldap_conf()
+    # Prepare connection settings (lazy connect)
+    init_ldap_options()
     # Init connection
     con = ldap.initialize(
-        cm().ldap.address,
+        conf.address,
         bytes_mode=False
     )
+    if "ldaps" in conf.address and conf.cacert_file and conf.cacert_file != cm().ldap.cacert_file:
+        # CA of a site directory (the global option holds the default one)
+        con.set_option(ldap.OPT_X_TLS_CACERTFILE, conf.cacert_file)
+        con.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
     # Bind user
-    con.simple_bind_s(
-        cm().ldap.user,
-        cm().ldap.secret
-    )
+    start = time.perf_counter()
+    try:
+        with tracing.span("ldap.bind"):
+            con.simple_bind_s(
+                conf.user,
+                conf.secret
+            )
+    except Exception as e:
+        bind_stats["failures"] += 1
+        bind_stats["last_failure"] = time.time()
+        bind_stats["last_error"] = str(e)
+        raise
+    bind_stats["last_latency"] = time.perf_counter() - start
+    bind_stats["last_time"] = time.time()
+    logger.debug(f"New LDAP connection bound in {bind_stats['last_latency'] * 1000:.1f}ms.")
     return con
 
 
-def ldap_search(base, filterstr="", attributes=[], scope: int=ldap.SCOPE_SUBTREE):
+def get_ldap_pool():
+    """Get the shared pool of LDAP connections of the directory of the current site.
+
+    Returns:
+        LdapConnectionPool: the pool, created on first call.
+    """
+    site = sites.current()
+    pool = _pools.get(site.directory)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(site.directory)
+            if pool is None:
+                pool = _pools[site.directory] = LdapConnectionPool(
+                    int(config_get("ldap.pool_size", 4)),
+                    timeout=float(config_get("ldap.pool_timeout", 30)),
+                    conf=site.ldap
+                )
+    return pool
+
+
+def get_ldap_pools():
+    """Get the LDAP connection pools of the process (one per directory).
+
+    Returns:
+        list: The pools.
+    """
+    with _pool_lock:
+        return list(_pools.values())
+
+
+def ldap_call(operation: str, *args, **kwargs):
+    """Run an operation on a pooled LDAP connection.
+
+    A connection closed by the server while idle in the pool is replaced
+    by a fresh one and the operation is retried once.
+
+    Args:
+        operation (str): Name of the `ldap.LDAPObject` method to call (ex: `add_s`).
+        *args: Positional arguments for the operation.
+        **kwargs: Keyword arguments for the operation.
+
+    Returns:
+        any: The result of the operation.
+    """
+    pool = get_ldap_pool()
+    for attempt in range(2):
+        with tracing.span("ldap.acquire"):
+            con = pool.acquire()
+        try:
+            with tracing.span(f"ldap.{operation}", dn=list_get(args, 0)):
+                result = getattr(con, operation)(*args, **kwargs)
+        except ldap.SERVER_DOWN:
+            pool.release(con, discard=True)
+            if attempt:
+                raise
+            logger.warning("LDAP connection lost: retrying on a new connection.")
+            continue
+        except Exception:
+            pool.release(con)
+            raise
+        pool.release(con)
+        return result
+
+
+def ldap_search(base, filterstr="", attributes=[], scope: int=ldap.SCOPE_SUBTREE,
+                serverctrls: list=None, strict: bool=False):
     """Run a LDAP search on directory.
 
     Args:
@@ -179,6 +486,9 @@ def ldap_search(base, filterstr="", attributes=[], scope: int=ldap.SCOPE_SUBTREE
         filterstr (str): A filter to apply on search.
         attributes (list): List of attrs to retrieves.
         scope (int, optional): default to `ldap.SCOPE_SUBTREE`. Scope for the LDAP request.
+        serverctrls (list, optional): default to None. LDAP controls for the request.
+        strict (bool, optional): default to False. Raise errors instead of returning
+            an empty list.
 
     Returns:
         list: A list of results.
@@ -187,85 +497,247 @@ def ldap_search(base, filterstr="", attributes=[], scope: int=ldap.SCOPE_SUBTREE
     logger.trivia(
         f"Parameters for the search are: filterstr: {filterstr} + attributes: {attributes} + scope: {scope}"
     )
-    con = get_ldap_connect()
     try:
-        return con.search_st(
+        if serverctrls:
+            return ldap_call(
+                "search_ext_s",
+                base,
+                scope,
+                filterstr,
+                attributes,
+                serverctrls=serverctrls,
+                timeout=int(sites.ldap_conf().search_timeout)
+            )
+        return ldap_call(
+            "search_st",
             base,
             scope,
             filterstr,
             attributes,
-            timeout=int(cm().ldap.search_timeout)
+            timeout=int(sites.ldap_conf().search_timeout)
         )
-    except ldap.TIMEOUT:
+    except ldap.TIMEOUT as e:
         logger.error(f"Exception raised while making query to the LDAP server: {str(e)}")
+        if strict:
+            raise
         return []
     except Exception as e:
         logger.warning(f"Exception raised while making query to the LDAP server: {str(e)}")
+        if strict:
+            raise
         return []
 
 
+def paged_search(base: str, filterstr: str, attributes: list, page_size: int=1000):
+    """Search entries by pages (simple paged results control).
+
+    Pages are read on a single pooled connection, held until the last page,
+    so the search is not limited by the server size limit.
+
+    Args:
+        base (str): LDAP Base to run query on.
+        filterstr (str): A filter to apply on search.
+        attributes (list): Attributes to read (`['1.1']` for none).
+        page_size (int, optional): Defaults to 1000. Entries per page.
+
+    Yields:
+        list: A page of `(dn, attrs)` entries.
+    """
+    pool = get_ldap_pool()
+    con = pool.acquire()
+    discard = False
+    try:
+        control = ldap.controls.SimplePagedResultsControl(True, size=page_size, cookie='')
+        while True:
+            msgid = con.search_ext(base, ldap.SCOPE_SUBTREE, filterstr, attributes, serverctrls=[control])
+            _, results, _, controls = con.result3(msgid, timeout=int(sites.ldap_conf().search_timeout))
+            # Referrals have no DN
+            yield [(dn, attrs) for dn, attrs in results if dn]
+            cookie = next((
+                c.cookie for c in controls
+                if c.controlType == ldap.controls.SimplePagedResultsControl.controlType
+            ), None)
+            if not cookie:
+                break
+            control.cookie = cookie
+    except ldap.SERVER_DOWN:
+        discard = True
+        raise
+    finally:
+        pool.release(con, discard=discard)
+
+
+def count_entries(base: str, filterstr: str, page_size: int=1000):
+    """Count the entries matching a filter, without reading their attributes.
+
+    Args:
+        base (str): LDAP Base to run query on.
+        filterstr (str): A filter to apply on search.
+        page_size (int, optional): Defaults to 1000. Entries per page.
+
+    Returns:
+        int: Number of matching entries.
+    """
+    return sum(len(page) for page in paged_search(base, filterstr, ['1.1'], page_size))
+
+
+def list_tenant_ous(strict: bool=False):
+    """List the tenant OUs (direct children of the LDAP base).
+
+    Args:
+        strict (bool, optional): default to False. Raise errors instead of
+            returning an empty list.
+
+    Returns:
+        list: Names of the OUs (org IDs).
+    """
+    results = ldap_search(
+        sites.ldap_conf().base, "(objectClass=organizationalUnit)", ['ou', 'name'],
+        scope=ldap.SCOPE_ONELEVEL, strict=strict
+    )
+    names = [list_get(attrs.get('ou') or attrs.get('name'), 0) for _, attrs in results]
+    return [name.decode('utf-8') for name in names if name]
+
+
 def get_ou_base(ou: str):
     """Return the full base of an OU
 
     Args:
         ou (str): OU to get the full path
     """
-    return f"ou={ou},{cm().ldap.base}"
+    return f"ou={ou},{sites.ldap_conf().base}"
+
 
+def get_modlist(entry: dict, new_values: dict):
+    """Get the modlist to apply new values on an entry.
 
-def get_modify_item(attribute, old_value, new_value, encoding="utf-8"):
-    """Get modify modlist for an attribute.
+    Unchanged values are skipped. A changed value is removed by its previous
+    value (then added again), so the modification fails if the entry was
+    modified since it has been read.
 
     Args:
-        attribute (str): Name of the attribute to change.
-        old_value (str): Old value for this attribute.
-        value (str): New value for this attribute.
-        encoding (str, optional): Default to `utf-8`. Encoding to use
-            for string conversion to bytes.
-    """
-    if old_value != new_value.encode('utf-8'):
-        if attribute != 'unicodePwd': # no log for password
-            logger.debug(f"Replacing value for attribute `{attribute}` from `{old_value}` to `{new_value}`")
-        return (ldap.MOD_REPLACE, attribute, [new_value.encode(encoding)])
-    else:
-        return None
+        entry (dict): Attributes of the entry as read from the directory.
+        new_values (dict): New values (str) by attribute name. An empty string
+            removes the attribute.
+
+    Returns:
+        list: The modlist for a modify operation.
+    """
+    current = {k.lower(): v for k, v in entry.items()}
+    modlist = []
+    for attribute, value in new_values.items():
+        old_values = current.get(attribute.lower()) or []
+        new_values_bytes = [value.encode('utf-8')] if value else []
+        if old_values == new_values_bytes:
+            continue
+        logger.debug(f"Replacing value for attribute `{attribute}` from `{old_values}` to `{new_values_bytes}`")
+        if old_values:
+            modlist.append((ldap.MOD_DELETE, attribute, old_values))
+        if new_values_bytes:
+            modlist.append((ldap.MOD_ADD, attribute, new_values_bytes))
+    return modlist
+
+
+def user_from_entry(dn: str, attrs: dict):
+    """Build a LdapUser from a search result.
+
+    Args:
+        dn (str): DN of the entry.
+        attrs (dict): Attributes of the entry.
+
+    Returns:
+        LdapUser: The user.
+    """
+    u = LdapUser(
+        dn,
+        list_get(attrs.get('userPrincipalName'),0).split(b'@')[0],
+        list_get(attrs.get('displayName'),0),
+        list_get(attrs.get('description'),0)
+    )
+    u._attrs = attrs
+    return u
 
 
 def test_tenant_for_ou(parent_ou: str):
     """Test if OU already exists in LDAP directory.
 
-    If not: create it and its sub-OU.
+    If not: create it and its sub-OU. Tenants with a complete OU structure are
+    remembered so the directory is only checked once per process.
 
     Args:
         parent_ou (str): Parent OU to lookup in directory.
     """
     logger.trivia(f"Testing if OU: {parent_ou} exists.")
     base = get_ou_base(parent_ou)
+    if base in _known_tenants:
+        logger.trivia(f"OU {parent_ou} already checked.")
+        return
+    with tracing.span("test_tenant_for_ou", ou=parent_ou):
+        _test_tenant_for_ou(parent_ou, base)
+
+
+def _test_tenant_for_ou(parent_ou: str, base: str):
+    """Check (and create if missing) the OU structure of a tenant.
+
+    Args:
+        parent_ou (str): Parent OU to lookup in directory.
+        base (str): LDAP base of the parent OU.
+    """
     filterstr = "(objectClass=organizationalUnit)"
     attributes = ['cn', 'name']
+    # Fast path: a single lookup for both sub-OU
+    sub_ous = {
+        list_get(attrs.get('name'), 0) for _, attrs in ldap_search(
+            base, filterstr, attributes, scope=ldap.SCOPE_ONELEVEL
+        )
+    }
+    if {b'Users', b'Groups'} <= sub_ous:
+        logger.debug(f"OU {parent_ou} and its sub-OU already exist")
+        _known_tenants.add(base)
+        return
+    errors = []
     # Look for tenant OU
     if not ldap_search(base, filterstr, attributes, scope=ldap.SCOPE_BASE):
         logger.debug(f"OU {parent_ou} not found. Creating...")
-        create_ou(parent_ou, cm().ldap.base)
+        errors.append(create_ou(parent_ou, sites.ldap_conf().base))
     else:
         logger.debug(f"OU {parent_ou} already exists")
     # Look for Users OU in tenant OU
     filterstr = "(&(objectClass=organizationalUnit)(name=Users))"
     if not ldap_search(base, filterstr, attributes, scope=ldap.SCOPE_ONELEVEL):
         logger.debug(f"OU {parent_ou}/Users not found. Creating...")
-        create_ou("Users", base)
+        errors.append(create_ou("Users", base))
     else:
         logger.debug(f"OU {parent_ou}/Users already exists")
     # Look for Users OU in tenant OU
     filterstr = "(&(objectClass=organizationalUnit)(name=Groups))"
     if not ldap_search(base, filterstr, attributes, scope=ldap.SCOPE_ONELEVEL):
         logger.debug(f"OU {parent_ou}/Groups not found. Creating...")
-        create_ou("Groups", base)
+        errors.append(create_ou("Groups", base))
     else:
         logger.debug(f"OU {parent_ou}/Groups already exists")
+    if not any(errors):
+        _known_tenants.add(base)
     return
 
 
+def prime_tenant_cache(parent_ous: list):
+    """Check in advance the OU structure of some tenants.
+
+    Args:
+        parent_ous (list): List of tenant OU (org IDs) to check.
+
+    Returns:
+        int: Number of tenants known to have a complete OU structure.
+    """
+    for parent_ou in parent_ous:
+        try:
+            test_tenant_for_ou(parent_ou)
+        except Exception as e:
+            logger.warning(f"Cannot check OU structure of {parent_ou}: {str(e)}")
+    return len(_known_tenants)
+
+
 def create_ou(name, base):
     """Create an OU in LDAP directory.
 
@@ -280,10 +752,9 @@ def create_ou(name, base):
         "cn": [name.encode('utf-8')],
         "name": [name.encode('utf-8')],
     }
-    con = get_ldap_connect()
     logger.trivia("Creation of an OU with following data: " + str(modlist))
     try:
-        con.add_s(new_ou_base, ldap.modlist.addModlist(modlist))
+        ldap_call("add_s", new_ou_base, ldap.modlist.addModlist(modlist))
         logger.info(f"OU {name} is created.")
     except Exception as e:
         logger.error(f"Cannot create OU {name}: {str(e)}")
@@ -291,32 +762,51 @@ def create_ou(name, base):
     return
 
 
-def list_users_in_ou(parent_ou: str, as_dict=False):
+def list_users_in_ou(parent_ou: str, as_dict=False, strict: bool=False):
     """List the users from a specific OU
 
     Args:
         parent_ou (str): Parent OU to lookup in directory.
         as_dict (bool, optional): Defaults to False. Transform output to dict for JSON dumps.
+        strict (bool, optional): Defaults to False. Raise search errors instead of
+            returning an empty list (a failed search is never cached).
 
     Returns:
         list: A list of LdapUser that belongs to the current OU.
     """
     logger.trivia(f"Listing users in OU: {parent_ou}")
+    cache = get_snapshot_cache()
+    results = None
+    if cache:
+        try:
+            results = cache.get(sites.qualify(parent_ou))
+            version = cache.version(sites.qualify(parent_ou))
+        except Exception as e:
+            logger.warning(f"Snapshot cache is unavailable: {str(e)}")
+            cache = None
+    if results is None:
+        # Test if parent OU(s) are existing
+        test_tenant_for_ou(parent_ou)
+        # Listing users
+        base = get_ou_base(parent_ou)
+        filterstr = "(objectClass=user)"
+        try:
+            with tracing.span("user_search", ou=parent_ou):
+                results = ldap_search(base, filterstr, USER_ATTRIBUTES, strict=True)
+        except Exception:
+            if strict:
+                raise
+            return []
+        if cache:
+            usn = get_highest_usn(results)
+            try:
+                cache.put(sites.qualify(parent_ou), version, results, usn)
+            except Exception as e:
+                logger.warning(f"Cannot store snapshot of {parent_ou}: {str(e)}")
     users = []
-    # Test if parent OU(s) are existing
-    test_tenant_for_ou(parent_ou)
-    # Listing users
-    base = get_ou_base(parent_ou)
-    filterstr = "(objectClass=user)"
-    attributes = ['displayName', 'description', 'userPrincipalName']
-    for user in ldap_search(base, filterstr, attributes):
+    for user in results:
         # Each result tuple is of the form (dn, attrs)
-        u = LdapUser(
-            user[0],
-            list_get(user[1].get('userPrincipalName'),0).split(b'@')[0],
-            list_get(user[1].get('displayName'),0),
-            list_get(user[1].get('description'),0)
-        )
+        u = user_from_entry(*user)
         if as_dict:
             u = u.get()
         users.append(u)
@@ -325,6 +815,74 @@ def list_users_in_ou(parent_ou: str, as_dict=False):
     return users
 
 
+def get_highest_usn(entries: list):
+    """Get the highest uSNChanged of search results.
+
+    Args:
+        entries (list): The `(dn, attrs)` entries.
+
+    Returns:
+        int: The highest uSNChanged (0 if no entry).
+    """
+    return max((int(list_get(attrs.get('uSNChanged'), 0, 0)) for _, attrs in entries), default=0)
+
+
+def get_users_etag(users: list):
+    """Get the ETag of a list of users.
+
+    The ETag is made of the number of users and of the highest uSNChanged:
+    any creation, edition, deletion or move of a user changes one of them.
+
+    Args:
+        users (list): LdapUser objects (as listed by `list_users_in_ou`).
+
+    Returns:
+        str: The ETag.
+    """
+    return f'"{len(users)}-{get_highest_usn([(u.base, u._attrs) for u in users])}"'
+
+
+def get_ou_etag(parent_ou: str):
+    """Get the ETag of the users of an OU without listing them.
+
+    Only the marker of the valid snapshot of the OU is used: without one, the
+    ETag is computed from the listing (`get_users_etag`), so the directory
+    is not searched twice.
+
+    Args:
+        parent_ou (str): Parent OU to lookup in directory.
+
+    Returns:
+        str: The ETag (same value as `get_users_etag` for the listing), or
+            None without a valid snapshot.
+    """
+    cache = get_snapshot_cache()
+    if not cache:
+        return None
+    try:
+        marker = cache.marker(sites.qualify(parent_ou))
+    except Exception as e:
+        logger.warning(f"Snapshot cache is unavailable: {str(e)}")
+        return None
+    return f'"{marker[0]}-{marker[1]}"' if marker else None
+
+
+def invalidate_snapshot(parent_ou: str, result):
+    """Invalidate the cached listing of an OU after a successful write.
+
+    Args:
+        parent_ou (str): Written OU.
+        result (any): Result of the write (an error message is a `str`).
+    """
+    cache = get_snapshot_cache()
+    if not cache or isinstance(result, str):
+        return
+    try:
+        cache.invalidate(sites.qualify(parent_ou))
+    except Exception as e:
+        logger.error(f"Cannot invalidate snapshot of {parent_ou}: {str(e)}")
+
+
 def get_user_in_ou(parent_ou: str, login: str, as_dict=False):
     """Get a specific user from a specific OU
 
@@ -337,8 +895,17 @@ def get_user_in_ou(parent_ou: str, login: str, as_dict=False):
         dict: A LdapUser that belongs to the current OU.
     """
     logger.trivia(f"Searching user with login {login} in OU: {parent_ou}")
-    for user in list_users_in_ou(parent_ou):
-        logger.trivia(f"Found a user with login {user.login.decode()}, comparing to the input...")
+    # Test if parent OU(s) are existing
+    test_tenant_for_ou(parent_ou)
+    escaped = ldap.filter.escape_filter_chars(login)
+    filterstr = (
+        f"(&(objectClass=user)(|(sAMAccountName={escaped})"
+        f"(userPrincipalName={escaped}@{ldap.filter.escape_filter_chars(sites.ldap_conf().domain)})))"
+    )
+    with tracing.span("user_search", ou=parent_ou, login=login):
+        results = ldap_search(get_ou_base(parent_ou), filterstr, USER_ATTRIBUTES)
+    for dn, attrs in results:
+        user = user_from_entry(dn, attrs)
         if user.login.decode() == login:
             logger.info(f"Found user {login} in OU {parent_ou}.")
             if as_dict:
@@ -348,6 +915,99 @@ def get_user_in_ou(parent_ou: str, login: str, as_dict=False):
     return None
 
 
+def encode_sync_token(usn: int, server: str):
+    """Build an opaque synchronization token.
+
+    USNs are local to a domain controller: the token records the server
+    (`dsServiceName`) it comes from.
+
+    Args:
+        usn (int): Highest committed USN of the server.
+        server (str): dsServiceName of the server.
+
+    Returns:
+        str: The token.
+    """
+    return base64.urlsafe_b64encode(f"{usn}|{server}".encode('utf-8')).decode().rstrip("=")
+
+
+def decode_sync_token(token: str):
+    """Read a synchronization token.
+
+    Args:
+        token (str): Token built by `encode_sync_token`.
+
+    Returns:
+        tuple: `(usn, server)`.
+
+    Raises:
+        ValueError: If the token is invalid.
+    """
+    try:
+        usn, server = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode('utf-8').split('|', 1)
+        return int(usn), server
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid synchronization token: {token}")
+
+
+def list_user_changes(parent_ou: str, since: str=None):
+    """List the users added, modified or deleted in an OU since a token.
+
+    Changes are found by uSNChanged: modified (or added) users are searched
+    in the OU, deleted users in the Deleted Objects container (by their last
+    known parent). Without token, or with a token of another domain controller,
+    all the users are returned (`full` is then True).
+
+    Args:
+        parent_ou (str): Parent OU to lookup in directory.
+        since (str, optional): Defaults to None. Token of the previous synchronization.
+
+    Returns:
+        dict: The `changed` users, the `deleted` ones, the new `token` and `full`.
+    """
+    usn, server = decode_sync_token(since) if since else (0, None)
+    # Read the new token first: changes made meanwhile will be returned again
+    root_dse = ldap_search(
+        "", "(objectClass=*)", ['highestCommittedUSN', 'dsServiceName'], scope=ldap.SCOPE_BASE, strict=True
+    )
+    attrs = list_get(root_dse, 0, (None, {}))[1]
+    highest = int(list_get(attrs.get('highestCommittedUSN'), 0, b"0"))
+    current_server = list_get(attrs.get('dsServiceName'), 0, b"").decode('utf-8')
+    full = usn == 0 or server != current_server
+    if full and since:
+        logger.info(f"Token of another server ({server}): full synchronization of {parent_ou}.")
+    # Test if parent OU(s) are existing
+    test_tenant_for_ou(parent_ou)
+    filterstr = "(objectClass=user)" if full else f"(&(objectClass=user)(uSNChanged>={usn + 1}))"
+    with tracing.span("user_changes", ou=parent_ou, since=usn):
+        changed = ldap_search(get_ou_base(parent_ou), filterstr, USER_ATTRIBUTES, strict=True)
+    deleted = []
+    if not full:
+        location = ldap.filter.escape_filter_chars("OU=Users," + get_ou_base(parent_ou))
+        with tracing.span("user_deletions", ou=parent_ou, since=usn):
+            tombstones = ldap_search(
+                f"CN=Deleted Objects,{password_policy.get_domain_dn()}",
+                f"(&(objectClass=user)(isDeleted=TRUE)(uSNChanged>={usn + 1})(lastKnownParent={location}))",
+                ['sAMAccountName', 'userPrincipalName'],
+                scope=ldap.SCOPE_ONELEVEL,
+                serverctrls=[ldap.controls.LDAPControl(SHOW_DELETED_OID, True, None)],
+                strict=True
+            )
+        for _, attrs in tombstones:
+            login = list_get(attrs.get('userPrincipalName'), 0, b"").split(b'@')[0]
+            deleted.append({"login": login or list_get(attrs.get('sAMAccountName'), 0)})
+    logger.info(
+        f"{len(changed)} changed and {len(deleted)} deleted user(s) in OU {parent_ou} "
+        f"since USN {usn}."
+    )
+    return {
+        "changed": [user_from_entry(*entry).get() for entry in changed],
+        "deleted": deleted,
+        "token": encode_sync_token(highest, current_server),
+        "full": full,
+    }
+
+
 def add_user_in_ou(parent_ou: str, data: dict):
     """Add a new user in OU
 
@@ -359,17 +1019,53 @@ def add_user_in_ou(parent_ou: str, data: dict):
     for attr in ["login", "password", "display_name"]:
         if not data.get(attr):
             return f"400: Missing mandatory atttribute {attr} for user creation."
-    if get_user_in_ou(parent_ou, data['login']):
-        return f"400: User {data['login']} already exists."
     if data.get('password') != data.get('passwordConfirm'):
         return f"400: password and passwordConfirm mismatch."
+    error = password_policy.validate_password(
+        data['password'], login=data['login'], display_name=data['display_name']
+    )
+    if error:
+        return error
+    if get_user_in_ou(parent_ou, data['login']):
+        return f"400: User {data['login']} already exists."
     u = LdapUser(
         None, # empty base
         login = data.get('login'),
         display_name = data.get('display_name'),
         description = data.get('description')
     )
-    return u.s_create(parent_ou, data.get('password'))
+    result = u.s_create(parent_ou, data.get('password'))
+    invalidate_snapshot(parent_ou, result)
+    search_index.user_written(parent_ou, result)
+    if not isinstance(result, str):
+        directory_stats.user_created(parent_ou)
+    return result
+
+
+def add_users_in_ou(parent_ou: str, users: list, progress=None):
+    """Add new users in an OU (bulk creation).
+
+    Args:
+        parent_ou (str): Parent OU where to create users.
+        users (list): Data for each new user (see `add_user_in_ou`).
+        progress (callable, optional): Defaults to None. Called with the number
+            of users done and the total after each user.
+
+    Returns:
+        dict: The created users, and the errors (with the login).
+    """
+    created, errors = [], []
+    for i, data in enumerate(users):
+        if not isinstance(data, dict):
+            data = {}
+        result = add_user_in_ou(parent_ou, data)
+        if isinstance(result, str):
+            errors.append({"login": data.get('login'), "error_message": result.split(':', 1)[-1].strip()})
+        else:
+            created.append(result)
+        if progress:
+            progress(i + 1, len(users))
+    return {"created": created, "errors": errors}
 
 
 def edit_user_in_ou(parent_ou: str, login: str, new_data: dict):
@@ -387,7 +1083,22 @@ def edit_user_in_ou(parent_ou: str, login: str, new_data: dict):
     if not u:
         # Invalid user
         return None
-    return u.s_edit(parent_ou, new_data)
+    if new_data.get('password'):
+        error = password_policy.validate_password(
+            new_data['password'],
+            login=new_data.get('login') or u.login.decode('utf-8'),
+            display_name=new_data.get('display_name') or (u.display_name or b"").decode('utf-8'),
+            user_dn=u.base
+        )
+        if error:
+            return error
+    previous_dn = u.base
+    result = u.s_edit(parent_ou, new_data)
+    # A failed edition may have renamed the entry (see `LdapUser.s_edit`)
+    written = u.get() if isinstance(result, str) and u.base != previous_dn else result
+    invalidate_snapshot(parent_ou, written)
+    search_index.user_written(parent_ou, written, previous_dn)
+    return result
 
 
 def del_user_in_ou(parent_ou: str, login: str):
@@ -404,4 +1115,9 @@ def del_user_in_ou(parent_ou: str, login: str):
     if not u:
         # Invalid user
         return None
-    return u.s_delete()
\ No newline at end of file
+    result = u.s_delete()
+    invalidate_snapshot(parent_ou, result)
+    search_index.user_deleted(u.base, result)
+    if not isinstance(result, str):
+        directory_stats.user_deleted(parent_ou)
+    return result
\ No newline at end of file
@@ -6,18 +6,35 @@ handle "single message per thread" incoming from vCD9.X.
 # Standard imports
 import base64
 import logging
-from threading import Thread
+import time
+from threading import Thread, Lock
+from urllib.parse import parse_qs
 import binascii
 
 # PIP imports
 import simplejson as json
 
 # Local imports
-from .utils import list_get, configuration_manager as cm
+from .utils import list_get, configuration_manager as cm, config_get
 from . import ldap_manager as lm
+from . import directory_stats
+from .warmup import touch_tenant
+from .scheduler import READ, WRITE, get_scheduler
+from .idempotency import get_idempotency_store
+from .reply_publisher import get_reply_publisher, publish_direct
+from .jobs import get_job_manager
+from . import search_index
+from . import benchmark
+from . import tracing
+from . import audit
+from . import sites
 
 logger = logging.getLogger(__name__)
 
+# Activity of the workers (exposed for monitoring)
+worker_stats = {"in_flight": 0, "peak": 0, "completed": 0}
+_stats_lock = Lock()
+
 
 class MessageWorker(Thread):
     """Thread based Worker to proceed messages from RabbitMQ.
@@ -37,9 +54,15 @@ class MessageWorker(Thread):
             metadata (str):  message metadata as string.
         """
         Thread.__init__(self)
+        parse_start = time.time()
+        self.trace = tracing.start_trace(message.properties.get('correlation_id'))
         self.parent_worker = message_worker
+        # Site of the broker the message comes from (set by `__main__.consume`)
+        self.site = getattr(message_worker, "site", None)
         self.request = data[0]
         self.metadata = data[1]
+        if benchmark.recorder:
+            benchmark.recorder.record(self.request, self.metadata)
         self.uri = self.request['requestUri'].split('/api/org/')[1]
         try:
             if not self.uri.split('/')[1] == "lumext":
@@ -50,7 +73,10 @@ class MessageWorker(Thread):
         except IndexError:
             self.proceed_response(f"Invalid URI for request: {self.uri}", 400)
         self.method = self.request['method'].upper()
+        # Reads are scheduled before the (slower) directory writes
+        self.lane = READ if self.method in ("GET", "HEAD") else WRITE
         self.query_str = self.request.get('queryString')
+        self.query = parse_qs(self.query_str or "", keep_blank_values=True)
         self.user = self.metadata['user'].split("urn:vcloud:user:")[1]
         self.rights = self.metadata['rights']
         self.response_properties = {
@@ -72,6 +98,10 @@ class MessageWorker(Thread):
                 logger.warning(f"Invalid JSON content for request body: {str(data)}")
             self.body = {}
         self.object_type = None
+        # Set while the response must be kept for duplicates
+        self.idempotency_key = None
+        tracing.record_span(self.trace, "parse", parse_start)
+        self.queued_at = time.time()
 
     def proceed_message(self):
         """Handle all messages received on the RabbitMQ Exchange.
@@ -81,7 +111,14 @@ class MessageWorker(Thread):
         if not self.object_type:
             self.proceed_response("No object type specified.", 404)
         if self.object_type == "user":
+            touch_tenant(self.org_id)
             self.proceed_user_message()
+        elif self.object_type == "stats":
+            self.proceed_stats_message()
+        elif self.object_type == "job":
+            self.proceed_job_message()
+        elif self.object_type == "search":
+            self.proceed_search_message()
         # elif self.object_type == "group":
         #     self.proceed_group_message()
         else:
@@ -94,21 +131,74 @@ class MessageWorker(Thread):
         """
         login = list_get(self.uri.split('/'), 3)
         code = 200
+        # Long-running writes are answered at once and run as jobs
+        jobs = get_job_manager() if self.method in ("POST", "PUT", "DELETE") else None
+        run_async = bool(jobs) and (
+            isinstance(self.body, list) or "respond-async" in (self.get_header("Prefer") or "")
+        )
         if self.method == "GET" and login:
             logger.debug(f"Proceeding request message to get a sepcific user: {login}")
-            r = lm.get_user_in_ou(self.org_id, login, as_dict=True)
-            if not r:
+            u = lm.get_user_in_ou(self.org_id, login)
+            if not u:
                 r = "404: Not found"
+            else:
+                usn = list_get(u._attrs.get('uSNChanged'), 0, b"0").decode('utf-8')
+                if self.set_etag(f'"{usn}"'):
+                    return self.proceed_response("", 304)
+                r = u.get()
+        elif self.method == "GET" and "since" in self.query:
+            logger.debug(f"Proceeding request message to list users changes.")
+            try:
+                r = lm.list_user_changes(self.org_id, list_get(self.query["since"], 0))
+            except ValueError as e:
+                r = f"400: {str(e)}"
+            except Exception as e:
+                logger.error(f"Cannot list users changes: {str(e)}")
+                r = "503: Directory unavailable, please retry."
         elif self.method == "GET":
             logger.debug(f"Proceeding request message to list users.")
-            r = lm.list_users_in_ou(self.org_id, as_dict=True)
+            # Compare the marker of a valid snapshot first (not read from the directory)
+            etag = lm.get_ou_etag(self.org_id) if self.get_header("If-None-Match") else None
+            if etag and self.set_etag(etag):
+                return self.proceed_response("", 304)
+            try:
+                users = lm.list_users_in_ou(self.org_id, strict=True)
+            except Exception as e:
+                logger.error(f"Cannot list users: {str(e)}")
+                return self.proceed_response("503: Directory unavailable, please retry.")
+            # ETag of the listing itself: a failed search cannot match a client copy
+            if self.set_etag(lm.get_users_etag(users)):
+                return self.proceed_response("", 304)
+            r = [u.get() for u in users]
+        elif self.method == "POST" and isinstance(self.body, list):
+            logger.debug(f"Proceeding request message to create {len(self.body)} users.")
+            if run_async:
+                return self.proceed_job(
+                    "bulk-create", lambda job, org, users: lm.add_users_in_ou(org, users, job.progress),
+                    self.org_id, self.body
+                )
+            r = lm.add_users_in_ou(self.org_id, self.body)
         elif self.method == "POST":
             logger.debug(f"Proceeding request message to create a user.")
+            if run_async:
+                return self.proceed_job(
+                    "create", lambda job, org, data: lm.add_user_in_ou(org, data), self.org_id, self.body
+                )
             r = lm.add_user_in_ou(self.org_id, self.body)
         elif self.method == "PUT" and login:
+            if run_async:
+                return self.proceed_job(
+                    "edit", lambda job, org, login, data: lm.edit_user_in_ou(org, login, data),
+                    self.org_id, login, self.body
+                )
             r = lm.edit_user_in_ou(self.org_id, login, self.body)
         elif self.method == "DELETE" and login:
             logger.debug(f"Proceeding request message to delete a sepcific user: {login}")
+            if run_async:
+                return self.proceed_job(
+                    "delete", lambda job, org, login: lm.del_user_in_ou(org, login) or "404: Not found",
+                    self.org_id, login
+                )
             r = lm.del_user_in_ou(self.org_id, login)
             if not r:
                 r = "404: Not found"
@@ -117,15 +207,174 @@ class MessageWorker(Thread):
             r = "405: Method Not Allowed"
         self.proceed_response(r, code)
 
+    def get_header(self, name: str):
+        """Get a header of the request (case insensitive).
+
+        Args:
+            name (str): Name of the header.
+
+        Returns:
+            str: The value, or None if missing.
+        """
+        for key, value in (self.request.get('headers') or {}).items():
+            if key.lower() == name.lower():
+                return value
+        return None
+
+    def set_etag(self, etag: str):
+        """Set the ETag of the response, and compare it to `If-None-Match`.
+
+        Args:
+            etag (str): The current ETag of the requested resource.
+
+        Returns:
+            bool: True if the client copy is up to date (304 can be sent).
+        """
+        self.response_properties['headers'] = {"ETag": etag}
+        if_none_match = self.get_header("If-None-Match")
+        if not if_none_match:
+            return False
+        # Weak comparison (RFC 7232)
+        tags = [t.strip().replace('W/', '', 1) for t in if_none_match.split(',')]
+        return "*" in tags or etag.replace('W/', '', 1) in tags
+
+    def proceed_stats_message(self):
+        """Handle message received about directory statistics
+
+        `?scope=all` returns the statistics of all organizations, for the
+        users of the provider organization (`stats.provider_org`) only.
+        """
+        if self.method != "GET":
+            return self.proceed_response("405: Method Not Allowed")
+        if list_get(self.query.get("scope"), 0) == "all":
+            if not self.is_provider():
+                return self.proceed_response("403: Statistics of all organizations are reserved to the provider.")
+            logger.debug(f"Proceeding request message to get statistics of all organizations.")
+            r = directory_stats.get_all_stats()
+        else:
+            logger.debug(f"Proceeding request message to get statistics of organization {self.org_id}.")
+            r = directory_stats.get_org_stats(self.org_id)
+        self.proceed_response(r)
+
+    def is_provider(self):
+        """Is the request sent by a user of the provider organization?
+
+        Returns:
+            bool: True if the organization of the user is `stats.provider_org`.
+        """
+        org = self.metadata.get('org', "").split("urn:vcloud:org:")[-1]
+        return bool(org) and org == config_get("stats.provider_org")
+
+    def proceed_search_message(self):
+        """Handle message received about user search (all organizations)
+
+        `?q=` is searched in the login, display name and description of the
+        users (`mode=prefix`, `substring` or `auto`), for the users of the
+        provider organization only.
+        """
+        index = search_index.get_index()
+        if self.method != "GET":
+            return self.proceed_response("405: Method Not Allowed")
+        if not self.is_provider():
+            return self.proceed_response("403: Search of all organizations is reserved to the provider.")
+        if index is None:
+            return self.proceed_response("404: Search is disabled.")
+        query = list_get(self.query.get("q"), 0, "").strip()
+        mode = list_get(self.query.get("mode"), 0, "auto")
+        if not query:
+            return self.proceed_response("400: Missing search text (q).")
+        if mode not in ("auto", "prefix", "substring"):
+            return self.proceed_response(f"400: Invalid search mode: {mode}")
+        try:
+            limit = min(int(list_get(self.query.get("limit"), 0, 50)), int(config_get("search.max_results", 500)))
+        except ValueError:
+            return self.proceed_response("400: Invalid limit.")
+        if limit < 1:
+            return self.proceed_response("400: Invalid limit.")
+        logger.debug(f"Proceeding request message to search users: {query}")
+        start = time.perf_counter()
+        results = index.search(query, sites.current().name, limit, mode)
+        self.proceed_response({
+            "query": query,
+            "complete": index.ready,
+            "took_ms": round((time.perf_counter() - start) * 1000, 3),
+            "results": results,
+        })
+
+    def proceed_job(self, operation: str, func, *args):
+        """Run an operation as a job, and answer `202 Accepted` at once.
+
+        Args:
+            operation (str): Name of the operation.
+            func (callable): Operation (see `jobs.Job`).
+            *args: Arguments of the operation.
+        """
+        job = get_job_manager().submit(self.org_id, self.user, operation, func, *args)
+        self.response_properties['headers'] = {"Location": f"/api/org/{self.org_id}/lumext/job/{job.id}"}
+        self.proceed_response(job.get(), 202)
+
+    def proceed_job_message(self):
+        """Handle message received about job request
+        """
+        job_id = list_get(self.uri.split('/'), 3)
+        jobs = get_job_manager()
+        if self.method != "GET":
+            return self.proceed_response("405: Method Not Allowed")
+        if jobs is None:
+            return self.proceed_response("404: Jobs are disabled.")
+        if job_id:
+            logger.debug(f"Proceeding request message to get job {job_id}.")
+            job = jobs.get(job_id, self.org_id)
+            r = job.get() if job else "404: Not found"
+        else:
+            logger.debug(f"Proceeding request message to list jobs of organization {self.org_id}.")
+            r = [job.get() for job in jobs.list(self.org_id)]
+        self.proceed_response(r)
+
     # def proceed_user_message(self):
     #     """Handle message received about group request
     #     """
     #     #TODO
 
+    def start(self):
+        """Queue the request in the scheduler instead of running a new thread.
+
+        The scheduler runs the request (through `run`) in its worker pool, fairly
+        between organizations.
+        """
+        self.queued_at = time.time()
+        get_scheduler().submit(self)
+
     def run(self):
         """Redirect messages to `proceed_message`.
         """
-        self.proceed_message()
+        with _stats_lock:
+            worker_stats["in_flight"] += 1
+            worker_stats["peak"] = max(worker_stats["peak"], worker_stats["in_flight"])
+        tracing.record_span(self.trace, "queue", self.queued_at)
+        store = get_idempotency_store()
+        key = self.response_properties['id'] or self.response_properties['correlation_id']
+        try:
+            with tracing.activate(self.trace), sites.activate(self.site), \
+                    audit.requester(self.user, self.org_id):
+                response = None
+                if store and key:
+                    response = store.begin(key, float(config_get("idempotency.wait", 30)))
+                if response:
+                    # Duplicate of a completed request: same reply, no LDAP operation
+                    code, body, headers = response
+                    if headers:
+                        self.response_properties['headers'] = headers
+                    self.publish_response(code, body)
+                else:
+                    self.idempotency_key = key
+                    self.proceed_message()
+        finally:
+            if store and self.idempotency_key:
+                store.abort(self.idempotency_key)
+            with _stats_lock:
+                worker_stats["in_flight"] -= 1
+                worker_stats["completed"] += 1
 
     def proceed_response(self, body, code: int=200):
         """Respond to the initial request
@@ -140,16 +389,42 @@ class MessageWorker(Thread):
             code = 500
             body = "Server error in response parsing."
         
-        # Send response
-        self.response_properties['statusCode'] = code
         if code >= 400: # convert str to dict
             logger.error(body)
             body = { "error_message": body }
+        # No body for "304: Not Modified"
+        body = json.dumps(body) if code != 304 else ""
+        # Keep the response for duplicates (not the transient errors)
+        store = get_idempotency_store()
+        if store and self.idempotency_key and code != 429 and code < 500:
+            store.complete(self.idempotency_key, code, body, self.response_properties.get('headers'))
+            self.idempotency_key = None
+        self.publish_response(code, body)
+
+    def publish_response(self, code: int, body: str):
+        """Send the response to the initial request
+
+        Args:
+            code (int): HTTP status of the response.
+            body (str): JSON body of the response.
+        """
+        self.response_properties['statusCode'] = code
         logger.info(f"Sending response to the request: {self.method} {self.uri}")
-        self.parent_worker.publish(
-            json.dumps(body),
-            self.response_properties
-        )
+        # Queued to the reply publisher (if enabled) without waiting
+        publisher = get_reply_publisher(self.site)
+        with tracing.span("publish", status=code):
+            if publisher is None and self.response_properties.get('headers') \
+                    and hasattr(self.parent_worker, "connection"):
+                # The message worker would drop the extra headers
+                publish_direct(
+                    self.parent_worker.connection, body, self.response_properties,
+                    getattr(self.parent_worker, "no_declare", True)
+                )
+            else:
+                (publisher or self.parent_worker).publish(
+                    body,
+                    self.response_properties
+                )
 
 
 def init():
@@ -0,0 +1,360 @@
+"""Local validation of passwords against the directory password policy.
+
+The domain password policy (``minPwdLength``, ``pwdProperties``,
+``pwdHistoryLength``) and the fine-grained password policies (PSO) are read
+once and cached, so an invalid password is refused with a precise message
+before any write on the directory. The PSO of an existing user is the one
+resolved by the directory (``msDS-ResultantPSO``, a single base search).
+
+Password history cannot be checked locally (hashes are not readable): a
+password refused by the server for this reason is reported as a constraint
+violation by the write operation itself.
+
+When the PSOs cannot be read (they are only readable with enough rights),
+passwords are validated against the domain policy alone. When no policy can
+be read, the directory decides alone.
+"""
+# Standard imports
+import logging
+import re
+import threading
+import time
+
+# PIP imports
+import ldap
+
+# Local imports
+from .utils import list_get, config_get
+from . import ldap_manager as lm
+from . import sites
+
+logger = logging.getLogger(__name__)
+
+# pwdProperties flag for password complexity
+DOMAIN_PASSWORD_COMPLEX = 0x1
+# Delimiters used by AD to split the display name in tokens
+NAME_DELIMITERS = re.compile(r"[,.\-_#\t ]+")
+# Error of AD refusing a password (diagnostic message of a constraint violation)
+PASSWORD_RESTRICTION_ERROR = "0000052D"
+# Attributes of a PSO
+PSO_ATTRIBUTES = ['cn', 'msDS-MinimumPasswordLength', 'msDS-PasswordComplexityEnabled',
+                  'msDS-PasswordHistoryLength', 'msDS-PasswordSettingsPrecedence', 'msDS-PSOAppliesTo']
+
+# Policies by domain DN (sites may use different directories)
+_cache = {}
+# PSO read on their own, by DN (PSO container not readable)
+_psos = {}
+_cache_lock = threading.Lock()
+
+
+class PasswordPolicy():
+    """Define a password policy (domain one or PSO).
+    """
+
+    def __init__(self, name: str, min_length: int=0, complexity: bool=False,
+                 history: int=0, precedence: int=None, applies_to: list=[]):
+        """Create a password policy.
+
+        Args:
+            name (str): Name of the policy.
+            min_length (int, optional): Defaults to 0. Minimum password length.
+            complexity (bool, optional): Defaults to False. Are complex passwords required?
+            history (int, optional): Defaults to 0. Number of remembered passwords.
+            precedence (int, optional): Defaults to None. Precedence of a PSO (lowest wins).
+            applies_to (list, optional): Defaults to []. DNs the PSO applies to.
+        """
+        self.name = name
+        self.min_length = min_length
+        self.complexity = complexity
+        self.history = history
+        self.precedence = precedence
+        self.applies_to = [dn.lower() for dn in applies_to]
+
+    def __repr__(self):
+        """Represent the PasswordPolicy object instance
+
+        Returns:
+            dict: Representation of object.
+        """
+        return f"{type(self)}({self.__dict__})"
+
+    def validate(self, password: str, login: str=None, display_name: str=None):
+        """Check a password against the policy.
+
+        Args:
+            password (str): Password to check.
+            login (str, optional): Defaults to None. sAMAccountName of the user.
+            display_name (str, optional): Defaults to None. Display name of the user.
+
+        Returns:
+            str: An error message ("400: ...") or None if the password is valid.
+        """
+        if len(password) < self.min_length:
+            return f"400: Password must contain at least {self.min_length} characters."
+        if not self.complexity:
+            return None
+        lowered = password.lower()
+        if login and len(login) >= 3 and login.lower() in lowered:
+            return "400: Password must not contain the user login."
+        for token in NAME_DELIMITERS.split(display_name or ""):
+            if len(token) >= 3 and token.lower() in lowered:
+                return "400: Password must not contain parts of the user display name."
+        categories = [
+            any(c.isupper() for c in password),
+            any(c.islower() for c in password),
+            any(c.isdigit() for c in password),
+            any(not c.isalnum() for c in password),
+            any(c.isalpha() and not c.isupper() and not c.islower() for c in password),
+        ]
+        if sum(categories) < 3:
+            return (
+                "400: Password must contain characters from three of the following "
+                "categories: uppercase, lowercase, digits, special characters."
+            )
+        return None
+
+
+def get_domain_dn():
+    """Get the DN of the domain (naming context) holding the password policy.
+
+    Returns:
+        str: Configured `ldap.domain_dn`, or the DC components of `ldap.base`.
+    """
+    conf = sites.ldap_conf()
+    domain_dn = getattr(conf, "domain_dn", None)
+    if domain_dn:
+        return domain_dn
+    return ",".join(
+        p.strip() for p in conf.base.split(',') if p.strip().lower().startswith("dc=")
+    )
+
+
+def _int(attrs: dict, name: str, default: int=0):
+    """Read an integer attribute from a search result.
+    """
+    value = list_get(attrs.get(name), 0)
+    return int(value) if value is not None else default
+
+
+def is_password_violation(error: ldap.LDAPError):
+    """Tell whether a constraint violation is a password refused by the directory.
+
+    Args:
+        error (ldap.LDAPError): Error raised by a write.
+
+    Returns:
+        bool: True if the diagnostic message is about the password.
+    """
+    info = list_get(error.args, 0, {})
+    info = info.get('info', "") if isinstance(info, dict) else str(info)
+    if isinstance(info, bytes):
+        info = info.decode('utf-8', 'replace')
+    return PASSWORD_RESTRICTION_ERROR in info.upper() or "password" in info.lower()
+
+
+def load_domain_policy():
+    """Read the domain password policy from the directory.
+
+    Raises:
+        ldap.LDAPError: The domain entry cannot be read.
+
+    Returns:
+        PasswordPolicy: The domain policy.
+    """
+    domain = PasswordPolicy("domain")
+    for _, attrs in lm.ldap_search(
+        get_domain_dn(), "(objectClass=*)",
+        ['minPwdLength', 'pwdProperties', 'pwdHistoryLength'], scope=ldap.SCOPE_BASE, strict=True
+    ):
+        domain = PasswordPolicy(
+            "domain",
+            min_length=_int(attrs, 'minPwdLength'),
+            complexity=bool(_int(attrs, 'pwdProperties') & DOMAIN_PASSWORD_COMPLEX),
+            history=_int(attrs, 'pwdHistoryLength'),
+        )
+    return domain
+
+
+def _pso(dn: str, attrs: dict):
+    """Build a PasswordPolicy from a PSO entry.
+    """
+    return PasswordPolicy(
+        dn,
+        min_length=_int(attrs, 'msDS-MinimumPasswordLength'),
+        complexity=list_get(attrs.get('msDS-PasswordComplexityEnabled'), 0) == b'TRUE',
+        history=_int(attrs, 'msDS-PasswordHistoryLength'),
+        precedence=_int(attrs, 'msDS-PasswordSettingsPrecedence'),
+        applies_to=[v.decode('utf-8') for v in attrs.get('msDS-PSOAppliesTo', [])],
+    )
+
+
+def load_psos():
+    """Read the fine-grained password policies (PSO) from the directory.
+
+    Raises:
+        ldap.LDAPError: The PSO cannot be read (the PSO container is not
+            visible without enough rights).
+
+    Returns:
+        list: The PSO.
+    """
+    return [
+        _pso(dn, attrs) for dn, attrs in lm.ldap_search(
+            f"CN=Password Settings Container,CN=System,{get_domain_dn()}",
+            "(objectClass=msDS-PasswordSettings)", PSO_ATTRIBUTES,
+            scope=ldap.SCOPE_ONELEVEL, strict=True
+        ) if dn
+    ]
+
+
+def get_policies():
+    """Get the password policies of the directory of the current site (cached).
+
+    The directory is read out of the cache lock. Expired policies are read
+    again by a single thread, the others use them meanwhile. A failed read
+    of the domain policy is not cached; a failed read of the PSO is cached
+    (as None) like the policies, since most bind accounts cannot read them.
+
+    Returns:
+        tuple: The domain PasswordPolicy and the list of PSO (None if unreadable).
+    """
+    key = (sites.current().directory, get_domain_dn())
+    with _cache_lock:
+        cache = _cache.get(key)
+        if cache is not None and (cache["expires"] >= time.time() or cache["loading"]):
+            return cache["domain"], cache["psos"]
+        if cache is not None:
+            cache["loading"] = True
+    try:
+        domain = load_domain_policy()
+        try:
+            psos = load_psos()
+        except ldap.LDAPError as e:
+            logger.warning(f"Cannot read PSO, only the domain password policy is used: {str(e)}")
+            psos = None
+    except Exception:
+        if cache is not None:
+            with _cache_lock:
+                cache["loading"] = False
+        raise
+    logger.info(f"Password policies loaded: {domain}, {len(psos) if psos is not None else 'no'} PSO.")
+    with _cache_lock:
+        _cache[key] = {
+            "expires": time.time() + int(config_get("password_policy.cache_ttl", 3600)),
+            "loading": False,
+            "domain": domain,
+            "psos": psos,
+        }
+    return domain, psos
+
+
+def get_resultant_pso(user_dn: str):
+    """Get the PSO applying to a user, as resolved by the directory.
+
+    The constructed ``msDS-ResultantPSO`` attribute takes the PSO linked to
+    the user and to its groups (nested ones included) into account.
+
+    Args:
+        user_dn (str): DN of the user.
+
+    Returns:
+        str: DN of the PSO, or None if the domain policy applies.
+    """
+    for _, attrs in lm.ldap_search(
+        user_dn, "(objectClass=*)", ['msDS-ResultantPSO'], scope=ldap.SCOPE_BASE, strict=True
+    ):
+        value = list_get(attrs.get('msDS-ResultantPSO'), 0)
+        return value.decode('utf-8') if value else None
+    return None
+
+
+def get_pso(dn: str, psos: list):
+    """Get a PSO by its DN, from the PSO list or read on its own (cached).
+
+    Args:
+        dn (str): DN of the PSO.
+        psos (list): The PSO (None if the container is unreadable).
+
+    Returns:
+        PasswordPolicy: The PSO, or None if it cannot be read.
+    """
+    for pso in psos or []:
+        if pso.name.lower() == dn.lower():
+            return pso
+    key = (sites.current().directory, dn.lower())
+    with _cache_lock:
+        if key in _psos and _psos[key]["expires"] >= time.time():
+            return _psos[key]["pso"]
+    pso = None
+    try:
+        for entry_dn, attrs in lm.ldap_search(
+            dn, "(objectClass=msDS-PasswordSettings)", PSO_ATTRIBUTES, scope=ldap.SCOPE_BASE, strict=True
+        ):
+            pso = _pso(entry_dn, attrs)
+    except ldap.LDAPError as e:
+        logger.warning(f"Cannot read PSO {dn}: {str(e)}")
+    with _cache_lock:
+        _psos[key] = {
+            "expires": time.time() + int(config_get("password_policy.cache_ttl", 3600)),
+            "pso": pso,
+        }
+    return pso
+
+
+def get_policy(user_dn: str=None):
+    """Get the password policy that applies to a user.
+
+    Args:
+        user_dn (str, optional): Defaults to None (new user). DN of the user.
+
+    Returns:
+        PasswordPolicy: The resultant policy (PSO or domain policy), or None if
+            the PSO of the user cannot be read.
+    """
+    domain, psos = get_policies()
+    if not user_dn:
+        return domain
+    pso_dn = get_resultant_pso(user_dn)
+    if not pso_dn:
+        return domain
+    return get_pso(pso_dn, psos)
+
+
+def validate_password(password: str, login: str=None, display_name: str=None, user_dn: str=None):
+    """Check a password against the policy applying to a user.
+
+    Args:
+        password (str): Password to check.
+        login (str, optional): Defaults to None. sAMAccountName of the user.
+        display_name (str, optional): Defaults to None. Display name of the user.
+        user_dn (str, optional): Defaults to None (new user). DN of the user.
+
+    Returns:
+        str: An error message ("400: ...") or None if the password is valid.
+    """
+    if not config_get("password_policy.enabled", True):
+        return None
+    try:
+        if user_dn:
+            policies = [get_policy(user_dn)]
+            if policies[0] is None:
+                # Let the directory decide
+                return None
+        else:
+            # A new user is only in the default group of the domain, which may
+            # be linked to a PSO: the password is refused only if refused by
+            # the domain policy and by every PSO linked to a group.
+            domain, psos = get_policies()
+            policies = [domain] + [p for p in psos or [] if p.applies_to]
+    except Exception as e:
+        # Let the directory decide
+        logger.warning(f"Cannot read password policy: {str(e)}")
+        return None
+    errors = []
+    for policy in policies:
+        logger.trivia(f"Validating password against policy {policy.name}")
+        error = policy.validate(password, login, display_name)
+        if not error:
+            return None
+        errors.append(error)
+    return errors[0]
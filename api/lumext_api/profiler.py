@@ -0,0 +1,125 @@
+"""Statistical sampling profiler, toggled at runtime.
+
+While running, the sampler periodically records the stack of every thread
+of the process. When stopped, the samples are written in the "collapsed
+stacks" format (one ``frame;frame;frame count`` line per distinct stack),
+ready for `flamegraph.pl`, speedscope or similar tools.
+
+Signals (see `utils.profiler_signal_handler`):
+    * ``SIGUSR1``: start sampling
+    * ``SIGUSR2``: stop sampling and dump the collapsed stacks
+"""
+# Standard imports
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Local imports
+from .utils import config_get
+
+logger = logging.getLogger(__name__)
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+class StackSampler():
+    """Sample the stacks of all threads in a background thread.
+    """
+
+    def __init__(self, interval: float=0.01):
+        """Prepare a sampler.
+
+        Args:
+            interval (float, optional): Defaults to 0.01. Seconds between two samples.
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling.
+        """
+        self._thread = threading.Thread(target=self._sample, name="StackSampler", daemon=True)
+        self.started = time.time()
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling (wait for the sampler thread to leave).
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        """Record the stacks of the other threads, until stopped.
+        """
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                    stack.append(f"{module}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, path: str):
+        """Write the collapsed stacks.
+
+        Args:
+            path (str): Path of the output file.
+        """
+        with open(path, "w", encoding="utf-8") as fd:
+            for stack, count in self.stacks.most_common():
+                fd.write(f"{stack} {count}\n")
+
+
+def start_profiling():
+    """Start the sampler (if not already running).
+    """
+    global _sampler
+    with _sampler_lock:
+        if _sampler is not None:
+            logger.warning("Profiler is already running.")
+            return
+        _sampler = StackSampler(float(config_get("profiler.interval", 0.01)))
+        _sampler.start()
+    logger.info("Profiler started.")
+
+
+def stop_profiling():
+    """Stop the sampler and dump the collapsed stacks.
+
+    Returns:
+        str: Path of the dump, or None if the profiler was not running.
+    """
+    global _sampler
+    with _sampler_lock:
+        sampler, _sampler = _sampler, None
+    if sampler is None:
+        logger.warning("Profiler is not running.")
+        return None
+    sampler.stop()
+    output_dir = config_get("profiler.output_dir", "/tmp")
+    path = os.path.join(
+        output_dir,
+        f"lumext-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+    )
+    sampler.dump(path)
+    logger.info(
+        f"Profiler stopped after {time.time() - sampler.started:.1f}s "
+        f"({sampler.samples} samples): stacks written in {path}"
+    )
+    return path
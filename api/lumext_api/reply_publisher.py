@@ -0,0 +1,311 @@
+"""Publishing of the replies to vCD, off the worker threads.
+
+Workers queue their replies without blocking. A few publisher threads, each
+owning its own AMQP connection and channel (in publisher confirms mode),
+publish the queued replies by batches and wait for the broker confirmations
+of the whole batch at once.
+
+A reply that is not confirmed (nack, timeout, connection lost) is published
+again, up to ``reply_publisher.max_attempts`` times: a reply is never
+dropped without an error log.
+
+The reply message is the one built by `vcdextmessageworker` (base64 body,
+``Content-Type``/``Content-Length`` headers), with optional extra headers.
+Without the reply publisher, a reply with extra headers (``ETag``,
+``Location``...) is published by `publish_direct` on the connection of the
+message worker, whose own `publish` would drop them.
+"""
+# Standard imports
+import base64
+import logging
+import queue
+import socket
+import threading
+import time
+
+# PIP imports
+from kombu import Connection, Exchange, Producer
+
+# Local imports
+from .utils import config_get
+from . import sites
+
+logger = logging.getLogger(__name__)
+
+# Publishers by site
+_publishers = {}
+_publisher_lock = threading.Lock()
+
+
+class Reply():
+    """A reply waiting to be published.
+    """
+
+    def __init__(self, message: dict, correlation_id: str, reply_to: str, exchange: str):
+        """Prepare a reply.
+
+        Args:
+            message (dict): The reply message.
+            correlation_id (str): AMQP correlation ID of the request.
+            reply_to (str): Routing key of the reply.
+            exchange (str): Exchange of the reply.
+        """
+        self.message = message
+        self.correlation_id = correlation_id
+        self.reply_to = reply_to
+        self.exchange = exchange
+        self.attempts = 0
+        self.confirmed = False
+        self.queued_at = time.time()
+
+
+def build_reply(data, properties: dict):
+    """Build a reply message, as `vcdextmessageworker` does.
+
+    Args:
+        data (str): JSON body (or raw bytes if ``properties['encode']`` is False).
+        properties (dict): Response properties (``id``, ``statusCode``,
+            ``Content-Type``, and optional extra ``headers``).
+
+    Returns:
+        dict: The reply message.
+    """
+    if properties.get("encode", True):
+        data = data.encode('utf-8')
+    headers = {
+        'Content-Type': properties.get("Content-Type", "application/*+json;version=31.0"),
+        'Content-Length': len(data),
+    }
+    headers.update(properties.get("headers") or {})
+    return {
+        'id': properties.get('id', None),
+        'headers': headers,
+        'statusCode': properties.get("statusCode", 200),
+        'body': base64.b64encode(data).decode(),
+    }
+
+
+def publish_direct(connection, data, properties: dict, no_declare: bool=True):
+    """Publish a reply on a connection, as `vcdextmessageworker` does, with its extra headers.
+
+    Args:
+        connection (kombu.Connection): Connection of the message worker.
+        data (str): JSON body of the reply.
+        properties (dict): Response properties (see `ReplyPublisher.publish`).
+        no_declare (bool, optional): Defaults to True. Do not declare the reply exchange.
+    """
+    try:
+        connection.Producer().publish(
+            build_reply(data, properties),
+            correlation_id=properties['correlation_id'],
+            routing_key=properties['reply_to'],
+            exchange=Exchange(properties['replyToExchange'], 'direct', durable=True, no_declare=no_declare),
+            retry=True,
+            expiration=10000
+        )
+    except Exception as e:
+        logger.error(f"Cannot publish reply to request {properties.get('id')}: {str(e)}")
+
+
+class ReplyPublisher():
+    """Publish replies from a pool of confirmed channels.
+    """
+
+    def __init__(self, amqp_url: str, channels: int=2, batch_size: int=50,
+                 confirm_timeout: float=5, max_attempts: int=3):
+        """Start the publisher threads.
+
+        Args:
+            amqp_url (str): URL of the broker.
+            channels (int, optional): Defaults to 2. Publisher threads (one channel each).
+            batch_size (int, optional): Defaults to 50. Maximum replies confirmed at once.
+            confirm_timeout (float, optional): Defaults to 5. Seconds to wait for confirmations.
+            max_attempts (int, optional): Defaults to 3. Publications of a reply before giving up.
+        """
+        self.amqp_url = amqp_url
+        self.batch_size = batch_size
+        self.confirm_timeout = confirm_timeout
+        self.max_attempts = max_attempts
+        self.stats = {"queued": 0, "confirmed": 0, "retried": 0, "failed": 0, "batches": 0,
+                      "last_latency": None}
+        self._queue = queue.Queue()
+        self._busy = 0
+        self._lock = threading.Lock()
+        for i in range(channels):
+            threading.Thread(target=self._work, name=f"ReplyPublisher-{i}", daemon=True).start()
+
+    def publish(self, data, properties: dict):
+        """Queue a reply (never blocks).
+
+        Args:
+            data (str): JSON body of the reply.
+            properties (dict): Response properties (see `build_reply`), with
+                ``correlation_id``, ``reply_to`` and ``replyToExchange``.
+        """
+        self._queue.put(Reply(
+            build_reply(data, properties),
+            properties['correlation_id'],
+            properties['reply_to'],
+            properties['replyToExchange'],
+        ))
+        self.stats["queued"] += 1
+
+    def backlog(self):
+        """Get the number of replies not confirmed yet.
+
+        Returns:
+            int: Queued and in-flight replies.
+        """
+        return self._queue.qsize() + self._busy
+
+    def flush(self, timeout: float=10):
+        """Wait for the queued replies to be published (on shutdown).
+
+        Args:
+            timeout (float, optional): Defaults to 10. Maximum seconds to wait.
+
+        Returns:
+            bool: True if all the replies are confirmed.
+        """
+        deadline = time.time() + timeout
+        while self.backlog() and time.time() < deadline:
+            time.sleep(0.05)
+        if self.backlog():
+            logger.error(f"{self.backlog()} reply(ies) not published before shutdown.")
+            return False
+        return True
+
+    def _connect(self):
+        """Open a connection and a channel in publisher confirms mode.
+
+        Returns:
+            tuple: The connection, the channel and its confirmations state.
+        """
+        conn = Connection(self.amqp_url, heartbeat=0)
+        conn.connect()
+        channel = conn.channel()
+        channel.confirm_select()
+        state = {"next_tag": 1, "pending": {}}
+
+        def confirm(delivery_tag, multiple, confirmed):
+            tags = [t for t in state["pending"] if t == delivery_tag or (multiple and t <= delivery_tag)]
+            for tag in tags:
+                reply = state["pending"].pop(tag)
+                reply.confirmed = confirmed
+                if confirmed:
+                    self.stats["confirmed"] += 1
+                    self.stats["last_latency"] = round(time.time() - reply.queued_at, 6)
+
+        channel.events['basic_ack'].add(lambda tag, multiple=False: confirm(tag, multiple, True))
+        channel.events['basic_nack'].add(lambda tag, multiple=False, *args: confirm(tag, multiple, False))
+        return conn, channel, state
+
+    def _publish_batch(self, conn, channel, state: dict, batch: list):
+        """Publish a batch of replies and wait for their confirmations.
+        """
+        producer = Producer(channel)
+        for reply in batch:
+            reply.attempts += 1
+            state["pending"][state["next_tag"]] = reply
+            state["next_tag"] += 1
+            producer.publish(
+                reply.message,
+                correlation_id=reply.correlation_id,
+                routing_key=reply.reply_to,
+                exchange=Exchange(reply.exchange, 'direct', durable=True, no_declare=True),
+                expiration=10000
+            )
+        deadline = time.time() + self.confirm_timeout
+        while state["pending"] and time.time() < deadline:
+            try:
+                conn.drain_events(timeout=max(deadline - time.time(), 0.01))
+            except socket.timeout:
+                pass
+        self.stats["batches"] += 1
+
+    def _retry(self, replies: list, reason: str):
+        """Queue again unconfirmed replies (or give up).
+        """
+        for reply in replies:
+            if reply.attempts >= self.max_attempts:
+                self.stats["failed"] += 1
+                logger.error(
+                    f"Reply to request {reply.message['id']} (correlation ID {reply.correlation_id}) "
+                    f"is lost after {reply.attempts} attempt(s): {reason}"
+                )
+            else:
+                self.stats["retried"] += 1
+                self._queue.put(reply)
+
+    def _work(self):
+        """Publish the queued replies, forever.
+        """
+        conn = channel = state = None
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            with self._lock:
+                self._busy += len(batch)
+            reason = "not confirmed by the broker"
+            try:
+                if conn is None:
+                    conn, channel, state = self._connect()
+                self._publish_batch(conn, channel, state, batch)
+            except Exception as e:
+                logger.warning(f"Cannot publish {len(batch)} reply(ies): {str(e)}")
+                reason = str(e)
+                # Let the broker come back before the next attempt
+                time.sleep(1)
+            failed = [reply for reply in batch if not reply.confirmed]
+            if failed:
+                # Late confirmations could not be matched anymore: use a new channel
+                conn = self._close(conn)
+                self._retry(failed, reason)
+            with self._lock:
+                self._busy -= len(batch)
+
+    def _close(self, conn):
+        """Close a connection, ignoring errors.
+
+        Returns:
+            None: Nothing, to reset the connection variable.
+        """
+        try:
+            if conn is not None:
+                conn.release()
+        except Exception:
+            pass
+        return None
+
+
+def get_reply_publisher(site: sites.Site=None):
+    """Get the reply publisher of a site.
+
+    Args:
+        site (sites.Site, optional): Defaults to the current site. Site whose
+            broker receives the replies.
+
+    Returns:
+        ReplyPublisher: The publisher, or None if disabled (replies are then
+            published by the message worker itself).
+    """
+    if not config_get("reply_publisher.enabled", False):
+        return None
+    site = site or sites.current()
+    publisher = _publishers.get(site.name)
+    if publisher is None:
+        with _publisher_lock:
+            publisher = _publishers.get(site.name)
+            if publisher is None:
+                publisher = _publishers[site.name] = ReplyPublisher(
+                    site.amqp_url,
+                    channels=int(config_get("reply_publisher.channels", 2)),
+                    batch_size=int(config_get("reply_publisher.batch_size", 50)),
+                    confirm_timeout=float(config_get("reply_publisher.confirm_timeout", 5)),
+                    max_attempts=int(config_get("reply_publisher.max_attempts", 3))
+                )
+    return publisher
@@ -0,0 +1,323 @@
+"""Fair scheduling of the requests between organizations.
+
+Requests of all organizations arrive through the same RabbitMQ queue. To
+avoid that a tenant's burst starves the others, each organization gets:
+
+* a token bucket limiting its request rate (``429`` answer when exceeded),
+* its own waiting queue, served by a pool of worker threads in a weighted
+  round-robin way (deficit round-robin).
+
+Requests are also classified in two lanes: reads (``GET``) and writes. Each
+lane has its own queues and concurrency limit, and queued reads are always
+served before queued writes, so slow directory writes do not delay the UI.
+"""
+# Standard imports
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Local imports
+from .utils import config_get
+
+logger = logging.getLogger(__name__)
+
+READ = "read"
+WRITE = "write"
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class TokenBucket():
+    """A token bucket rate limiter.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        """Create a full bucket.
+
+        Args:
+            rate (float): Tokens added per second.
+            burst (float): Maximum number of tokens in the bucket.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def consume(self, count: float=1):
+        """Take tokens from the bucket.
+
+        Args:
+            count (float, optional): Defaults to 1. Number of tokens to take.
+
+        Returns:
+            bool: Were tokens available?
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+
+class Lane():
+    """Waiting requests of a lane, by organization.
+    """
+
+    def __init__(self, name: str, limit: int):
+        """Create an empty lane.
+
+        Args:
+            name (str): Name of the lane.
+            limit (int): Maximum requests of the lane running concurrently.
+        """
+        self.name = name
+        self.limit = limit
+        self.running = 0
+        self.queues = {}
+        self.credits = {}
+        self.active = deque()
+
+    def ready(self):
+        """Can a request of the lane run now?
+
+        Returns:
+            bool: Are there waiting requests and a free slot?
+        """
+        return bool(self.active) and self.running < self.limit
+
+    def queued(self):
+        """Get the number of waiting requests.
+
+        Returns:
+            int: Waiting requests of all organizations.
+        """
+        return sum(len(q) for q in self.queues.values())
+
+
+class FairScheduler():
+    """Dispatch requests to a pool of worker threads, fairly between organizations.
+    """
+
+    def __init__(self, workers: int, rate: float=None, burst: float=None,
+                 max_queued: int=None, weights: dict={}, read_workers: int=None,
+                 write_workers: int=None):
+        """Create the scheduler and start its worker threads.
+
+        Args:
+            workers (int): Number of worker threads.
+            rate (float, optional): Defaults to None. Allowed requests per second
+                for each organization (None: no limit).
+            burst (float, optional): Defaults to `rate`. Size of the token buckets.
+            max_queued (int, optional): Defaults to None. Maximum number of waiting
+                requests per organization and lane (None: no limit).
+            weights (dict, optional): Defaults to {}. Share of the workers for some
+                organizations (org ID -> weight, default weight is 1).
+            read_workers (int, optional): Defaults to `workers`. Maximum reads
+                running concurrently.
+            write_workers (int, optional): Defaults to half of `workers`. Maximum
+                writes running concurrently (the other workers stay available to reads).
+        """
+        self.workers = workers
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_queued = max_queued
+        self.weights = {}
+        for org_id, value in weights.items():
+            try:
+                weight = float(value)
+            except (TypeError, ValueError):
+                weight = 0
+            # A weight <= 0 would never give credits to the organization
+            if weight > 0:
+                self.weights[org_id] = weight
+            else:
+                logger.error(f"Invalid scheduler weight for organization {org_id}: {value} (default is used)")
+        # Reads first: a free worker takes a waiting read before any write
+        self.lanes = OrderedDict([
+            (READ, Lane(READ, min(read_workers or workers, workers))),
+            (WRITE, Lane(WRITE, min(write_workers or max(workers // 2, 1), workers))),
+        ])
+        self._buckets = {}
+        self._buckets_pruned = time.monotonic()
+        self._cond = threading.Condition()
+        self._busy = 0
+        self.rejected = 0
+        for i in range(workers):
+            threading.Thread(
+                target=self._work, name=f"Worker-{i}", daemon=True
+            ).start()
+        logger.info(
+            f"Scheduler started with {workers} workers "
+            f"({self.lanes[READ].limit} for reads, {self.lanes[WRITE].limit} for writes)."
+        )
+
+    def submit(self, job):
+        """Queue a request.
+
+        Args:
+            job (lumext.MessageWorker): The request to run. It must provide `org_id`,
+                `run()` and `proceed_response()`, and may provide its `lane`
+                (`READ` or `WRITE`, default).
+
+        Returns:
+            bool: Is the request accepted?
+        """
+        org_id = getattr(job, "org_id", None) or ""
+        lane = self.lanes.get(getattr(job, "lane", WRITE), self.lanes[WRITE])
+        with self._cond:
+            if self.rate:
+                self._prune_buckets()
+                bucket = self._buckets.get(org_id)
+                if not bucket:
+                    bucket = self._buckets[org_id] = TokenBucket(self.rate, self.burst)
+                allowed = bucket.consume()
+            else:
+                allowed = True
+            if allowed and self.max_queued:
+                allowed = len(lane.queues.get(org_id, ())) < self.max_queued
+            if allowed:
+                if org_id not in lane.queues:
+                    lane.queues[org_id] = deque()
+                    lane.credits[org_id] = 0
+                    lane.active.append(org_id)
+                lane.queues[org_id].append(job)
+                self._cond.notify()
+            else:
+                self.rejected += 1
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for organization {org_id}")
+            job.proceed_response(f"429: Too many requests for organization {org_id}.")
+        return allowed
+
+    def _prune_buckets(self):
+        """Forget the buckets of idle organizations, once a minute (lock must be held).
+
+        A bucket refilled up to its burst is the same as a new one.
+        """
+        now = time.monotonic()
+        if now - self._buckets_pruned < 60:
+            return
+        self._buckets_pruned = now
+        for org_id in [
+            o for o, b in self._buckets.items() if b.tokens + (now - b.last) * b.rate >= b.burst
+        ]:
+            del self._buckets[org_id]
+
+    def weight(self, org_id: str):
+        """Get the weight of an organization.
+
+        Args:
+            org_id (str): ID of the organization.
+
+        Returns:
+            float: Number of requests served per round for this organization.
+        """
+        return float(self.weights.get(org_id, 1))
+
+    def _ready_lane(self):
+        """Get the lane of the next request to run (lock must be held).
+
+        Returns:
+            Lane: The first lane with a runnable request, or None.
+        """
+        for lane in self.lanes.values():
+            if lane.ready():
+                return lane
+        return None
+
+    def _pop(self, lane: Lane):
+        """Get the next request to run from a lane (lock must be held).
+
+        Args:
+            lane (Lane): A lane with waiting requests.
+
+        Returns:
+            lumext.MessageWorker: The next request.
+        """
+        while True:
+            org_id = lane.active[0]
+            if lane.credits[org_id] < 1:
+                # Give a new quantum and let the next organization run
+                lane.credits[org_id] += self.weight(org_id)
+                lane.active.rotate(-1)
+                continue
+            lane.credits[org_id] -= 1
+            tenant_queue = lane.queues[org_id]
+            job = tenant_queue.popleft()
+            if not tenant_queue:
+                del lane.queues[org_id]
+                del lane.credits[org_id]
+                lane.active.popleft()
+            return job
+
+    def _work(self):
+        """Run the requests, forever.
+        """
+        while True:
+            with self._cond:
+                lane = self._ready_lane()
+                while lane is None:
+                    self._cond.wait()
+                    lane = self._ready_lane()
+                job = self._pop(lane)
+                lane.running += 1
+                self._busy += 1
+            try:
+                job.run()
+            except Exception as e:
+                logger.error(f"Request failed in scheduler: {str(e)}")
+            finally:
+                with self._cond:
+                    lane.running -= 1
+                    self._busy -= 1
+                    # A worker may wait for this lane to have a free slot
+                    self._cond.notify()
+
+    def stats(self):
+        """Get the usage of the scheduler.
+
+        Returns:
+            dict: Workers usage and waiting requests.
+        """
+        with self._cond:
+            lanes = {
+                name: {"limit": lane.limit, "running": lane.running, "queued": lane.queued()}
+                for name, lane in self.lanes.items()
+            }
+            tenants = len(set().union(*(lane.queues for lane in self.lanes.values())))
+        return {
+            "workers": self.workers,
+            "busy": self._busy,
+            "saturation": round(self._busy / self.workers, 3),
+            "queued": sum(lane["queued"] for lane in lanes.values()),
+            "queued_tenants": tenants,
+            "rejected": self.rejected,
+            "lanes": lanes,
+        }
+
+
+def get_scheduler():
+    """Get the scheduler of the process.
+
+    Returns:
+        FairScheduler: The scheduler, created (and started) on first call.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                weights = config_get("scheduler.weights")
+                _scheduler = FairScheduler(
+                    int(config_get("scheduler.workers", 16)),
+                    rate=config_get("scheduler.rate"),
+                    burst=config_get("scheduler.burst"),
+                    max_queued=config_get("scheduler.max_queued"),
+                    weights=vars(weights) if weights else {},
+                    read_workers=config_get("scheduler.read_workers"),
+                    write_workers=config_get("scheduler.write_workers")
+                )
+    return _scheduler
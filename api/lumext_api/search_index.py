@@ -0,0 +1,393 @@
+"""In-memory index of the users of all tenants, for the provider search.
+
+The login, display name and description of every user under the LDAP base
+of each site are indexed:
+
+* by prefix: the terms (whole values and their words) with their users, and
+  the sorted list of the distinct terms, searched by bisection,
+* by substring: the trigrams of the values, whose posting sets are
+  intersected before checking the candidates.
+
+The index is built in background by paged searches of each tenant OU, kept
+current by the user writes of the process, and rebuilt every
+``search.refresh_interval`` seconds to catch the changes made out of this
+process. A rebuild fills a new index without holding the lock of the
+served one, which is swapped at the end: searches and writes are not
+blocked meanwhile. The users of the tenants which cannot be read are kept
+from the previous build.
+"""
+# Standard imports
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+
+# Local imports
+from .utils import config_get, list_get
+from . import ldap_manager as lm
+from . import sites
+
+logger = logging.getLogger(__name__)
+
+# Indexed fields of a user
+FIELDS = ("login", "display_name", "description")
+
+_index = None
+_index_lock = threading.Lock()
+_indexer = None
+
+
+def _text(value):
+    """Decode an attribute value (bytes from the directory).
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value or ""
+
+
+def trigrams(value: str):
+    """Get the trigrams of a (lowercase) value.
+
+    Args:
+        value (str): The value.
+
+    Returns:
+        set: Its trigrams (none for values shorter than 3 characters).
+    """
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class UserIndex():
+    """Prefix and trigram index of users.
+    """
+
+    def __init__(self):
+        """Create an empty index.
+        """
+        self.ready = False
+        self.stats = {"users": 0, "terms": 0, "trigrams": 0, "builds": 0,
+                      "last_build": None, "last_build_duration": None}
+        self._users = {}  # ID -> user record
+        self._ids = {}  # (site, DN) -> ID
+        self._terms = defaultdict(set)  # term -> IDs
+        self._sorted_terms = []  # distinct terms, sorted (None while building)
+        self._trigrams = defaultdict(set)  # trigram -> IDs
+        self._next_id = 0
+        # Writes received during a rebuild, applied again to the new index
+        self._journal = None
+        self._lock = threading.RLock()
+
+    def _terms_of(self, user: dict):
+        """Get the prefix terms of a user: values and their words.
+        """
+        terms = set()
+        for field in FIELDS:
+            value = user[field].lower()
+            if value:
+                terms.add(value)
+                terms.update(value.split())
+        return terms
+
+    def _trigrams_of(self, user: dict):
+        """Get the trigrams of the values of a user.
+        """
+        return set().union(*(trigrams(user[field].lower()) for field in FIELDS))
+
+    def _insert(self, user: dict):
+        """Index a user record (lock held).
+        """
+        user_id = self._ids.get((user["site"], user["dn"]))
+        if user_id is not None:
+            self._remove_id(user_id)
+        user_id = self._next_id
+        self._next_id += 1
+        self._users[user_id] = user
+        self._ids[(user["site"], user["dn"])] = user_id
+        for term in self._terms_of(user):
+            postings = self._terms[term]
+            if not postings and self._sorted_terms is not None:
+                # New distinct term (rare once built)
+                bisect.insort(self._sorted_terms, term)
+            postings.add(user_id)
+        for trigram in self._trigrams_of(user):
+            self._trigrams[trigram].add(user_id)
+
+    def _remove_id(self, user_id: int):
+        """Remove a user from the index (lock held).
+        """
+        user = self._users.pop(user_id)
+        del self._ids[(user["site"], user["dn"])]
+        for term in self._terms_of(user):
+            postings = self._terms[term]
+            postings.discard(user_id)
+            if not postings:
+                del self._terms[term]
+                if self._sorted_terms is not None:
+                    i = bisect.bisect_left(self._sorted_terms, term)
+                    if i < len(self._sorted_terms) and self._sorted_terms[i] == term:
+                        del self._sorted_terms[i]
+        for trigram in self._trigrams_of(user):
+            postings = self._trigrams[trigram]
+            postings.discard(user_id)
+            if not postings:
+                del self._trigrams[trigram]
+
+    def add(self, site: str, org: str, dn: str, login, display_name, description):
+        """Add (or update) a user.
+
+        Args:
+            site (str): Name of the site.
+            org (str): Organization (tenant OU) of the user.
+            dn (str): DN of the user.
+            login (str): Login of the user.
+            display_name (str): Display name of the user.
+            description (str): Description of the user.
+        """
+        user = {
+            "site": site, "org": org, "dn": dn, "login": _text(login),
+            "display_name": _text(display_name), "description": _text(description),
+        }
+        with self._lock:
+            self._insert(user)
+            if self._journal is not None:
+                self._journal.append(("add", user))
+
+    def remove(self, site: str, dn: str):
+        """Remove a user.
+
+        Args:
+            site (str): Name of the site.
+            dn (str): DN of the user.
+        """
+        with self._lock:
+            user_id = self._ids.get((site, dn))
+            if user_id is not None:
+                self._remove_id(user_id)
+            if self._journal is not None:
+                self._journal.append(("remove", (site, dn)))
+
+    def _prefix(self, query: str):
+        """Get the IDs of the users with a term starting with `query` (lock held).
+        """
+        i = bisect.bisect_left(self._sorted_terms, query)
+        while i < len(self._sorted_terms) and self._sorted_terms[i].startswith(query):
+            for user_id in sorted(self._terms[self._sorted_terms[i]]):
+                yield user_id
+            i += 1
+
+    def _substring(self, query: str):
+        """Get the IDs of the users with a value containing `query` (lock held).
+        """
+        postings = sorted((self._trigrams.get(t, set()) for t in trigrams(query)), key=len)
+        if not postings:
+            return
+        for user_id in sorted(postings[0].intersection(*postings[1:])):
+            user = self._users[user_id]
+            if any(query in user[field].lower() for field in FIELDS):
+                yield user_id
+
+    def search(self, query: str, site: str, limit: int=50, mode: str="auto"):
+        """Search users by prefix and/or substring.
+
+        Args:
+            query (str): Searched text (case insensitive).
+            site (str): Name of the site of the users.
+            limit (int, optional): Defaults to 50. Maximum number of results.
+            mode (str, optional): Defaults to ``auto``. ``prefix``, ``substring``,
+                or ``auto`` (prefix matches first, then substring matches).
+
+        Returns:
+            list: Matching users (site, org, dn, login, display name, description).
+        """
+        query = query.strip().lower()
+        results = []
+        seen = set()
+        with self._lock:
+            sources = []
+            if mode in ("prefix", "auto"):
+                sources.append(self._prefix(query))
+            if mode in ("substring", "auto") and len(query) >= 3:
+                sources.append(self._substring(query))
+            for source in sources:
+                for user_id in source:
+                    user = self._users[user_id]
+                    if user_id in seen or user["site"] != site:
+                        continue
+                    seen.add(user_id)
+                    results.append(dict(user))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def begin_build(self):
+        """Start a rebuild: the writes are recorded until `end_build`.
+
+        Returns:
+            UserIndex: The new index to fill (without lock contention, its
+                sorted terms are only computed at the end).
+        """
+        fresh = UserIndex()
+        fresh._sorted_terms = None
+        with self._lock:
+            self._journal = []
+        return fresh
+
+    def cancel_build(self):
+        """Abort a rebuild: the served index is kept as is.
+        """
+        with self._lock:
+            self._journal = None
+
+    def end_build(self, fresh, failed: set, duration: float):
+        """End a rebuild: serve the new index.
+
+        Args:
+            fresh (UserIndex): The index filled since `begin_build`.
+            failed (set): ``(site, org)`` of the tenants which could not be
+                read (``org`` is None for a whole site): their users are kept.
+            duration (float): Duration of the build (seconds).
+        """
+        fresh._sorted_terms = sorted(fresh._terms)
+        with self._lock:
+            for user in self._users.values():
+                if (user["site"], user["org"]) in failed or (user["site"], None) in failed:
+                    fresh._insert(user)
+            # Writes made meanwhile are more recent than the directory reads
+            for operation, item in self._journal:
+                if operation == "add":
+                    fresh._insert(item)
+                elif item in fresh._ids:
+                    fresh._remove_id(fresh._ids[item])
+            self._journal = None
+            self._users, self._ids = fresh._users, fresh._ids
+            self._terms, self._sorted_terms = fresh._terms, fresh._sorted_terms
+            self._trigrams, self._next_id = fresh._trigrams, fresh._next_id
+            self.ready = True
+            self.stats.update({
+                "users": len(self._users), "terms": len(self._terms), "trigrams": len(self._trigrams),
+                "builds": self.stats["builds"] + 1, "last_build": int(time.time()),
+                "last_build_duration": round(duration, 3),
+            })
+
+
+def get_index():
+    """Get the user index of the process.
+
+    Returns:
+        UserIndex: The index, or None if the search is disabled.
+    """
+    global _index
+    if not config_get("search.enabled", False):
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = UserIndex()
+    return _index
+
+
+def build(index: UserIndex):
+    """Index the users of all tenants of all sites, by paged searches.
+
+    Args:
+        index (UserIndex): The index to rebuild.
+    """
+    start = time.perf_counter()
+    page_size = int(config_get("search.page_size", 1000))
+    fresh = index.begin_build()
+    failed = set()
+    try:
+        for site in sites.get_sites():
+            with sites.activate(site):
+                try:
+                    orgs = lm.list_tenant_ous(strict=True)
+                except Exception as e:
+                    logger.warning(f"Cannot list tenants of site {site.name}: {str(e)}")
+                    failed.add((site.name, None))
+                    continue
+                for org in orgs:
+                    try:
+                        for page in lm.paged_search(
+                            lm.get_ou_base(org), "(objectClass=user)", lm.USER_ATTRIBUTES, page_size
+                        ):
+                            for dn, attrs in page:
+                                fresh.add(
+                                    site.name, org, dn,
+                                    list_get(attrs.get('userPrincipalName'), 0, b"").split(b'@')[0],
+                                    list_get(attrs.get('displayName'), 0),
+                                    list_get(attrs.get('description'), 0)
+                                )
+                    except Exception as e:
+                        logger.warning(f"Cannot index users of {org} (site {site.name}): {str(e)}")
+                        failed.add((site.name, org))
+    except Exception:
+        index.cancel_build()
+        raise
+    # The users of the failed tenants are kept from the previous build
+    index.end_build(fresh, failed, time.perf_counter() - start)
+    logger.info(
+        f"Search index built in {(time.perf_counter() - start) * 1000:.0f}ms: "
+        f"{index.stats['users']} user(s), {len(failed)} tenant(s) kept from the previous build."
+    )
+
+
+def user_written(parent_ou: str, result, previous_dn: str=None):
+    """Update the index after a user creation or edition.
+
+    Args:
+        parent_ou (str): Organization of the user.
+        result (any): Result of the write (the user as dict, or an error message).
+        previous_dn (str, optional): Defaults to None. DN of the user before
+            the write (renamed users).
+    """
+    index = get_index()
+    if index is None or not isinstance(result, dict):
+        return
+    site = sites.current().name
+    if previous_dn and previous_dn != result.get('base'):
+        index.remove(site, previous_dn)
+    index.add(
+        site, parent_ou, result.get('base'),
+        result.get('login'), result.get('display_name'), result.get('description')
+    )
+
+
+def user_deleted(dn: str, result):
+    """Update the index after a user deletion.
+
+    Args:
+        dn (str): DN of the deleted user.
+        result (any): Result of the deletion (an error message is a `str`).
+    """
+    index = get_index()
+    if index is None or isinstance(result, str):
+        return
+    index.remove(sites.current().name, dn)
+
+
+def _build_forever(index: UserIndex, interval: int):
+    """Build the index, then rebuild it every `interval` seconds.
+    """
+    while True:
+        try:
+            build(index)
+        except Exception as e:
+            logger.error(f"Cannot build search index: {str(e)}")
+        if interval <= 0:
+            return
+        time.sleep(interval)
+
+
+def start_indexer():
+    """Start the background build of the index (if enabled).
+    """
+    global _indexer
+    index = get_index()
+    if index is None or _indexer is not None:
+        return
+    _indexer = threading.Thread(
+        target=_build_forever, args=(index, int(config_get("search.refresh_interval", 3600))),
+        name="SearchIndexer", daemon=True
+    )
+    _indexer.start()
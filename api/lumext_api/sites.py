@@ -0,0 +1,188 @@
+"""vCD sites served by the daemon.
+
+By default, the daemon serves a single vCD instance, described by the
+``rabbitmq`` and ``ldap`` blocks of the configuration. With a ``sites`` list,
+one process consumes the brokers of several vCD instances concurrently. Each
+site overrides some settings of these blocks (broker, exchange, queue, LDAP
+base, directory...).
+
+The sites share the worker pool, the metrics and, for the sites using the
+same directory (address and bind user), the LDAP connection pool. The site
+of the running request is set for the thread with `activate`, and the LDAP
+functions read its settings through `ldap_conf`.
+"""
+# Standard imports
+import logging
+import threading
+from contextlib import contextmanager
+
+# Local imports
+from .utils import configuration_manager as cm, dict2obj, get_amqp_url
+
+logger = logging.getLogger(__name__)
+
+_sites = None
+_sites_lock = threading.Lock()
+# Site of the request run by the current thread
+_current = threading.local()
+
+
+class Site():
+    """A vCD instance: its broker and its directory settings.
+    """
+
+    def __init__(self, name: str, rabbitmq, ldap):
+        """Describe a site.
+
+        Args:
+            name (str): Name of the site.
+            rabbitmq (object): `rabbitmq` configuration block of the site.
+            ldap (object): `ldap` configuration block of the site.
+        """
+        self.name = name
+        self.rabbitmq = rabbitmq
+        self.ldap = ldap
+
+    def __repr__(self):
+        return f"Site({self.name})"
+
+    @property
+    def amqp_url(self):
+        """URL of the broker of the site.
+        """
+        return get_amqp_url(self.rabbitmq)
+
+    @property
+    def directory(self):
+        """Key of the directory of the site (sites with the same key share LDAP connections).
+        """
+        return (self.ldap.address, self.ldap.user)
+
+
+def _merge(block, overrides):
+    """Override some settings of a configuration block.
+
+    Args:
+        block (object): Global configuration block.
+        overrides (object): Settings of the site (None: no override).
+
+    Returns:
+        object: A new configuration block.
+    """
+    settings = dict(vars(block))
+    settings.update(vars(overrides) if overrides is not None else {})
+    return dict2obj(settings)
+
+
+def site_name(index: int, settings):
+    """Get the name of a site of the ``sites`` setting.
+
+    Args:
+        index (int): Position of the site in the list.
+        settings (object): Settings of the site.
+
+    Returns:
+        str: Its ``name``, or ``site<index>`` if not set.
+    """
+    return getattr(settings, "name", None) or f"site{index}"
+
+
+def get_sites():
+    """Get the sites served by the daemon.
+
+    Returns:
+        list: The sites (a single ``default`` site without ``sites`` setting).
+    """
+    global _sites
+    if _sites is None:
+        with _sites_lock:
+            if _sites is None:
+                conf = cm()
+                sites = []
+                for i, site in enumerate(getattr(conf, "sites", None) or []):
+                    sites.append(Site(
+                        site_name(i, site),
+                        _merge(conf.rabbitmq, getattr(site, "rabbitmq", None)),
+                        _merge(conf.ldap, getattr(site, "ldap", None))
+                    ))
+                _sites = sites or [Site("default", conf.rabbitmq, conf.ldap)]
+    return _sites
+
+
+def get_site(name: str):
+    """Get a site by its name.
+
+    Args:
+        name (str): Name of the site.
+
+    Returns:
+        Site: The site, or None if unknown.
+    """
+    for site in get_sites():
+        if site.name == name:
+            return site
+    return None
+
+
+def current():
+    """Get the site of the running request.
+
+    Returns:
+        Site: The site activated for the current thread, or the first site.
+    """
+    return getattr(_current, "site", None) or get_sites()[0]
+
+
+@contextmanager
+def activate(site: Site):
+    """Set the site of the operations run by the current thread.
+
+    Args:
+        site (Site): The site (None: keep the current one).
+    """
+    previous = getattr(_current, "site", None)
+    _current.site = site or previous
+    try:
+        yield
+    finally:
+        _current.site = previous
+
+
+def ldap_conf():
+    """Get the `ldap` settings of the current site.
+
+    Returns:
+        object: The `ldap` configuration block.
+    """
+    return current().ldap
+
+
+def qualify(org: str):
+    """Get a process-wide key for an organization of the current site.
+
+    Organizations of different sites may have the same ID.
+
+    Args:
+        org (str): ID of the organization.
+
+    Returns:
+        str: The org ID for a single site, else ``<site>/<org ID>``.
+    """
+    if len(get_sites()) == 1:
+        return org
+    return f"{current().name}/{org}"
+
+
+def unqualify(key: str):
+    """Split a key built by `qualify`.
+
+    Args:
+        key (str): Qualified organization key.
+
+    Returns:
+        tuple: The site (None if unknown) and the org ID.
+    """
+    if len(get_sites()) == 1 or "/" not in key:
+        return get_sites()[0], key
+    name, org = key.split("/", 1)
+    return get_site(name), org
@@ -0,0 +1,200 @@
+"""Cache of the tenant user listings, shared by the worker processes of a host.
+
+The listing of an organization (its user entries) is stored, compressed, in
+a local SQLite database in WAL mode, so readers of all processes never block
+each other nor the writers.
+
+Each organization has a version stamp, increased by any worker after a write
+in the organization. A snapshot is only served if it has been taken at the
+current version (and is not older than ``snapshot_cache.ttl``, which bounds
+the staleness of changes made from another host or out of LUMExt).
+"""
+# Standard imports
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import config_get
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    org TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    org TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    usn INTEGER,
+    count INTEGER,
+    created REAL NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class SnapshotCache():
+    """Versioned snapshots of the user entries of organizations.
+    """
+
+    def __init__(self, path: str, ttl: int=60):
+        """Open (or create) the cache database.
+
+        Args:
+            path (str): Path of the SQLite database.
+            ttl (int, optional): Defaults to 60. Maximum age (seconds) of a served snapshot.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "invalidations": 0}
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+
+    def _db(self):
+        """Get the database connection of the running thread.
+
+        Returns:
+            sqlite3.Connection: The connection (in autocommit mode).
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def version(self, org: str):
+        """Get the current version stamp of an organization.
+
+        Args:
+            org (str): Organization (parent OU).
+
+        Returns:
+            int: The version (0 if never written).
+        """
+        row = self._db().execute("SELECT version FROM versions WHERE org = ?", (org,)).fetchone()
+        return row[0] if row else 0
+
+    def _valid_row(self, columns: str, org: str):
+        """Read columns of the snapshot of an organization, if still valid.
+
+        Returns:
+            tuple: The columns, or None if there is no valid snapshot.
+        """
+        row = self._db().execute(
+            f"SELECT s.created, {columns} FROM snapshots s LEFT JOIN versions v ON v.org = s.org "
+            "WHERE s.org = ? AND s.version = IFNULL(v.version, 0)", (org,)
+        ).fetchone()
+        if row is None or row[0] + self.ttl < time.time():
+            return None
+        return row[1:]
+
+    def marker(self, org: str):
+        """Get the change marker of the snapshot of an organization.
+
+        Args:
+            org (str): Organization (parent OU).
+
+        Returns:
+            tuple: `(count, usn)` of the valid snapshot, or None.
+        """
+        return self._valid_row("s.count, s.usn", org)
+
+    def get(self, org: str):
+        """Get the snapshot of an organization, if still valid.
+
+        Args:
+            org (str): Organization (parent OU).
+
+        Returns:
+            list: The `(dn, attrs)` entries, or None if there is no valid snapshot.
+        """
+        row = self._valid_row("s.data", org)
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return [
+            (dn, {k: [v.encode('utf-8') for v in values] for k, values in attrs.items()})
+            for dn, attrs in json.loads(zlib.decompress(row[0]))
+        ]
+
+    def put(self, org: str, version: int, entries: list, usn: int=None):
+        """Store the snapshot of an organization.
+
+        The snapshot is dropped if the organization has been written since
+        `version` was read (the listing may miss this write).
+
+        Args:
+            org (str): Organization (parent OU).
+            version (int): Version read before listing the entries.
+            entries (list): The `(dn, attrs)` entries (values as bytes).
+            usn (int, optional): Defaults to None. Highest uSNChanged of the entries.
+        """
+        data = zlib.compress(json.dumps([
+            (dn, {k: [v.decode('utf-8') for v in values] for k, values in attrs.items()})
+            for dn, attrs in entries
+        ]).encode('utf-8'))
+        cursor = self._db().execute(
+            "INSERT OR REPLACE INTO snapshots (org, version, usn, count, created, data) "
+            "SELECT ?, ?, ?, ?, ?, ? WHERE IFNULL((SELECT version FROM versions WHERE org = ?), 0) = ?",
+            (org, version, usn, len(entries), time.time(), data, org, version)
+        )
+        if cursor.rowcount:
+            self.stats["stored"] += 1
+            logger.debug(f"Snapshot of {org} stored ({len(entries)} entries, {len(data)} bytes).")
+
+    def invalidate(self, org: str):
+        """Increase the version of an organization (after a write).
+
+        Args:
+            org (str): Organization (parent OU).
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT OR IGNORE INTO versions (org, version) VALUES (?, 0)", (org,))
+            db.execute("UPDATE versions SET version = version + 1 WHERE org = ?", (org,))
+            db.execute("DELETE FROM snapshots WHERE org = ?", (org,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self.stats["invalidations"] += 1
+
+
+def get_snapshot_cache():
+    """Get the snapshot cache of the process.
+
+    Returns:
+        SnapshotCache: The cache, or None if disabled (or unusable).
+    """
+    global _cache
+    if not config_get("snapshot_cache.enabled", False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = config_get("snapshot_cache.path", "/var/cache/lumext/snapshots.db")
+                try:
+                    _cache = SnapshotCache(path, int(config_get("snapshot_cache.ttl", 60)))
+                except (OSError, sqlite3.Error) as e:
+                    logger.error(f"Cannot open snapshot cache {path}: {str(e)}")
+                    return None
+    return _cache
@@ -0,0 +1,70 @@
+"""Startup timing of the LUMExt daemon and commands.
+
+Heavy dependencies (kombu, python-ldap...) are imported by the commands that
+need them, through `timed_import`, so the cost of each import is known. The
+report lists these costs and the duration of the startup stages.
+"""
+# Standard imports
+import importlib
+import sys
+import time
+from collections import OrderedDict
+
+# Time origin: import of the package entry point
+started = time.perf_counter()
+# Import durations (module name -> seconds)
+imports = OrderedDict()
+# Startup stages (stage name -> seconds since start)
+stages = OrderedDict()
+
+
+def timed_import(name: str):
+    """Import a module and record the duration of the import.
+
+    Args:
+        name (str): Absolute name of the module.
+
+    Returns:
+        module: The imported module.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    imports[name] = time.perf_counter() - start
+    return module
+
+
+def mark(stage: str):
+    """Record the end of a startup stage.
+
+    Args:
+        stage (str): Name of the stage.
+    """
+    stages[stage] = time.perf_counter() - started
+
+
+def report():
+    """Get the startup timing report.
+
+    Returns:
+        dict: Import durations and stages end (milliseconds).
+    """
+    return {
+        "imports": {k: round(v * 1000, 1) for k, v in imports.items()},
+        "stages": {k: round(v * 1000, 1) for k, v in stages.items()},
+    }
+
+
+def format_report():
+    """Get the startup timing report as text.
+
+    Returns:
+        str: One line per import and per stage.
+    """
+    lines = ["Startup timing:"]
+    for name, duration in sorted(imports.items(), key=lambda i: i[1], reverse=True):
+        lines.append(f"  import {name:<30} {duration * 1000:8.1f}ms")
+    for stage, elapsed in stages.items():
+        lines.append(f"  {stage:<37} {elapsed * 1000:8.1f}ms")
+    return "\n".join(lines)
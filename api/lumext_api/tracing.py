@@ -0,0 +1,316 @@
+"""Lightweight tracing of the requests.
+
+A sampled request gets a trace (identified by the AMQP ``correlation_id``)
+made of spans for each stage: parsing, scheduling, LDAP operations and
+response publishing. Finished traces are written by a background thread to
+a local file, one JSON document per line, in Jaeger or OTLP JSON format.
+
+Unsampled requests only pay for a thread-local lookup per span.
+"""
+# Standard imports
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import config_get
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+class Span():
+    """A timed stage of a trace.
+    """
+
+    def __init__(self, trace, name: str, parent_id: str=None, tags: dict=None):
+        """Start a span.
+
+        Args:
+            trace (Trace): Trace of the span.
+            name (str): Name of the stage.
+            parent_id (str, optional): Defaults to None. ID of the parent span.
+            tags (dict, optional): Defaults to None. Attributes of the span.
+        """
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.tags = tags or {}
+        self.start = time.time()
+        self.end = None
+
+    def __enter__(self):
+        """Make the span the parent of the nested spans.
+        """
+        _local.stack.append(self.span_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """Stop the span.
+        """
+        _local.stack.pop()
+        if exc_type:
+            self.tags["error"] = str(exc)
+        self.finish()
+
+    def finish(self, end: float=None):
+        """Stop the span and attach it to its trace.
+
+        Args:
+            end (float, optional): Defaults to now. End timestamp.
+        """
+        self.end = end or time.time()
+        self.trace.spans.append(self)
+
+
+class _NoopSpan():
+    """Span used when the current request is not traced.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Trace():
+    """The spans of a request.
+    """
+
+    def __init__(self, correlation_id: str):
+        """Start a trace.
+
+        Args:
+            correlation_id (str): AMQP correlation ID of the request.
+        """
+        trace_id = (correlation_id or "").replace('-', '').lower()
+        try:
+            int(trace_id, 16)
+        except ValueError:
+            trace_id = hashlib.md5((correlation_id or os.urandom(8).hex()).encode()).hexdigest()
+        self.trace_id = trace_id[:32].rjust(32, '0')
+        self.correlation_id = correlation_id
+        self.spans = []
+        self.root = Span(self, "request", tags={"correlation_id": correlation_id})
+
+
+def start_trace(correlation_id: str):
+    """Start the trace of a request (if sampled).
+
+    Args:
+        correlation_id (str): AMQP correlation ID of the request.
+
+    Returns:
+        Trace: The trace, or None if the request is not sampled.
+    """
+    if not config_get("tracing.enabled", False):
+        return None
+    if random.random() >= float(config_get("tracing.sample_rate", 0.01)):
+        return None
+    return Trace(correlation_id)
+
+
+def record_span(trace: Trace, name: str, start: float, **tags):
+    """Record an already finished stage of a trace.
+
+    Args:
+        trace (Trace): The trace (nothing is done if None).
+        name (str): Name of the stage.
+        start (float): Start timestamp of the stage (it ends now).
+        **tags: Attributes of the span.
+    """
+    if trace is None:
+        return
+    s = Span(trace, name, parent_id=trace.root.span_id, tags=tags)
+    s.start = start
+    s.finish()
+
+
+def span(name: str, **tags):
+    """Time a stage of the current trace (use as a context manager).
+
+    Args:
+        name (str): Name of the stage.
+        **tags: Attributes of the span.
+
+    Returns:
+        Span: The span, or a no-op one if the current request is not traced.
+    """
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return _NOOP
+    return Span(trace, name, parent_id=_local.stack[-1], tags=tags)
+
+
+class activate():
+    """Make a trace the current one for the running thread (context manager).
+
+    The trace is finished and exported on exit.
+    """
+
+    def __init__(self, trace: Trace):
+        """Prepare the activation.
+
+        Args:
+            trace (Trace): The trace (nothing is done if None).
+        """
+        self.trace = trace
+
+    def __enter__(self):
+        if self.trace is not None:
+            _local.trace = self.trace
+            _local.stack = [self.trace.root.span_id]
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            _local.trace = None
+            self.trace.root.finish()
+            get_exporter().export(self.trace)
+        return False
+
+
+class FileExporter():
+    """Write finished traces to a file from a background thread.
+    """
+
+    def __init__(self, path: str, fmt: str="jaeger"):
+        """Start the exporter.
+
+        Args:
+            path (str): Path of the output file.
+            fmt (str, optional): Defaults to `jaeger`. `jaeger` or `otlp`.
+        """
+        self.path = path
+        self.format = fmt
+        self._queue = queue.Queue(maxsize=10000)
+        threading.Thread(target=self._write, name="TraceExporter", daemon=True).start()
+
+    def export(self, trace: Trace):
+        """Queue a trace for writing (dropped if the queue is full).
+
+        Args:
+            trace (Trace): Finished trace.
+        """
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.debug("Trace queue is full: dropping a trace.")
+
+    def _write(self):
+        """Write the queued traces, forever.
+
+        The file is opened again for the next batch after an error.
+        """
+        fd = None
+        while True:
+            traces = [self._queue.get()]
+            while not self._queue.empty() and len(traces) < 100:
+                traces.append(self._queue.get_nowait())
+            try:
+                if fd is None:
+                    fd = open(self.path, "a", encoding="utf-8")
+                fd.write("".join(
+                    json.dumps(to_otlp(trace) if self.format == "otlp" else to_jaeger(trace)) + "\n"
+                    for trace in traces
+                ))
+                fd.flush()
+            except (OSError, ValueError) as e:
+                logger.error(f"Cannot write {len(traces)} trace(s) to {self.path}: {str(e)}")
+                if fd is not None:
+                    try:
+                        fd.close()
+                    except OSError:
+                        pass
+                fd = None
+
+
+def to_jaeger(trace: Trace):
+    """Convert a trace to the Jaeger JSON format (as served by Jaeger query API).
+
+    Args:
+        trace (Trace): Finished trace.
+
+    Returns:
+        dict: Jaeger representation.
+    """
+    spans = []
+    for s in trace.spans:
+        spans.append({
+            "traceID": trace.trace_id,
+            "spanID": s.span_id,
+            "operationName": s.name,
+            "references": [{
+                "refType": "CHILD_OF", "traceID": trace.trace_id, "spanID": s.parent_id
+            }] if s.parent_id else [],
+            "startTime": int(s.start * 1e6),
+            "duration": int((s.end - s.start) * 1e6),
+            "tags": [{"key": k, "type": "string", "value": str(v)} for k, v in s.tags.items()],
+            "processID": "p1",
+        })
+    return {"data": [{
+        "traceID": trace.trace_id,
+        "spans": spans,
+        "processes": {"p1": {"serviceName": "lumext", "tags": []}},
+    }]}
+
+
+def to_otlp(trace: Trace):
+    """Convert a trace to the OTLP JSON format (as written by OTLP file exporters).
+
+    Args:
+        trace (Trace): Finished trace.
+
+    Returns:
+        dict: OTLP representation.
+    """
+    spans = []
+    for s in trace.spans:
+        otlp_span = {
+            "traceId": trace.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 5 if s.parent_id is None else 1,  # CONSUMER / INTERNAL
+            "startTimeUnixNano": str(int(s.start * 1e9)),
+            "endTimeUnixNano": str(int(s.end * 1e9)),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in s.tags.items()],
+        }
+        if s.parent_id:
+            otlp_span["parentSpanId"] = s.parent_id
+        spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "lumext"}}]},
+        "scopeSpans": [{"scope": {"name": "lumext_api"}, "spans": spans}],
+    }]}
+
+
+def get_exporter():
+    """Get the trace exporter of the process.
+
+    Returns:
+        FileExporter: The exporter, created on first call.
+    """
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = FileExporter(
+                    config_get("tracing.file", "/var/log/lumext_traces.json"),
+                    config_get("tracing.format", "jaeger")
+                )
+    return _exporter
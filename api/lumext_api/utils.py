@@ -5,21 +5,39 @@ import logging
 import signal
 import sys
 import os
+import threading
 
 # PIP imports
 import yaml
 
 logger = logging.getLogger(__name__)
 
+# Parsed configuration, loaded once per process
+_configuration = None
+_configuration_lock = threading.Lock()
 
-def signal_handler(signal, frame):
-    """Handle a Keyboard Interrupt to leave rabbitMQ connection.
+
+def signal_handler(signum, frame):
+    """Handle a Keyboard Interrupt (or a service stop) to leave rabbitMQ connection.
     """
     sys.stdout.write('\b\b\r')  # hide the ^C
-    logger.info("SIGINT signal catched -> Exiting...")
+    logger.info(f"{signal.Signals(signum).name} signal catched -> Exiting...")
     sys.exit(0)
 
 
+def profiler_signal_handler(signum, frame):
+    """Handle SIGUSR1 (start) and SIGUSR2 (stop and dump) for the sampling profiler.
+
+    The work is done in a new thread to leave the interrupted one quickly.
+    """
+    from . import profiler
+    if signum == signal.SIGUSR1:
+        action = profiler.start_profiling
+    else:
+        action = profiler.stop_profiling
+    threading.Thread(target=action, name="Profiler", daemon=True).start()
+
+
 def add_log_level(level_name, level_value, method_name=None):
     """Add a new logging level.
 
@@ -112,19 +130,65 @@ valid YAML document.
     return
 
 
-def configuration_manager():
+def configuration_manager(reload: bool=False):
     """Read configuration file.
 
+    The file is parsed on first call only, then the same object is returned.
+
+    Args:
+        reload (bool, optional): Defaults to False. Force a new read of the file.
+
     Returns:
         A configuration object to get members when needed in code.
     """
-    # Read config path from rnv settings.
-    config_path = os.environ.get("LUMEXT_CONFIGURATION_FILE_PATH")
-    # load config file
-    with open(config_path) as yaml_config:
-        c = yaml.load(yaml_config, Loader=yaml.SafeLoader)
-    # parse config
-    return dict2obj(c)
+    global _configuration
+    if _configuration is not None and not reload:
+        return _configuration
+    with _configuration_lock:
+        if _configuration is None or reload:
+            # Read config path from rnv settings.
+            config_path = os.environ.get("LUMEXT_CONFIGURATION_FILE_PATH")
+            # load config file
+            with open(config_path) as yaml_config:
+                c = yaml.load(yaml_config, Loader=yaml.SafeLoader)
+            # parse config
+            _configuration = dict2obj(c)
+    return _configuration
+
+
+def config_get(path: str, default: any = None):
+    """Get an optional setting from the configuration.
+
+    Arguments:
+        path (str): Dotted path of the setting (ex: ``ldap.pool_size``)
+        default (any, optional): A default value to return if the setting is missing
+            (Defaults to ``None``)
+
+    Returns:
+        any: The value of the setting (could be the default one)
+    """
+    value = configuration_manager()
+    for member in path.split('.'):
+        value = getattr(value, member, None)
+        if value is None:
+            return default
+    return value
+
+
+def get_amqp_url(rmq_conf):
+    """Build the URL of a RabbitMQ server.
+
+    Arguments:
+        rmq_conf (object): A `rabbitmq` configuration block.
+
+    Returns:
+        str: The AMQP URL.
+    """
+    amqp_url = f"amqp://{rmq_conf.user}:{rmq_conf.password}"
+    amqp_url += f"@{rmq_conf.server}:{rmq_conf.port}/%2F"
+    if rmq_conf.use_ssl:
+        amqp_url += "?ssl=1"
+    return amqp_url
 
 
 def list_get(arr: list, index: int, default: any = None):
@@ -0,0 +1,139 @@
+"""Warm-up of the LUMExt daemon.
+
+Before consuming messages, the daemon gets ready for the first requests:
+configuration is parsed, LDAP connections are opened and bound, and the
+OU structure of the recently active tenants is checked.
+"""
+# Standard imports
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# PIP imports
+import simplejson as json
+
+# Local imports
+from .utils import configuration_manager as cm, config_get
+from . import sites
+
+logger = logging.getLogger(__name__)
+
+# Set once the daemon is ready to serve requests
+READY = threading.Event()
+# Latest warm-up report
+report = {}
+# Recently active tenants (org ID -> last activity timestamp)
+_recent_tenants = OrderedDict()
+_recent_lock = threading.Lock()
+
+
+def touch_tenant(org_id: str):
+    """Record an activity for a tenant of the current site.
+
+    Args:
+        org_id (str): ID of the active organization.
+    """
+    org_id = sites.qualify(org_id)
+    with _recent_lock:
+        _recent_tenants[org_id] = time.time()
+        _recent_tenants.move_to_end(org_id)
+        while len(_recent_tenants) > int(config_get("warmup.max_tenants", 50)):
+            _recent_tenants.popitem(last=False)
+
+
+def load_recent_tenants():
+    """Load the recently active tenants saved by a previous run.
+
+    Returns:
+        list: Org IDs, most recently active first.
+    """
+    state_file = config_get("warmup.state_file")
+    if not state_file or not os.path.isfile(state_file):
+        return []
+    try:
+        with open(state_file, "r", encoding="utf-8") as fd:
+            saved = json.load(fd)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Cannot read warm-up state file {state_file}: {str(e)}")
+        return []
+    with _recent_lock:
+        for org_id, last_seen in sorted(saved.items(), key=lambda i: i[1]):
+            _recent_tenants.setdefault(org_id, last_seen)
+    return sorted(saved, key=saved.get, reverse=True)
+
+
+def save_recent_tenants():
+    """Save the recently active tenants for the next run.
+    """
+    state_file = config_get("warmup.state_file")
+    if not state_file:
+        return
+    with _recent_lock:
+        recent = dict(_recent_tenants)
+    try:
+        with open(state_file, "w", encoding="utf-8") as fd:
+            json.dump(recent, fd)
+        logger.debug(f"{len(recent)} recent tenant(s) saved in {state_file}.")
+    except OSError as e:
+        logger.warning(f"Cannot write warm-up state file {state_file}: {str(e)}")
+
+
+def warm_up():
+    """Get the daemon ready before consuming the first message.
+
+    Returns:
+        dict: A report of the warm-up phase.
+    """
+    start = time.perf_counter()
+    report.clear()
+    # Parse configuration once
+    cm()
+    if config_get("warmup.enabled", True):
+        # Import the LDAP stack (and set TLS options) now
+        from . import ldap_manager as lm
+        try:
+            lm.init_ldap_options()
+            tenants = list(config_get("warmup.tenants", []))
+            tenants += [t for t in load_recent_tenants() if t not in tenants]
+            tenants = tenants[:int(config_get("warmup.max_tenants", 50))]
+        except Exception as e:
+            # Not fatal: requests will open connections on their own
+            logger.error(f"LDAP warm-up failed: {str(e)}")
+            report["error"] = str(e)
+            tenants = None
+        if tenants is not None:
+            pools = set()
+            report["ldap_connections"] = 0
+            report["tenants"] = 0
+            for site in sites.get_sites():
+                # A site failing does not stop the warm-up of the others
+                try:
+                    with sites.activate(site):
+                        pool = lm.get_ldap_pool()
+                        # Sites using the same directory share their pool
+                        if id(pool) not in pools:
+                            pools.add(id(pool))
+                            report["ldap_connections"] += pool.prefill(config_get("warmup.connections"))
+                        report["tenants"] += lm.prime_tenant_cache([
+                            org for owner, org in map(sites.unqualify, tenants) if owner is site
+                        ])
+                        if config_get("password_policy.enabled", True):
+                            try:
+                                lm.password_policy.get_policies()
+                            except Exception as e:
+                                # Read again by the first password check
+                                logger.warning(f"Cannot read password policies of site {site.name}: {str(e)}")
+                except Exception as e:
+                    # Not fatal: requests will open connections on their own
+                    logger.error(f"LDAP warm-up of site {site.name} failed: {str(e)}")
+                    report.setdefault("errors", {})[site.name] = str(e)
+    report["duration"] = time.perf_counter() - start
+    READY.set()
+    logger.info(
+        f"Ready in {report['duration'] * 1000:.0f}ms: "
+        f"{report.get('ldap_connections', 0)} LDAP connection(s) opened, "
+        f"{report.get('tenants', 0)} tenant OU(s) primed."
+    )
+    return report
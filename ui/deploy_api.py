@@ -1,26 +1,12 @@
-import requests
-import time
-import base64
 import sys
-import os
-import json
 import argparse
-import urllib3
-import configparser
-import xmltodict
 import logging
-from pprint import pprint
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-requests.packages.urllib3.add_stderr_logger()
+from collections import OrderedDict
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s -- %(name)s -- %(levelname)s -- %(message)s')
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 console_formatter = logging.Formatter("%(levelname)s\t | %(message)s")
 console_logger = logging.StreamHandler()
@@ -28,6 +14,23 @@ console_logger.setFormatter(console_formatter)
 console_logger.setLevel(logging.DEBUG)
 logger.addHandler(console_logger)
 
+
+_requests = None
+
+
+def import_requests():
+    # requests is only imported by the commands talking to vCD
+    global _requests
+    if _requests is None:
+        import requests
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        requests.packages.urllib3.add_stderr_logger()
+        logging.getLogger("requests").setLevel(logging.WARNING)
+        logging.getLogger("urllib3").setLevel(logging.WARNING)
+        _requests = requests
+    return _requests
+
 ############### TO DELETE ################
 
 
@@ -35,10 +38,24 @@ logger.addHandler(console_logger)
 ########################################
 
 
+# Namespaces of vCD extension documents, mapped to stable prefixes for comparison
+NAMESPACES = {
+    "http://www.vmware.com/vcloud/v1.5": None,
+    "http://www.vmware.com/vcloud/extension/v1.5": "vmext",
+}
+# Service fields updated in place on redeploy, in the order of the vCD schema (AdminService)
+SERVICE_FIELDS = ["@name", "Description", "vmext:Namespace", "vmext:Enabled",
+                  "vmext:AuthorizationEnabled", "vmext:RoutingKey", "vmext:Exchange"]
+
+
 class APIExtension:
     def __init__(self, vcduri, username, password, org="System"):
         self._token = None
         self.vcduri = vcduri
+        # Keep-alive connection and cached service query
+        self._session = import_requests().Session()
+        self._session.verify = False
+        self._service_query = None
         self.getToken(username, org, password)
 
     def __request(self, method, path=None, data=None, uri=None, auth=None, content_type="application/vnd.vmware.admin.service+xml", accept="application/*+xml;version=31.0"):
@@ -51,8 +68,8 @@ class APIExtension:
             headers['Accept'] = accept
         if path:
             uri = self.vcduri+path
-        r = requests.request(method, uri, headers=headers, auth=auth,
-                             data=data, verify=False)
+        r = self._session.request(method, uri, headers=headers, auth=auth,
+                                  data=data)
         if 200 <= r.status_code <= 299:
             return r
         raise Exception(
@@ -65,19 +82,35 @@ class APIExtension:
                            accept='application/*+xml;version=31.0')
         self._token = r.headers['x-vcloud-authorization']
 
-    def get_extension_link(self, extension_name):
-        r = self.__request("GET", "/api/admin/extension/service/query")
-        data = xmltodict.parse(r.text)
-        logger.info("Got extension link")
-        if not("AdminServiceRecord" in data["QueryResultRecords"]):
-            logger.error('No extension to delete')
-            sys.exit(-1)
-        elif isinstance(data["QueryResultRecords"]["AdminServiceRecord"], list):
-            for item in data["QueryResultRecords"]["AdminServiceRecord"]:
-                if item['@namespace'] == extension_name:
-                    return "/api" + item['@href'].split("/api", 1)[-1]
-        elif isinstance(data["QueryResultRecords"]["AdminServiceRecord"], dict):
-            return "/api" + data["QueryResultRecords"]["AdminServiceRecord"]['@href'].split("/api", 1)[1]
+    def get_service_query(self):
+        import xmltodict
+        if self._service_query is None:
+            r = self.__request("GET", "/api/admin/extension/service/query")
+            self._service_query = xmltodict.parse(r.text)
+        return self._service_query
+
+    def get_extension_link(self, extension_name, required=True):
+        data = self.get_service_query()
+        records = data["QueryResultRecords"].get("AdminServiceRecord", [])
+        if isinstance(records, dict):
+            records = [records]
+        for item in records:
+            if item['@namespace'] == extension_name:
+                logger.info("Got extension link")
+                return "/api" + item['@href'].split("/api", 1)[-1]
+        if not required:
+            return None
+        logger.error('No extension found with namespace %s' % extension_name)
+        sys.exit(-1)
+
+    def list_extensions(self):
+        data = self.get_service_query()
+        records = data["QueryResultRecords"].get("AdminServiceRecord", [])
+        if isinstance(records, dict):
+            records = [records]
+        for item in records:
+            print("%s\t%s\tenabled=%s" % (item.get('@name'), item.get('@namespace'), item.get('@enabled')))
+        return records
 
     def get_extension_data(self, ext_uri):
         r = self.__request("GET", ext_uri)
@@ -105,26 +138,114 @@ class APIExtension:
     def delete_extension(self, extension_name):
         ext_uri = self.get_extension_link(extension_name)
         self.__request("DELETE", ext_uri)
+        self._service_query = None
         return
 
     def create_extension(self, extension_file):
         with open(extension_file, 'r') as f:
             payload = f.read()
         self.__request("POST", "/api/admin/extension/service", data=payload)
+        self._service_query = None
         logger.info("Extension is deployed")
         return
 
+    def parse_service(self, payload):
+        import xmltodict
+        return xmltodict.parse(payload, process_namespaces=True, namespaces=NAMESPACES)["vmext:Service"]
+
+    def get_url_patterns(self, data):
+        # Collect (pattern, href) of API filters, whatever the document layout
+        if isinstance(data, list):
+            return [p for item in data for p in self.get_url_patterns(item)]
+        if not isinstance(data, dict):
+            return []
+        pattern = data.get("vmext:UrlPattern", data.get("@urlPattern"))
+        if pattern is not None:
+            return [(pattern, data.get("@href"))]
+        return [p for value in data.values() for p in self.get_url_patterns(value)]
+
+    def update_extension(self, extension_file, extension_name):
+        import xmltodict
+        ext_uri = self.get_extension_link(extension_name, required=False)
+        if not ext_uri:
+            return self.create_extension(extension_file)
+        with open(extension_file, 'r') as f:
+            desired = self.parse_service(f.read())
+        current = self.parse_service(self.get_extension_data(ext_uri))
+
+        # Service fields: a single PUT with the changed values only
+        changes = [k for k in SERVICE_FIELDS if k in desired and desired[k] != current.get(k)]
+        if changes:
+            logger.info("Updating extension fields: %s" % ", ".join(changes))
+            self.__request("PUT", ext_uri, data=xmltodict.unparse(
+                {"vmext:Service": self.build_service(desired, current)}))
+
+        # API filters: add the missing ones, remove the obsolete ones
+        if "vmext:ApiFilters" in desired:
+            changes += self.update_api_filters(ext_uri, desired["vmext:ApiFilters"])
+
+        if changes:
+            logger.info("Extension is updated")
+        else:
+            logger.info("Extension is already up to date")
+        return
+
+    def build_service(self, desired, current):
+        # PUT body: the wanted fields (current values for the missing ones), in
+        # schema order, with the identity of the record. Other attributes of the
+        # record (xsi:schemaLocation...) and its links are not sent back, and
+        # the API filters are updated on their own.
+        service = OrderedDict([
+            ("@xmlns", "http://www.vmware.com/vcloud/v1.5"),
+            ("@xmlns:vmext", "http://www.vmware.com/vcloud/extension/v1.5"),
+        ])
+        for attribute in ("@id", "@href", "@type"):
+            if attribute in current:
+                service[attribute] = current[attribute]
+        for k in SERVICE_FIELDS:
+            value = desired.get(k, current.get(k))
+            if value is not None:
+                service[k] = value
+        return service
+
+    def update_api_filters(self, ext_uri, desired_filters):
+        import xmltodict
+        changes = []
+        wanted = [p for p, _ in self.get_url_patterns(desired_filters)]
+        filters_uri = ext_uri + "/apifilters"
+        existing = self.get_url_patterns(xmltodict.parse(
+            self.__request("GET", filters_uri).text, process_namespaces=True, namespaces=NAMESPACES))
+        for pattern, href in existing:
+            if pattern not in wanted and href:
+                logger.info("Removing API filter: %s" % pattern)
+                self.__request("DELETE", uri=href)
+                changes.append("ApiFilter")
+        for pattern in wanted:
+            if pattern not in [p for p, _ in existing]:
+                logger.info("Adding API filter: %s" % pattern)
+                payload = xmltodict.unparse({"vmext:ApiFilter": {
+                    "@xmlns:vmext": "http://www.vmware.com/vcloud/extension/v1.5",
+                    "vmext:UrlPattern": pattern}})
+                self.__request("POST", filters_uri, data=payload,
+                               content_type="application/vnd.vmware.admin.apifilter+xml")
+                changes.append("ApiFilter")
+        return changes
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('API Extension Helper')
     parser.add_argument(
-        'command', help='Valid Commands: deploy, redeploy, remove')
+        'command', help='Valid Commands: deploy, redeploy, remove, list')
     parser.add_argument("--server", "-s", help="Hostame server", required=True)
     parser.add_argument("--user", "-u", help="Username to connect", required=True)
     parser.add_argument("--password", "-p", help="Password to connect", required=True)
-    parser.add_argument("--extension_file", "-e", help="Folder and name of the file in xml which describe extension", required=True)
-    parser.add_argument("--extension_name", "-n", help="Extension name", required=True)
+    parser.add_argument("--extension_file", "-e", help="Folder and name of the file in xml which describe extension")
+    parser.add_argument("--extension_name", "-n", help="Extension name")
     args = parser.parse_args()
+    if args.command in ('deploy', 'redeploy') and not args.extension_file:
+        parser.error("--extension_file is required by command %s" % args.command)
+    if args.command in ('redeploy', 'remove') and not args.extension_name:
+        parser.error("--extension_name is required by command %s" % args.command)
 
     vcduri = "https://" + args.server
     user = args.user
@@ -137,12 +258,12 @@ if __name__ == '__main__':
     if args.command == 'deploy':
         api.create_extension(extension_file)
     elif args.command == 'redeploy':
-        api.disable_extension(extension_name)
-        api.delete_extension(extension_name)
-        api.create_extension(extension_file)
+        api.update_extension(extension_file, extension_name)
     elif args.command == 'remove':
         api.disable_extension(extension_name)
         api.delete_extension(extension_name)
+    elif args.command == 'list':
+        api.list_extensions()
     else:
         raise ValueError('Command (%s) not found' % args.command)
     sys.exit(0)
@@ -1,24 +1,17 @@
-import requests
 import time
-import base64
 import sys
 import os
 import json
 import argparse
-import urllib3
-import configparser
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pprint
 
-requests.packages.urllib3.add_stderr_logger()
-
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s -- %(name)s -- %(levelname)s -- %(message)s')
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 console_formatter = logging.Formatter("%(levelname)s\t | %(message)s")
 console_logger = logging.StreamHandler()
@@ -27,14 +20,40 @@ console_logger.setLevel(logging.DEBUG)
 logger.addHandler(console_logger)
 
 
+_requests = None
+
+
+def import_requests():
+    # requests is only imported by the commands talking to vCD
+    global _requests
+    if _requests is None:
+        import requests
+        import urllib3
+        requests.packages.urllib3.add_stderr_logger()
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        logging.getLogger("requests").setLevel(logging.WARNING)
+        logging.getLogger("urllib3").setLevel(logging.WARNING)
+        _requests = requests
+    return _requests
+
+
 class UiPlugin:
-    def __init__(self, vcduri, username, password, org="System"):
+    def __init__(self, vcduri, username, password, org="System", workers=4):
         self._token = None
         self.vcduri = vcduri
         self.current_ui_extension = {}
+        self.workers = workers
+        # Keep-alive connections, shared by the threads of parallel operations
+        # (tenants publications run in parallel inside parallel deployments)
+        requests = import_requests()
+        self._session = requests.Session()
+        self._session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers * workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
         self.getToken(username, org, password)
 
-    def __request(self, method, path=None, data=None, uri=None, auth=None, content_type="application/json", accept="application/json"):
+    def __request(self, method, path=None, data=None, uri=None, auth=None, content_type="application/json", accept="application/json", retries=0):
         headers = {}
         if self._token:
             headers['x-vcloud-authorization'] = self._token
@@ -45,13 +64,25 @@ class UiPlugin:
         if path:
             uri = self.vcduri+path
 
-        r = requests.request(method, uri, headers=headers, auth=auth,
-                             data=data, verify=False)
-        if 200 <= r.status_code <= 299:
-            return r
-        else :
+        for attempt in range(retries + 1):
+            if attempt:
+                # Exponential backoff before a new attempt
+                time.sleep(2 ** (attempt - 1))
+                logger.warning("Retrying %s %s (%d/%d)" % (method, uri, attempt, retries))
+            if hasattr(data, 'seek'):
+                data.seek(0)  # stream the file again from its beginning
+            try:
+                r = self._session.request(method, uri, headers=headers, auth=auth,
+                                          data=data)
+            except import_requests().exceptions.RequestException as e:
+                logger.error("Request error -> %s" % e)
+                continue
+            if 200 <= r.status_code <= 299:
+                return r
             logger.error("Request code error -> %s" %r.status_code)
-            sys.exit(0)
+            if r.status_code < 500:
+                break
+        sys.exit(0)
 
     def getToken(self, username, org, password):
         r = self.__request('POST',
@@ -78,8 +109,8 @@ class UiPlugin:
     def postUiExtensionPlugin(self, eid, data):
         return self.__request('POST', '/cloudapi/extensions/ui/%s/plugin' % eid, json.dumps(data))
 
-    def putUiExtensionPlugin(self, uri, data):
-        return self.__request('PUT', uri=uri, content_type="application/zip", accept=None, data=data)
+    def putUiExtensionPlugin(self, uri, data, retries=0):
+        return self.__request('PUT', uri=uri, content_type="application/zip", accept=None, data=data, retries=retries)
 
     def deleteUiExtensionPlugin(self, eid):
         return self.__request('DELETE', '/cloudapi/extensions/ui/%s/plugin' % eid)
@@ -108,12 +139,44 @@ class UiPlugin:
         }
         return self.postUiExtensionPlugin(eid, data)
 
-    def putUiExtensionPluginFromFile(self, eid, fn):
-        data = open(fn, 'rb').read()
-        return self.putUiExtensionPlugin(eid, data)
+    def putUiExtensionPluginFromFile(self, uri, fn, retries=3):
+        # Stream the file instead of loading it in memory
+        with open(fn, 'rb') as data:
+            return self.putUiExtensionPlugin(uri, data, retries=retries)
+
+    def checksumFile(self, fn):
+        sha = hashlib.sha256()
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def getUploadedChecksum(self, fn, eid):
+        # Checksums of the uploaded plugins are kept next to the plugin file
+        try:
+            with open(self.checksumStateFile(fn)) as f:
+                return json.load(f).get(self.vcduri, {}).get(eid)
+        except (OSError, ValueError):
+            return None
 
-    def deleteUiExtensionPluginSafe(self, eid):
-        if self.current_ui_extension.get('plugin_status', None) == 'ready':
+    def setUploadedChecksum(self, fn, eid, checksum):
+        state_file = self.checksumStateFile(fn)
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        state.setdefault(self.vcduri, {})[eid] = checksum
+        with open(state_file, 'w') as f:
+            json.dump(state, f, indent=2)
+
+    def checksumStateFile(self, fn):
+        return os.path.join(os.path.dirname(os.path.abspath(fn)), '.uploaded_plugins.json')
+
+    def deleteUiExtensionPluginSafe(self, eid, ext=None):
+        if ext is None:
+            ext = self.current_ui_extension
+        if ext.get('plugin_status', None) == 'ready':
             return self.deleteUiExtensionPlugin(eid)
         else:
             print('Unable to delete plugin for %s' % eid)
@@ -140,20 +203,31 @@ class UiPlugin:
             "enabled": enabled
         }
 
-    def addExtension(self, data, fn, publishAll=False):
+    def addExtension(self, data, fn, publishAll=False, tenants=None):
         r = self.postUiExtension(data).json()
         eid = r['id']
-        self.addPlugin(eid, fn, publishAll=publishAll)
+        self.addPlugin(eid, fn, publishAll=publishAll, tenants=tenants)
 
-    def addPlugin(self, eid, fn, publishAll=False):
+    def addPlugin(self, eid, fn, publishAll=False, tenants=None, checksum=None):
         r = self.postUiExtensionPluginFromFile(eid, fn)
         link = r.headers["Link"].split('>')[0][1:]
 
         self.putUiExtensionPluginFromFile(link, fn)
+        self.setUploadedChecksum(fn, eid, checksum or self.checksumFile(fn))
 
-        if publishAll:
+        if tenants:
+            self.publishTenants(eid, tenants)
+        elif publishAll:
             self.postUiExtensionTenantsPublishAll(eid)
 
+    def publishTenants(self, eid, tenants):
+        """Publish an extension to some tenants, one concurrent request per tenant."""
+        def publish(tenant):
+            return self.postUiExtensionTenantsPublish(eid, json.dumps([{"name": tenant}]))
+
+        for done, tenant in enumerate(self.runParallel(publish, tenants), 1):
+            logger.info("Published to tenant %s (%d/%d)" % (tenant, done, len(tenants)))
+
     def removeAllUiExtensions(self):
         for ext in self.walkUiExtensions():
             self.removeExtension(ext['id'])
@@ -165,30 +239,59 @@ class UiPlugin:
     def removePlugin(self, eid):
         self.deleteUiExtensionPluginSafe(eid)
 
-    def replacePlugin(self, eid, fn, publishAll=False):
-        self.removePlugin(eid)
-        self.addPlugin(eid, fn, publishAll=publishAll)
+    def replacePlugin(self, eid, fn, publishAll=False, tenants=None, ext=None):
+        checksum = self.checksumFile(fn)
+        if (ext or {}).get('plugin_status') == 'ready' and self.getUploadedChecksum(fn, eid) == checksum:
+            # Same plugin already on the server: only publish it
+            logger.info("Plugin %s is already uploaded, skipping upload" % fn)
+            if tenants:
+                self.publishTenants(eid, tenants)
+            elif publishAll:
+                self.postUiExtensionTenantsPublishAll(eid)
+            return
+        self.deleteUiExtensionPluginSafe(eid, ext)
+        self.addPlugin(eid, fn, publishAll=publishAll, tenants=tenants, checksum=checksum)
 
     ###
 
-    def deploy(self, basedir):
+    def runParallel(self, func, items):
+        """Call func for each item in the worker threads, yield items as they are done."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(func, item): item for item in items}
+            for future in as_completed(futures):
+                future.result()
+                yield futures[future]
+
+    def indexUiExtensions(self):
+        """Get the deployed extensions, by (pluginName, version), with a single request."""
+        return {(ext['pluginName'], ext['version']): ext for ext in self.getUiExtensions().json()}
+
+    def deploy(self, basedir, extensions=None, tenants=None):
         manifest = self.parseManifest(
             '%s/manifest.json' % basedir, enabled=True)
 
-        eid = None
-        for ext in self.walkUiExtensions():
-            if manifest['pluginName'] == ext['pluginName'] and manifest['version'] == ext['version']:
-                eid = ext['id']
-                break
+        if extensions is None:
+            extensions = self.indexUiExtensions()
+        ext = extensions.get((manifest['pluginName'], manifest['version']))
 
-        if not eid:
+        if not ext:
             self.addExtension(manifest, '%s/plugin.zip' %
-                              basedir, publishAll=True)
+                              basedir, publishAll=True, tenants=tenants)
         else:
-            self.replacePlugin(eid, '%s/plugin.zip' %
-                               basedir, publishAll=True)
+            self.replacePlugin(ext['id'], '%s/plugin.zip' %
+                               basedir, publishAll=True, tenants=tenants, ext=ext)
         logger.info("Extension UI deploy")
 
+    def deployMany(self, basedirs, tenants=None):
+        """Deploy several plugin folders in parallel."""
+        extensions = self.indexUiExtensions()
+
+        def deploy(basedir):
+            return self.deploy(basedir, extensions=extensions, tenants=tenants)
+
+        for done, basedir in enumerate(self.runParallel(deploy, basedirs), 1):
+            logger.info("Deployed %s (%d/%d)" % (basedir, done, len(basedirs)))
+
     def remove(self, basedir):
         manifest = self.parseManifest(
             '%s/manifest.json' % basedir, enabled=True)
@@ -209,20 +312,23 @@ if __name__ == '__main__':
     parser.add_argument("--server", "-s", help="Hostame server", required=True)
     parser.add_argument("--user", "-u", help="Username to connect", required=True)
     parser.add_argument("--password", "-p", help="Password to connect", required=True)
-    parser.add_argument("--folder", "-f", help="Folder where is plugin.zip and manifest.json", required=True)
+    parser.add_argument("--folder", "-f", nargs='+', help="Folder(s) where is plugin.zip and manifest.json", required=True)
+    parser.add_argument("--tenants", "-t", nargs='+', help="Publish to these tenants only (default: all)")
+    parser.add_argument("--workers", "-w", type=int, default=4, help="Number of parallel requests")
     args = parser.parse_args()
 
     vcduri = "https://" + args.server
     user = args.user
     password = args.password
-    folder = args.folder
+    folders = args.folder
 
-    ui = UiPlugin(vcduri, user, password)
+    ui = UiPlugin(vcduri, user, password, workers=args.workers)
 
     if args.command == 'deploy':
-        ui.deploy(folder)
+        ui.deployMany(folders, tenants=args.tenants)
     elif args.command == 'remove':
-        ui.remove(folder)
+        for folder in folders:
+            ui.remove(folder)
     elif args.command == 'removeAllUiExtensions':
         ui.removeAllUiExtensions()
     elif args.command == 'listUiExtensions':